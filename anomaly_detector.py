@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备遥测异常检测
+在心跳流上增量检测，每个 unit 每次心跳只做常数次计算，不需要定期扫描全部设备:
+    阈值    cpu_temp / sense_temp 过高、video_fps / spi_fps 过低（ANOMALY_THRESHOLDS）
+    漂移    每个指标维护 EWMA 均值和方差，z 分数朝异常方向超过 ANOMALY_DRIFT_Z（如帧率突然下降）
+    静默    每个 unit 的下次心跳截止时间放在哈希时间轮中，时间轮每个刻度只检查到期的槽
+
+告警在产生和恢复时各发布一次事件，经 event_subscriptions 推送给订阅的 Backend:
+    {"event": "alert", "state": "raised" | "cleared", "kind": "threshold" | "drift" | "silent",
+     "unit": "...", "metric": "cpu_temp", "value": 91.5, "limit": 85, "ts": 1760860000.0}
+"""
+
+import math
+import time
+import threading
+import logging
+from array import array
+from config import *
+
+logger = logging.getLogger(__name__)
+
+KIND_THRESHOLD = "threshold"
+KIND_DRIFT = "drift"
+KIND_SILENT = "silent"
+
+STATE_RAISED = "raised"
+STATE_CLEARED = "cleared"
+
+
+class _Metric:
+    """单个指标的 EWMA 均值和方差"""
+
+    __slots__ = ('mean', 'var', 'count')
+
+    def __init__(self, mean=0.0, var=0.0, count=0):
+        self.mean = mean
+        self.var = var
+        self.count = count
+
+    def update(self, value, alpha):
+        if self.count == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            incr = alpha * diff
+            self.mean += incr
+            self.var = (1 - alpha) * (self.var + diff * incr)
+        self.count += 1
+
+
+class _UnitState:
+    """单个 unit 的检测状态"""
+
+    __slots__ = ('metrics', 'active', 'deadline', 'slot', 'baseline')
+
+    def __init__(self, baseline=None):
+        self.metrics = {}         # 指标 → _Metric
+        self.active = {}          # (kind, metric) → 告警事件
+        self.deadline = 0         # 静默截止刻度
+        self.slot = None          # 所在时间轮槽，None 表示不在时间轮中（已告警静默）
+        self.baseline = baseline  # 快照基线中的行号，指标首次出现时再从快照恢复
+
+
+class AnomalyDetector:
+    """异常检测类 - 心跳流水线消费者，告警推送给订阅的 Backend"""
+
+    def __init__(self, silent_timeout=ANOMALY_SILENT_TIMEOUT, tick=ANOMALY_WHEEL_TICK, silent_detection=True):
+        """
+        初始化检测器
+
+        Args:
+            silent_timeout: 超过该时间（秒）没有心跳视为静默
+            tick: 时间轮刻度（秒），静默检测的精度
+            silent_detection: 是否检测静默（集群模式下本实例只收到部分心跳，需关闭）
+        """
+        self.thresholds = ANOMALY_THRESHOLDS
+        self.drift_direction = ANOMALY_DRIFT
+        self.alpha = ANOMALY_EWMA_ALPHA
+        self.drift_z = ANOMALY_DRIFT_Z
+        self.warmup = ANOMALY_WARMUP
+        self.min_std = ANOMALY_MIN_STD
+        self.tick = tick
+        self.timeout_ticks = max(1, math.ceil(silent_timeout / tick))
+        self.silent_detection = silent_detection
+
+        self.lock = threading.Lock()
+        self.units = {}
+        self.baselines = {}  # 指标 → (mean, var, count) 数组，快照恢复的基线
+        # 哈希时间轮：槽数大于超时刻度数，截止时间只会落在一圈之内
+        self.wheel = [set() for _ in range(self.timeout_ticks + 1)]
+        self.current_tick = self._now_tick()
+
+        self.listeners = []
+        self.hub = None  # 事件订阅中心，ALR 订阅通过它推送
+        self.running = False
+        self.thread = None
+
+        # 统计
+        self.samples = 0
+        self.raised = 0
+        self.cleared = 0
+
+    def _now_tick(self):
+        return int(time.monotonic() / self.tick)
+
+    def start(self):
+        """启动时间轮线程"""
+        if not self.silent_detection:
+            logger.info("✓ 异常检测已启动 (静默检测已关闭)")
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._wheel_loop, name="anomaly-wheel", daemon=True)
+        self.thread.start()
+        logger.info(f"✓ 异常检测已启动 (静默超时 {self.timeout_ticks * self.tick}s)")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=self.tick * 2 + 1)
+            self.thread = None
+
+    def add_listener(self, listener):
+        """
+        注册告警监听函数
+
+        Args:
+            listener: 接收告警事件 (dict)
+        """
+        self.listeners.append(listener)
+
+    def set_event_hub(self, hub):
+        """设置事件订阅中心，告警经它推送给订阅的 Backend"""
+        self.hub = hub
+        self.add_listener(hub.publish_alert)
+
+    # ---------------- 心跳检测 ----------------
+
+    def update_batch(self, batch):
+        """
+        心跳流水线消费者
+
+        Args:
+            batch: [(unit, received_at, data), ...]
+        """
+        events = []
+        with self.lock:
+            now_tick = self._now_tick()
+            for unit, received_at, data in batch:
+                state = self.units.get(unit)
+                if state is None:
+                    state = self.units[unit] = _UnitState()
+                if self.silent_detection:
+                    self._reschedule(unit, state, now_tick)
+                self._clear(unit, state, KIND_SILENT, None, received_at, events)
+                for metric in self.thresholds:
+                    value = data.get(metric)
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    self._check_metric(unit, state, metric, float(value), received_at, events)
+                self.samples += 1
+        self._emit(events)
+
+    def _check_metric(self, unit, state, metric, value, ts, events):
+        """阈值和漂移检测，检测后再更新 EWMA（异常值本身不参与本次判断的基线）"""
+        low, high = self.thresholds[metric]
+        if high is not None and value > high:
+            self._raise(unit, state, KIND_THRESHOLD, metric, ts, events, value=value, limit=high)
+        elif low is not None and value < low:
+            self._raise(unit, state, KIND_THRESHOLD, metric, ts, events, value=value, limit=low)
+        else:
+            self._clear(unit, state, KIND_THRESHOLD, metric, ts, events, value=value)
+
+        m = state.metrics.get(metric)
+        if m is None:
+            m = state.metrics[metric] = _Metric(*self._baseline(state, metric))
+        direction = self.drift_direction.get(metric)
+        if direction and m.count >= self.warmup:
+            std = max(math.sqrt(m.var), self.min_std)
+            z = (value - m.mean) / std
+            if z * direction > self.drift_z:
+                self._raise(unit, state, KIND_DRIFT, metric, ts, events,
+                            value=value, mean=round(m.mean, 3), z=round(z, 2))
+            else:
+                self._clear(unit, state, KIND_DRIFT, metric, ts, events, value=value)
+        m.update(value, self.alpha)
+
+    def _raise(self, unit, state, kind, metric, ts, events, **fields):
+        key = (kind, metric)
+        if key in state.active:
+            return
+        event = {"event": "alert", "state": STATE_RAISED, "kind": kind, "unit": unit, "metric": metric,
+                 "ts": ts, **fields}
+        state.active[key] = event
+        events.append(event)
+        self.raised += 1
+
+    def _clear(self, unit, state, kind, metric, ts, events, **fields):
+        if state.active.pop((kind, metric), None) is None:
+            return
+        events.append({"event": "alert", "state": STATE_CLEARED, "kind": kind, "unit": unit,
+                       "metric": metric, "ts": ts, **fields})
+        self.cleared += 1
+
+    # ---------------- 静默检测（哈希时间轮） ----------------
+
+    def _reschedule(self, unit, state, now_tick):
+        """收到心跳，截止时间顺延（O(1) 移动到新槽）"""
+        if state.slot is not None:
+            self.wheel[state.slot].discard(unit)
+        state.deadline = now_tick + self.timeout_ticks
+        state.slot = state.deadline % len(self.wheel)
+        self.wheel[state.slot].add(unit)
+
+    def _wheel_loop(self):
+        while self.running:
+            time.sleep(self.tick)
+            self.advance()
+
+    def advance(self):
+        """推进时间轮到当前刻度，检查经过的槽中到期的 unit"""
+        events = []
+        now = time.time()
+        with self.lock:
+            now_tick = self._now_tick()
+            # 停顿超过一圈时只需检查整圈
+            first = max(self.current_tick + 1, now_tick - len(self.wheel) + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self.wheel[tick % len(self.wheel)]
+                expired = [unit for unit in slot if self.units[unit].deadline <= now_tick]
+                for unit in expired:
+                    slot.discard(unit)
+                    state = self.units[unit]
+                    state.slot = None
+                    self._raise(unit, state, KIND_SILENT, None, now, events,
+                                timeout=self.timeout_ticks * self.tick)
+            self.current_tick = now_tick
+        self._emit(events)
+
+    # ---------------- 告警推送 ----------------
+
+    def _emit(self, events):
+        """在锁外发布告警"""
+        for event in events:
+            if event["state"] == STATE_RAISED:
+                logger.warning(f"⚠️ 设备告警 [{event['kind']}] unit={event['unit']} "
+                               f"metric={event['metric']} value={event.get('value')}")
+            else:
+                logger.info(f"✓ 设备告警恢复 [{event['kind']}] unit={event['unit']} metric={event['metric']}")
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    logger.error(f"✗ 告警监听函数出错: {e}")
+
+    # ---------------- 快照 ----------------
+
+    def dump_snapshot(self, writer):
+        """
+        导出快照段：每个指标的 EWMA 基线（列式数组，count 为 0 表示没有该指标）和未恢复的告警。
+        锁内只复制设备列表和告警，基线在锁外读取（只是近似值，与并发更新交错不影响检测）
+        """
+        metrics = list(self.thresholds)
+        with self.lock:
+            states = list(self.units.items())
+            alerts = [event for _, state in states if state.active for event in state.active.values()]
+
+        writer.strings(metrics)
+        writer.strings([unit for unit, _ in states])
+        for metric in metrics:
+            # 直接写入数组，不保留 10 万个元组（大量存活的新对象会触发全量垃圾回收，期间持有 GIL）
+            means, variances, counts = array('d'), array('d'), array('I')
+            for _, state in states:
+                mean, var, count = self._metric_tuple(state, metric)
+                means.append(mean)
+                variances.append(var)
+                counts.append(count)
+            writer.array('d', means)
+            writer.array('d', variances)
+            writer.array('I', counts)
+        writer.json(alerts)
+
+    def _baseline(self, state, metric):
+        """返回快照中的 (mean, var, count)，没有基线时返回零值"""
+        column = self.baselines.get(metric)
+        if column is None or state.baseline is None:
+            return 0.0, 0.0, 0
+        means, variances, counts = column
+        i = state.baseline
+        return means[i], variances[i], counts[i]
+
+    def _metric_tuple(self, state, metric):
+        m = state.metrics.get(metric)
+        return (m.mean, m.var, m.count) if m else self._baseline(state, metric)
+
+    def load_snapshot(self, reader):
+        """
+        导入快照段，EWMA 基线保留为数组，设备的指标首次出现时再恢复（10 万台设备的加载不需要创建几十万个对象）。
+        静默截止时间从现在重新计算（停机期间不计入静默，重启后超时仍未收到心跳才告警），
+        快照时已静默的设备保持告警状态，收到心跳后恢复
+        """
+        metrics = reader.strings()
+        units = reader.strings()
+        baselines = {metric: (reader.array(), reader.array(), reader.array()) for metric in metrics}
+        alerts = reader.json()
+
+        restored = {}
+        with self.lock:
+            self.baselines = {metric: column for metric, column in baselines.items() if metric in self.thresholds}
+            for i, unit in enumerate(units):
+                if unit not in self.units:
+                    state = self.units[unit] = restored[unit] = _UnitState(i)
+            for event in alerts:
+                state = restored.get(event["unit"])
+                # 关闭静默检测时不恢复静默告警（不会再有对应的恢复事件）
+                if state is not None and (self.silent_detection or event["kind"] != KIND_SILENT):
+                    state.active.setdefault((event["kind"], event["metric"]), event)
+
+            if self.silent_detection:
+                # 恢复的设备截止时间相同，批量放入同一个槽
+                deadline = self._now_tick() + self.timeout_ticks
+                slot = deadline % len(self.wheel)
+                scheduled = [unit for unit, state in restored.items() if (KIND_SILENT, None) not in state.active]
+                for unit in scheduled:
+                    state = restored[unit]
+                    state.deadline = deadline
+                    state.slot = slot
+                self.wheel[slot].update(scheduled)
+        logger.info(f"✓ 异常检测基线已从快照恢复: {len(units)} 台设备")
+
+    def active_alerts(self):
+        """返回当前所有未恢复的告警"""
+        with self.lock:
+            return [event for state in self.units.values() for event in state.active.values()]
+
+    def cmd_alerts(self, conn, json_data):
+        """
+        ALR 本地命令
+        {"type": "ALR", "subscribe": true} 订阅告警推送（等同于 SUB events=["alert"]，需多路复用连接），
+        回复中附带当前未恢复的告警
+        """
+        response = {"type": "ALR", "ok": True}
+        if json_data.get('subscribe') and self.hub:
+            sub = self.hub.cmd_subscribe(conn, {"events": ["alert"]})
+            if not sub["ok"]:
+                return {"type": "ALR", "ok": False, "error": sub["error"]}
+            response["sub_id"] = sub["sub_id"]
+        response["active"] = self.active_alerts()
+        return response
+
+    def get_stats(self):
+        """检测统计"""
+        with self.lock:
+            units = len(self.units)
+            active = sum(len(state.active) for state in self.units.values())
+        return {"units": units, "samples": self.samples, "raised": self.raised,
+                "cleared": self.cleared, "active": active}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+负载编码基准测试
+按命令类型比较 JSON / MessagePack / CBOR 的线上字节数与编解码耗时，
+以及二进制设备回复转为 JSON 的转码耗时（中转服务为每条回复额外付出的开销）
+
+用法:
+    python bench_payload_codec.py              # 默认每项 20000 次
+    python bench_payload_codec.py 100000       # 指定次数
+"""
+
+import sys
+import timeit
+from payload_codec import PayloadCodec, available_encodings, encode, decode, ENCODING_JSON
+from test_client import TEST_COMMANDS_CONFIG
+
+# 典型的 SCS 设备回复（设备当前设置），用于测量回复转码开销
+SAMPLE_SCS_REPLY = {
+    "type": "SCS",
+    "unit": "MS500-H120-EP-zlcu-0059",
+    "camera": "2622",
+    "settings": {
+        "brightness": 90,
+        "contrast": 60,
+        "exposure": "manual",
+        "exposure_value": 1000,
+        "detection_threshold": 0.6,
+        "cs_picEnable": True,
+        "cs_vidEnable": False,
+        "cs_picMode": 0,
+        "cs_picQuality": 95,
+        "cs_vidFps": 30,
+        "wifi_enabled": True,
+        "network": "eth",
+    },
+    "coordinates": {
+        "roi1": [[100, 100], [200, 100], [200, 200], [100, 200]],
+        "roi2": [[300, 150], [400, 150], [400, 250], [300, 250]],
+    },
+}
+
+
+def _per_call_us(func, number):
+    """单次调用耗时（微秒），取 3 轮中的最小值"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def bench_commands(number):
+    """按命令类型测量各编码的字节数和编解码耗时"""
+    encodings = available_encodings()
+    header = f"{'命令':<6}" + "".join(f"{e + ' 字节':>14}{'编码µs':>10}{'解码µs':>10}" for e in encodings)
+    print(header)
+    print("-" * len(header))
+
+    totals = {e: 0 for e in encodings}
+    for command_type, fields in TEST_COMMANDS_CONFIG.items():
+        command = {"type": command_type, **fields}
+        row = f"{command_type:<6}"
+        for encoding in encodings:
+            payload = encode(encoding, command)
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            totals[encoding] += len(payload)
+            encode_us = _per_call_us(lambda: encode(encoding, command), number)
+            decode_us = _per_call_us(lambda: decode(encoding, payload), number)
+            row += f"{len(payload):>14}{encode_us:>10.2f}{decode_us:>10.2f}"
+        print(row)
+
+    print("-" * len(header))
+    baseline = totals[ENCODING_JSON]
+    for encoding in encodings:
+        print(f"{encoding:<8} 合计 {totals[encoding]:>6} 字节 ({totals[encoding] / baseline:.0%} of JSON)")
+
+
+def bench_reply_transcode(number):
+    """测量设备回复转为 JSON 的开销（JSON 回复原样转发，作为对照）"""
+    codec = PayloadCodec()
+    print(f"\nSCS 回复转码（设备 → Backend JSON）")
+    for encoding in codec.available:
+        payload = encode(encoding, SAMPLE_SCS_REPLY)
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        view = memoryview(payload)
+        transcode_us = _per_call_us(lambda: codec.transcode_reply(None, view), number)
+        print(f"  {encoding:<8} {len(payload):>5} 字节  {transcode_us:>8.2f} µs")
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    encodings = available_encodings()
+    print(f"可用编码: {', '.join(encodings)}（每项 {number} 次）\n")
+    if len(encodings) == 1:
+        print("⚠️ 未安装 msgpack / cbor2，只能测试 JSON: pip install msgpack cbor2\n")
+
+    bench_commands(number)
+    bench_reply_transcode(number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+集群模式
+多个中转服务实例通过 MQTT 共享订阅 ($share/<group>/...) 分摊设备消息，
+回复落在没有对应请求的实例上时，转发给持有该 unit 请求的实例
+
+实例之间通过以下主题协作（均为普通订阅，不共享）:
+    /bridge/ms500/instances/{instance}        实例在线标记（保留消息，遗嘱清除）
+    /bridge/ms500/owner/{unit}                unit 当前由哪个实例等待回复（保留消息）
+    /bridge/ms500/encoding/{unit}             从设备心跳学到的编码（保留消息，心跳由各实例分摊，
+                                              收到心跳的实例发布，其他实例据此编码发往该设备的命令）
+    /bridge/ms500/{instance}/fwd/<原主题>      转发给该实例的设备消息
+"""
+
+import os
+import socket
+import threading
+import logging
+from config import *
+
+logger = logging.getLogger(__name__)
+
+INSTANCE_TOPIC = "/bridge/ms500/instances/{instance}"
+OWNER_TOPIC = "/bridge/ms500/owner/{unit}"
+ENCODING_TOPIC = "/bridge/ms500/encoding/{unit}"
+# 实例间协作主题的前缀（流量抓取不记录）
+COORDINATION_PREFIXES = tuple(topic.split('{')[0] for topic in (INSTANCE_TOPIC, OWNER_TOPIC, ENCODING_TOPIC))
+FORWARD_TOPIC = "/bridge/ms500/{instance}/fwd"
+
+
+class ClusterCoordinator:
+    """集群协调类 - 维护 unit 归属并在实例间转发回复"""
+
+    def __init__(self, mqtt_service, instance_id=None, group=CLUSTER_GROUP):
+        """
+        初始化集群协调器（需在 MQTT 服务启动前创建，以便设置遗嘱消息）
+
+        Args:
+            mqtt_service: MQTTService 实例
+            instance_id: 实例ID，默认为 主机名-进程号
+            group: 共享订阅组名
+        """
+        self.mqtt_service = mqtt_service
+        self.instance_id = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.group = group
+
+        self.lock = threading.Lock()
+        self.claimed = set()          # 本实例正在等待回复的 unit
+        self.owners = {}              # unit → 实例ID（来自其他实例的保留消息）
+        self.live_instances = set()   # 在线实例
+        self.codec = None
+        self.forwarded = 0
+        self.received_forwarded = 0
+        self.encodings_published = 0
+        self.encodings_received = 0
+
+        self.forward_prefix = FORWARD_TOPIC.format(instance=self.instance_id)
+
+        # 遗嘱：实例异常退出时清除在线标记，其他实例随即忽略它的 unit 归属
+        instance_topic = INSTANCE_TOPIC.format(instance=self.instance_id)
+        self.mqtt_service.client.will_set(instance_topic, b'', retain=True)
+
+        mqtt_service.add_route(INSTANCE_TOPIC.format(instance='{instance}'), self._handle_instance, shared=False)
+        mqtt_service.add_route(OWNER_TOPIC, self._handle_owner, shared=False)
+        mqtt_service.add_route(self.forward_prefix + "/#", self._handle_forwarded, shared=False)
+        mqtt_service.set_connect_callback(self._on_connect)
+
+        logger.info(f"✓ 集群模式已启用: 实例={self.instance_id}, 共享组={self.group}")
+
+    def set_codec(self, codec):
+        """
+        同步设备编码（需在 MQTT 服务启动前调用）：本实例从心跳学到的编码发布为保留消息，
+        其他实例学到的编码写入本实例的 PayloadCodec
+
+        Args:
+            codec: PayloadCodec 实例
+        """
+        self.codec = codec
+        codec.add_advertise_callback(self.publish_encoding)
+        self.mqtt_service.add_route(ENCODING_TOPIC, self._handle_encoding, shared=False)
+
+    def publish_encoding(self, unit, encoding):
+        """发布本实例从心跳学到的编码"""
+        if self.mqtt_service.publish(ENCODING_TOPIC.format(unit=unit), encoding, retain=True):
+            with self.lock:
+                self.encodings_published += 1
+
+    def _handle_encoding(self, topic, payload, captures):
+        """其他实例学到的编码（本实例发布的保留消息也会收到，值相同）"""
+        with self.lock:
+            self.encodings_received += 1
+        self.codec.set_advertised(captures['unit'], payload.decode('utf-8') if payload else None)
+
+    def _on_connect(self):
+        """连接成功后发布在线标记，并重新声明本实例持有的 unit"""
+        self.mqtt_service.publish(INSTANCE_TOPIC.format(instance=self.instance_id),
+                                  self.instance_id, retain=True)
+        with self.lock:
+            claimed = list(self.claimed)
+        for unit in claimed:
+            self.mqtt_service.publish(OWNER_TOPIC.format(unit=unit), self.instance_id, retain=True)
+
+    def _handle_instance(self, topic, payload, captures):
+        """实例在线标记"""
+        instance = captures['instance']
+        with self.lock:
+            if payload:
+                self.live_instances.add(instance)
+            else:
+                self.live_instances.discard(instance)
+        logger.info(f"集群实例{'上线' if payload else '下线'}: {instance}")
+
+    def _handle_owner(self, topic, payload, captures):
+        """unit 归属变化"""
+        unit = captures['unit']
+        with self.lock:
+            if payload:
+                self.owners[unit] = payload.decode('utf-8')
+            else:
+                self.owners.pop(unit, None)
+
+    def _handle_forwarded(self, topic, payload, captures):
+        """其他实例转发来的设备消息，按原主题重新分发（不会再次转发）"""
+        self.received_forwarded += 1
+        self.mqtt_service.dispatch_forwarded('/' + captures['#'], payload)
+
+    def claim(self, unit):
+        """声明本实例等待 unit 的回复"""
+        with self.lock:
+            if unit in self.claimed:
+                return
+            self.claimed.add(unit)
+        self.mqtt_service.publish(OWNER_TOPIC.format(unit=unit), self.instance_id, retain=True)
+
+    def release(self, unit):
+        """本实例不再等待 unit 的回复，清除归属"""
+        with self.lock:
+            if unit not in self.claimed:
+                return
+            self.claimed.discard(unit)
+            owner = self.owners.get(unit)
+        # 其他实例已经接手时不清除
+        if owner in (None, self.instance_id):
+            self.mqtt_service.publish(OWNER_TOPIC.format(unit=unit), b'', retain=True)
+
+    def forward_if_remote(self, unit, topic, payload):
+        """
+        回复属于其他实例时转发过去
+
+        Args:
+            unit: 设备单元标识
+            topic: 原始主题
+            payload: 原始数据
+
+        Returns:
+            bool: 已转发返回True，应由本实例处理返回False
+        """
+        with self.lock:
+            if unit in self.claimed:
+                return False
+            owner = self.owners.get(unit)
+            if not owner or owner == self.instance_id or owner not in self.live_instances:
+                return False
+
+        forward_topic = FORWARD_TOPIC.format(instance=owner) + topic
+        if self.mqtt_service.publish(forward_topic, payload):
+            self.forwarded += 1
+            logger.info(f"↪ 回复已转发到实例 {owner} (unit={unit})")
+            return True
+        return False
+
+    def device_topic(self, topic):
+        """
+        流量抓取使用的设备主题
+
+        Returns:
+            str: 转发来的消息返回原始主题，实例在线标记/归属/编码同步返回 None，其他主题原样返回
+        """
+        if topic.startswith(self.forward_prefix + '/'):
+            return topic[len(self.forward_prefix):]
+        if topic.startswith(COORDINATION_PREFIXES):
+            return None
+        return topic
+
+    def shared_filter(self, topic_filter):
+        """将订阅过滤器转换为共享订阅"""
+        return f"$share/{self.group}/{topic_filter}"
+
+    def get_stats(self):
+        """集群统计"""
+        with self.lock:
+            return {
+                "instance": self.instance_id,
+                "group": self.group,
+                "live_instances": sorted(self.live_instances),
+                "claimed_units": len(self.claimed),
+                "known_owners": len(self.owners),
+                "forwarded": self.forwarded,
+                "received_forwarded": self.received_forwarded,
+                "encodings_published": self.encodings_published,
+                "encodings_received": self.encodings_received,
+            }
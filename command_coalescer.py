@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设置命令合并
+配置工具常在几秒内向同一设备连续发送多条 CFG/CTS/CDN/UDS，逐条转发会让设备依次应用每个中间状态。
+开启 COMMAND_COALESCE_WINDOW 后，同一 (unit, camera, type) 的第一条命令等待一个窗口再发布，
+窗口内后到的命令按字段合并到尚未发布的命令中:
+    CFG   configs 按 name 合并，其余字段后到覆盖
+    CDN   coordinates 按 ROI 名合并
+    UDS   settings 按键合并
+    CTS   顶层字段后到覆盖
+
+窗口从第一条命令开始计时，持续发送也不会无限推迟发布。同一 unit 的其他命令到达时先发布该 unit 合并中的命令，
+设备收到的命令顺序不变（MQTT 3.1.1 模式下回复按发送顺序匹配）。
+UDS 需要回复：被合并的请求挂到保留请求上，设备的一条回复同时发送给所有被合并的请求。
+传统连接的回复按 unit 映射到最后一个发送命令的连接，无法分发给多个请求，因此传统连接的 UDS 不合并。
+无回复命令进入合并窗口即确认（ACK），之后发布失败只记录日志
+"""
+
+import time
+import heapq
+import itertools
+import threading
+import logging
+from config import *
+from socket_service import REPLY_COMMAND_TYPES
+
+logger = logging.getLogger(__name__)
+
+# 按 name 合并的列表字段
+MERGE_BY_NAME_FIELDS = ('configs',)
+# 按键合并的字典字段
+MERGE_DICT_FIELDS = ('coordinates', 'settings')
+
+
+def _merge_by_name(current, newer):
+    """合并 [{"name": ..., "value": ...}, ...]，同名项后到覆盖并保留原位置"""
+    merged = {}
+    unnamed = []
+    for item in current + newer:
+        if isinstance(item, dict) and 'name' in item:
+            merged[item['name']] = item
+        else:
+            unnamed.append(item)
+    return list(merged.values()) + unnamed
+
+
+def merge_command(queued, newer):
+    """
+    把后到的命令按字段合并到尚未发布的命令中
+
+    Args:
+        queued: 尚未发布的命令 (dict)，原地修改
+        newer: 后到的同类命令 (dict)
+    """
+    for field, value in newer.items():
+        current = queued.get(field)
+        if field in MERGE_BY_NAME_FIELDS and isinstance(current, list) and isinstance(value, list):
+            queued[field] = _merge_by_name(current, value)
+        elif field in MERGE_DICT_FIELDS and isinstance(current, dict) and isinstance(value, dict):
+            queued[field] = {**current, **value}
+        else:
+            queued[field] = value
+
+
+class _Pending:
+    """合并窗口中尚未发布的命令"""
+
+    __slots__ = ('key', 'unit', 'command', 'correlation', 'deadline', 'seq', 'merged')
+
+    def __init__(self, key, command, correlation, deadline, seq):
+        self.key = key
+        self.unit = key[0]
+        self.command = command
+        self.correlation = correlation  # 需要回复的命令（UDS）发布时使用的 Correlation Data
+        self.deadline = deadline
+        self.seq = seq                  # 到达顺序，同一 unit 的命令按它发布
+        self.merged = 0
+
+
+class CommandCoalescer:
+    """命令合并类 - 位于 SocketService 和 MQTTPublisher 之间，接口与 MQTTPublisher 相同"""
+
+    def __init__(self, publisher, window=COMMAND_COALESCE_WINDOW, command_types=COALESCE_COMMAND_TYPES):
+        """
+        初始化命令合并
+
+        Args:
+            publisher: MQTTPublisher 实例
+            window: 合并窗口（秒），0 表示直接转发
+            command_types: 参与合并的命令类型
+        """
+        self.publisher = publisher
+        self.window = window
+        self.command_types = frozenset(command_types)
+        self.socket_service = None
+
+        self.cond = threading.Condition()
+        self.pending = {}      # (unit, camera, type) → _Pending
+        self.by_unit = {}      # unit → set(key)
+        self.deadlines = []    # 堆 (deadline, seq, _Pending)
+        self.flushing = {}     # unit → 正在发布该 unit 命令的线程数
+        self.seq = itertools.count()
+        self.running = False
+        self.thread = None
+
+        # 统计
+        self.received = 0      # 进入合并窗口的命令
+        self.published = 0     # 合并后实际发布的命令
+        self.saved = {}        # 命令类型 → 省去的发布次数
+        self.failed = 0
+
+    def set_socket_service(self, socket_service):
+        """设置 SocketService，用于合并 UDS 等待中的请求和发布失败时通知 Backend"""
+        self.socket_service = socket_service
+
+    def start(self):
+        """启动窗口到期发布线程"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="command-coalescer", daemon=True)
+        self.thread.start()
+        logger.info(f"✓ 命令合并已启用 (窗口 {self.window}s，类型 {sorted(self.command_types)})")
+
+    def stop(self):
+        """停止并立即发布所有合并中的命令"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+        with self.cond:
+            entries = [self._take_locked(key) for key in list(self.pending)]
+        self._publish(entries)
+
+    # ---------------- 转发 ----------------
+
+    def forward_socket_command(self, json_data, correlation=None):
+        """
+        转发 Backend 的 Socket 命令（参数和返回值与 MQTTPublisher.forward_socket_command 相同）
+        参与合并的命令放入合并窗口后返回True
+        """
+        unit = json_data.get('unit')
+        if not self.window or not unit:
+            return self.publisher.forward_socket_command(json_data, correlation)
+
+        command_type = json_data.get('type')
+        # 需要回复的命令只合并多路复用连接的请求（带 Correlation Data）
+        coalesce = command_type in self.command_types and \
+            (correlation is not None or command_type not in REPLY_COMMAND_TYPES)
+        with self.cond:
+            while unit in self.flushing:
+                self.cond.wait()
+
+            if coalesce:
+                key = (unit, json_data.get('camera'), command_type)
+                entry = self.pending.get(key)
+                if entry is not None:
+                    self._merge_locked(entry, json_data, correlation)
+                    return True
+                flush = [self._take_locked(key)] if entry is not None else []
+                self._add_locked(key, json_data, correlation)
+                self.received += 1
+            else:
+                # 其他命令先发布该 unit 合并中的命令，保持顺序
+                flush = [self._take_locked(key) for key in list(self.by_unit.get(unit, ()))]
+
+        if flush:
+            self._publish(flush)
+        if coalesce:
+            return True
+        return self.publisher.forward_socket_command(json_data, correlation)
+
+    def _add_locked(self, key, json_data, correlation):
+        entry = _Pending(key, dict(json_data), correlation, time.monotonic() + self.window, next(self.seq))
+        self.pending[key] = entry
+        self.by_unit.setdefault(entry.unit, set()).add(key)
+        heapq.heappush(self.deadlines, (entry.deadline, entry.seq, entry))
+        if self.deadlines[0][2] is entry:
+            self.cond.notify_all()
+
+    def _merge_locked(self, entry, json_data, correlation):
+        merge_command(entry.command, json_data)
+        entry.merged += 1
+        command_type = entry.key[2]
+        self.saved[command_type] = self.saved.get(command_type, 0) + 1
+        self.received += 1
+        if correlation is not None and self.socket_service:
+            if not self.socket_service.merge_pending(correlation, entry.correlation):
+                # 保留的请求已超时或连接已断开，改用新请求等待回复
+                entry.correlation = correlation
+
+    def _take_locked(self, key):
+        """取出合并中的命令并标记其 unit 正在发布（同一 unit 的其他命令等待发布完成）"""
+        entry = self.pending.pop(key)
+        keys = self.by_unit[entry.unit]
+        keys.discard(key)
+        if not keys:
+            del self.by_unit[entry.unit]
+        self.flushing[entry.unit] = self.flushing.get(entry.unit, 0) + 1
+        return entry
+
+    # ---------------- 发布 ----------------
+
+    def _run(self):
+        while True:
+            with self.cond:
+                due = self._take_due_locked()
+                while self.running and not due:
+                    timeout = self.deadlines[0][0] - time.monotonic() if self.deadlines else None
+                    if timeout is None or timeout > 0:
+                        self.cond.wait(timeout)
+                    due = self._take_due_locked()
+                if not due:
+                    return
+            self._publish(due)
+
+    def _take_due_locked(self):
+        """取出所有窗口已到期的命令"""
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= time.monotonic():
+            entry = heapq.heappop(self.deadlines)[2]
+            # 已被提前发布的命令在堆中留有旧记录，跳过
+            if self.pending.get(entry.key) is entry:
+                due.append(self._take_locked(entry.key))
+        return due
+
+    def _publish(self, entries):
+        """按到达顺序发布命令（调用方已通过 _take_locked 标记 unit）"""
+        try:
+            for entry in sorted(entries, key=lambda e: e.seq):
+                command_type = entry.key[2]
+                if entry.merged:
+                    logger.info(f"✓ 已合并 {entry.merged + 1} 条 {command_type} 命令 (unit={entry.unit})")
+                success = self.publisher.forward_socket_command(entry.command, entry.correlation)
+                with self.cond:
+                    self.published += 1
+                    if not success:
+                        self.failed += 1
+                if not success:
+                    logger.error(f"✗ 合并后的 {command_type} 命令发布失败 (unit={entry.unit})")
+                    if entry.correlation is not None and self.socket_service:
+                        self.socket_service.fail_pending(entry.correlation, "forward failed")
+        finally:
+            with self.cond:
+                for entry in entries:
+                    count = self.flushing[entry.unit] - 1
+                    if count:
+                        self.flushing[entry.unit] = count
+                    else:
+                        del self.flushing[entry.unit]
+                self.cond.notify_all()
+
+    def get_stats(self):
+        """合并统计"""
+        with self.cond:
+            return {
+                "window": self.window,
+                "pending": len(self.pending),
+                "received": self.received,
+                "published": self.published,
+                "saved": sum(self.saved.values()),
+                "saved_by_type": dict(self.saved),
+                "failed": self.failed,
+            }
@@ -19,11 +19,133 @@ MQTT_KEEPALIVE = 60
 # MQTT 客户端ID前缀
 MQTT_CLIENT_ID_PREFIX = "ms500_server"
 
-# MQTT 订阅主题列表
+# MQTT 协议版本: "3.1.1" 或 "5"
+# MQTT 5 模式下启用主题别名、按命令类型的消息过期时间，以及 SCS/UDS 的响应主题/Correlation Data
+MQTT_PROTOCOL = "3.1.1"
+
+# MQTT 5 主题别名上限（实际取与 Broker 协商值中的较小者，0 表示不使用）
+MQTT_TOPIC_ALIAS_MAXIMUM = 64
+
+# MQTT 5 各命令类型的消息过期时间（秒），设备离线超过该时间后命令不再投递
+MQTT_MESSAGE_EXPIRY = {
+    "IMG": 10,          # 图片请求只在短时间内有意义
+    "SCS": 30,
+    "UDS": 60,
+    "RSR": 30,
+    "CDN": 600,
+    "CFG": 600,
+    "CTS": 600,
+    "WFI": 600,
+    "FRS": 3600,
+    "AIM": 6 * 3600,    # 模型/固件/应用更新可以等设备重新上线
+    "FMW": 6 * 3600,
+    "APP": 6 * 3600,
+}
+
+# 未在上表中的命令类型的消息过期时间（秒），0 表示不过期
+MQTT_MESSAGE_EXPIRY_DEFAULT = 3600
+
+# MQTT 5 响应主题（每个中转服务客户端独立，集群模式下回复直接到达发出请求的实例）
+MQTT_RESPONSE_TOPIC = "/bridge/ms500/{client_id}/response"
+
+# MQTT 订阅主题列表（与回复主题一起加入路由表，消息交给通用消息回调）
 SUBSCRIBE_TOPICS = [
     "/device/ms500/+/online",   # 订阅所有设备的在线心跳消息
 ]
 
+# 设备 Socket 回复主题（{unit} 为单层通配，匹配值作为 unit 传给处理函数）
+SOCKET_REPLY_TOPIC = "/device/ms500/{unit}/socket_reply"
+
+# 设备分片回复主题（大回复如 IMG 图片按序号分片发送）
+REPLY_CHUNK_TOPIC = "/device/ms500/{unit}/socket_reply_part"
+
+# 分片回复重组超时时间（秒），超时未收齐的回复将被丢弃
+REPLY_CHUNK_TIMEOUT = 30
+
+# 单个回复允许缓存的乱序分片字节数上限
+REPLY_CHUNK_MAX_BUFFERED = 4 * 1024 * 1024  # 4MB
+
+# ==================== 负载编码配置 ====================
+
+# 发往设备的命令默认编码: "json" / "msgpack" / "cbor"（后两者需安装 msgpack / cbor2）
+# Backend 始终使用 JSON，中转服务在 MQTT 边界转码
+DEFAULT_PAYLOAD_ENCODING = "json"
+
+# 按 unit 指定编码，优先于设备心跳中声明的 "encoding" 字段
+# 例如 {"MS500-H090-EP-2549-0038": "cbor"}
+UNIT_PAYLOAD_ENCODING = {}
+
+
+# ==================== 心跳处理配置 ====================
+
+# 设备在线心跳主题（由心跳流水线批量处理，"encoding" 字段声明设备支持的编码）
+DEVICE_ONLINE_TOPIC = "/device/ms500/{unit}/online"
+
+# 心跳队列上限（MQTT 网络线程只入队，满时丢弃最旧的心跳）
+HEARTBEAT_QUEUE_SIZE = 100000
+
+# 积压达到该数量时立即处理一批
+HEARTBEAT_BATCH_SIZE = 500
+
+# 最长攒批时间（秒）
+HEARTBEAT_BATCH_INTERVAL = 0.2
+
+# 心跳归档目录（None 表示关闭），列式存储，可用 heartbeat_archive.py 或 HIS 命令查询
+HEARTBEAT_ARCHIVE_DIR = None
+
+# 每个归档段覆盖的时间（秒），到期后封存并写入 unit 索引
+HEARTBEAT_ARCHIVE_SEGMENT_SECONDS = 3600
+
+# 归档总大小上限，超过后删除最旧的段
+HEARTBEAT_ARCHIVE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB
+
+# ==================== 异常检测配置 ====================
+
+# 阈值告警: 指标 → (下限, 上限)，None 表示不检查
+ANOMALY_THRESHOLDS = {
+    "cpu_temp": (None, 85),
+    "sense_temp": (None, 75),
+    "video_fps": (5, None),
+    "spi_fps": (5, None),
+}
+
+# 漂移告警方向: 1 表示异常升高（温度），-1 表示异常下降（帧率）
+ANOMALY_DRIFT = {
+    "cpu_temp": 1,
+    "sense_temp": 1,
+    "video_fps": -1,
+    "spi_fps": -1,
+}
+
+# EWMA 平滑系数（越大越快跟随最新值）
+ANOMALY_EWMA_ALPHA = 0.1
+
+# 漂移告警的 z 分数阈值
+ANOMALY_DRIFT_Z = 4.0
+
+# 至少收到多少次心跳后才做漂移检测
+ANOMALY_WARMUP = 10
+
+# 标准差下限，避免数值长期不变时微小波动触发漂移告警
+ANOMALY_MIN_STD = 1.0
+
+# 超过该时间（秒）没有心跳视为设备静默
+ANOMALY_SILENT_TIMEOUT = 180
+
+# 静默检测时间轮刻度（秒）
+ANOMALY_WHEEL_TICK = 1.0
+
+# ==================== 集群配置 ====================
+
+# 集群模式：多个实例通过共享订阅 $share/<group>/... 分摊设备消息，回复转发给等待该 unit 的实例
+CLUSTER_ENABLED = False
+
+# 共享订阅组名（同一集群的实例必须相同）
+CLUSTER_GROUP = "ms500_bridge"
+
+# 实例ID（None 表示使用 主机名-进程号）
+CLUSTER_INSTANCE_ID = None
+
 # ==================== Socket 配置 ====================
 
 # Socket 服务器地址（接收 Backend 服务器的连接）
@@ -35,6 +157,67 @@ SOCKET_PORT = 6080
 # Socket 缓冲区大小
 SOCKET_BUFFER_SIZE = 65536  # 64KB，用于接收大的 JSON 数据
 
+# 监听队列长度（突发连接时等待 accept 的连接数）
+SOCKET_BACKLOG = 128
+
+# 最大同时连接数，超过后新连接立即被关闭
+SOCKET_MAX_CONNECTIONS = 256
+
+# 空闲超时时间（秒），连接在该时间内没有任何收发则关闭并清除映射
+SOCKET_IDLE_TIMEOUT = 300
+
+# 关闭 Nagle 算法，减少小包回复延迟
+SOCKET_TCP_NODELAY = True
+
+# TCP keepalive，及时发现已断开的 Backend 连接
+SOCKET_TCP_KEEPALIVE = True
+SOCKET_KEEPALIVE_IDLE = 60      # 空闲多久后开始探测（秒）
+SOCKET_KEEPALIVE_INTERVAL = 10  # 探测间隔（秒）
+SOCKET_KEEPALIVE_COUNT = 3      # 探测失败次数
+
+# 多路复用连接上 SCS/UDS 请求等待设备回复的超时时间（秒）
+MUX_REQUEST_TIMEOUT = 60
+
+# ==================== 命令合并配置 ====================
+
+# 设置类命令的合并窗口（秒，0 表示关闭）：同一设备、同一摄像头、同一类型的命令在窗口内只发布一次，
+# 后到的命令按字段合并到尚未发布的命令中
+COMMAND_COALESCE_WINDOW = 0
+
+# 参与合并的命令类型
+COALESCE_COMMAND_TYPES = ('CFG', 'CTS', 'CDN', 'UDS')
+
+# ==================== 流量抓取配置 ====================
+
+# 流量抓取文件路径（None 表示关闭），记录 Backend 命令、MQTT 发布和设备消息，可用 replay_tool.py 回放
+CAPTURE_FILE = None
+
+# 抓取文件写缓冲大小
+CAPTURE_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# ==================== 状态快照配置 ====================
+
+# 状态快照文件（None 表示关闭），保存设备注册表、负载编码、异常检测基线和在线设备，启动时加载
+SNAPSHOT_FILE = None
+
+# 定期快照间隔（秒），停止服务时还会写入一次
+SNAPSHOT_INTERVAL = 60
+
+# ==================== 运行时诊断配置 ====================
+
+# 采样分析输出目录
+INTROSPECTION_DIR = "diagnostics"
+
+# 采样间隔（秒）
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# 默认采样时长 / 最长采样时长（秒）
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+
+# tracemalloc 每次分配记录的调用栈层数（按代码行排行只需 1 层）
+TRACEMALLOC_FRAMES = 1
+
 # ==================== 日志配置 ====================
 
 # 日志级别
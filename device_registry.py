@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备注册表
+由心跳流水线批量更新，保存每个 unit 最近一次心跳的状态
+"""
+
+import threading
+import logging
+from snapshot import column_kind
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceState:
+    """单个设备的最新状态"""
+
+    __slots__ = ('unit', 'first_seen', 'last_seen', 'heartbeats', 'data')
+
+    def __init__(self, unit, seen_at):
+        self.unit = unit
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+        self.heartbeats = 0
+        self.data = {}
+
+    def to_dict(self):
+        return {
+            "unit": self.unit,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "heartbeats": self.heartbeats,
+            "data": self.data,
+        }
+
+
+class DeviceRegistry:
+    """设备注册表类 - unit → DeviceState"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def update_batch(self, batch):
+        """
+        心跳流水线消费者，一个批次只加一次锁
+
+        Args:
+            batch: [(unit, received_at, data), ...]
+        """
+        new_units = []
+        with self.lock:
+            for unit, received_at, data in batch:
+                state = self.devices.get(unit)
+                if state is None:
+                    state = self.devices[unit] = DeviceState(unit, received_at)
+                    new_units.append(unit)
+                state.last_seen = received_at
+                state.heartbeats += 1
+                state.data = data
+
+        for unit in new_units:
+            logger.info(f"📱 发现设备: {unit}")
+
+    def get(self, unit):
+        """返回 unit 的最新状态 (dict)，未知设备返回 None"""
+        with self.lock:
+            state = self.devices.get(unit)
+            return state.to_dict() if state else None
+
+    def units(self):
+        """返回所有已知 unit"""
+        with self.lock:
+            return list(self.devices)
+
+    def dump_snapshot(self, writer):
+        """
+        导出快照段（锁内只复制引用，字段在锁外读取；同一设备的字段可能来自相邻两次心跳，不影响恢复）
+        心跳数据按字段集合分组，每组的每个字段写成一列（见 SnapshotWriter.column）
+        """
+        with self.lock:
+            states = list(self.devices.values())
+        writer.strings([state.unit for state in states])
+        writer.array('d', [state.first_seen for state in states])
+        writer.array('d', [state.last_seen for state in states])
+        writer.array('Q', [state.heartbeats for state in states])
+
+        # 同一固件的心跳字段相同，分组数很少
+        groups = {}
+        datas = [state.data for state in states]
+        for i, data in enumerate(datas):
+            groups.setdefault(tuple(data), []).append(i)
+
+        schemas = []
+        for keys, indexes in groups.items():
+            columns = [[datas[i][key] for i in indexes] for key in keys]
+            schemas.append((keys, indexes, columns, [column_kind(values) for values in columns]))
+        writer.json([[list(keys), kinds, len(indexes)] for keys, indexes, _, kinds in schemas])
+        for _, indexes, columns, kinds in schemas:
+            writer.array('I', indexes)
+            for kind, values in zip(kinds, columns):
+                writer.column(kind, values)
+
+    def load_snapshot(self, reader):
+        """导入快照段，已收到心跳的设备以实时状态为准"""
+        units = reader.strings()
+        first_seen = reader.array().tolist()
+        last_seen = reader.array().tolist()
+        heartbeats = reader.array().tolist()
+
+        data = [None] * len(units)
+        for keys, kinds, count in reader.json():
+            indexes = reader.array().tolist()
+            columns = [reader.column(kind, count) for kind in kinds]
+            rows = zip(*columns) if columns else [()] * count
+            for i, row in zip(indexes, rows):
+                data[i] = dict(zip(keys, row))
+
+        with self.lock:
+            for i, unit in enumerate(units):
+                if unit in self.devices:
+                    continue
+                state = self.devices[unit] = DeviceState(unit, first_seen[i])
+                state.last_seen = last_seen[i]
+                state.heartbeats = heartbeats[i]
+                state.data = data[i]
+        logger.info(f"✓ 设备注册表已从快照恢复: {len(units)} 台设备")
+
+    def __len__(self):
+        return len(self.devices)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备事件订阅
+Backend 通过多路复用连接订阅设备事件，中转服务以 EVENT 帧推送，无需自己连接 MQTT
+
+事件类型:
+    heartbeat   设备心跳（遥测数据）
+    online      设备上线（首次心跳或静默后恢复心跳）
+    offline     设备静默（超过 ANOMALY_SILENT_TIMEOUT 没有心跳）
+    alert       设备告警（见 anomaly_detector）
+
+集群模式下心跳由各实例分摊，单个实例无法判断设备是否在线，不提供 online / offline 事件（presence=False）
+
+同一订阅、同一设备的 online / offline 共用一个合并键，积压时只推送最新的在线状态
+
+订阅命令:
+    {"type": "SUB", "units": ["MS500-..."], "prefixes": ["MS500-H090"], "events": ["online", "offline"]}
+        units / prefixes 都不填表示所有设备，events 不填表示所有事件类型；回复中返回 sub_id
+    {"type": "UNS", "sub_id": 3}      取消订阅，不带 sub_id 取消该连接的全部订阅
+
+过滤器按事件类型分别建索引：精确 unit 为字典查找，前缀按长度分组后各查一次字典，
+每个事件的匹配开销与订阅数量无关。每个连接一个发送队列，同一订阅、同一设备、同一类事件只保留最新的一条，
+慢速订阅者收到的是合并后的最新状态，而不是无限增长的积压
+"""
+
+import json
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+EVENT_HEARTBEAT = "heartbeat"
+EVENT_ONLINE = "online"
+EVENT_OFFLINE = "offline"
+EVENT_ALERT = "alert"
+EVENT_TYPES = (EVENT_HEARTBEAT, EVENT_ONLINE, EVENT_OFFLINE, EVENT_ALERT)
+
+# online / offline 事件的合并键
+PRESENCE_KEY = "presence"
+
+
+def _string_list(json_data, field):
+    """读取 SUB 命令中的字符串列表字段，缺失或 null 返回空元组，类型不符抛出 ValueError"""
+    value = json_data.get(field)
+    if value is None:
+        return ()
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{field} 必须是字符串列表")
+    return value
+
+
+class Subscription:
+    """一个订阅"""
+
+    __slots__ = ('sub_id', 'outbox', 'units', 'prefixes', 'events')
+
+    def __init__(self, sub_id, outbox, units, prefixes, events):
+        self.sub_id = sub_id
+        self.outbox = outbox
+        self.units = units
+        self.prefixes = prefixes
+        self.events = events
+
+    def to_dict(self):
+        return {"sub_id": self.sub_id, "units": sorted(self.units), "prefixes": sorted(self.prefixes),
+                "events": sorted(self.events)}
+
+
+class _FilterIndex:
+    """单个事件类型的过滤器索引"""
+
+    def __init__(self):
+        self.by_unit = {}        # unit → set(Subscription)
+        self.by_prefix = {}      # 前缀长度 → {前缀: set(Subscription)}
+        self.wildcard = set()    # 匹配所有设备的订阅
+
+    def add(self, sub):
+        if not sub.units and not sub.prefixes:
+            self.wildcard.add(sub)
+        for unit in sub.units:
+            self.by_unit.setdefault(unit, set()).add(sub)
+        for prefix in sub.prefixes:
+            self.by_prefix.setdefault(len(prefix), {}).setdefault(prefix, set()).add(sub)
+
+    def remove(self, sub):
+        self.wildcard.discard(sub)
+        for unit in sub.units:
+            subs = self.by_unit.get(unit)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.by_unit[unit]
+        for prefix in sub.prefixes:
+            group = self.by_prefix.get(len(prefix))
+            if group is None:
+                continue
+            subs = group.get(prefix)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del group[prefix]
+            if not group:
+                del self.by_prefix[len(prefix)]
+
+    def match(self, unit):
+        """返回匹配 unit 的订阅（同一订阅只出现一次）"""
+        matched = set(self.wildcard)
+        subs = self.by_unit.get(unit)
+        if subs:
+            matched |= subs
+        for length, group in self.by_prefix.items():
+            subs = group.get(unit[:length])
+            if subs:
+                matched |= subs
+        return matched
+
+    def is_empty(self):
+        return not (self.by_unit or self.by_prefix or self.wildcard)
+
+
+class _Outbox:
+    """连接的发送队列 - 按键合并，后到的事件覆盖未发送的旧事件"""
+
+    def __init__(self, conn, on_failed):
+        self.conn = conn
+        self.on_failed = on_failed
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # 合并键 → body
+        self.closed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.thread = threading.Thread(target=self._run, name=f"event-outbox-{conn}", daemon=True)
+        self.thread.start()
+
+    def put(self, key, body):
+        with self.cond:
+            if key in self.pending:
+                # 覆盖的事件移到队尾，与其他键的先后顺序以最新一条为准
+                self.coalesced += 1
+                self.pending.move_to_end(key)
+            self.pending[key] = body
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                bodies = list(self.pending.values())
+                self.pending.clear()
+            try:
+                for body in bodies:
+                    self.conn.send_event(body)
+                    self.sent += 1
+            except OSError as e:
+                logger.warning(f"⚠️ 推送事件失败，取消订阅 ({self.conn}): {e}")
+                self.on_failed(self.conn)
+                return
+
+
+class EventHub:
+    """事件订阅中心 - 心跳流水线消费者，匹配订阅并推送"""
+
+    def __init__(self, presence=True):
+        """
+        Args:
+            presence: 是否提供 online / offline 事件（集群模式下为 False）
+        """
+        self.presence = presence
+        self.event_types = EVENT_TYPES if presence else (EVENT_HEARTBEAT, EVENT_ALERT)
+        self.lock = threading.Lock()
+        self.indexes = {event: _FilterIndex() for event in EVENT_TYPES}
+        self.subscriptions = {}   # sub_id → Subscription
+        self.outboxes = {}        # BackendConnection → _Outbox
+        self.sub_ids = itertools.count(1)
+        self.online = set()       # 当前在线的 unit
+        self.published = 0
+
+    # ---------------- 订阅管理 ----------------
+
+    def subscribe(self, conn, units=(), prefixes=(), events=()):
+        """
+        添加订阅
+
+        Returns:
+            Subscription: 新订阅
+        """
+        events = set(events or self.event_types)
+        unknown = events - set(EVENT_TYPES)
+        if unknown:
+            raise ValueError(f"未知的事件类型: {sorted(unknown)}")
+        unavailable = events - set(self.event_types)
+        if unavailable:
+            raise ValueError(f"集群模式下不提供事件: {sorted(unavailable)}")
+
+        with self.lock:
+            outbox = self.outboxes.get(conn)
+            if outbox is None:
+                outbox = self.outboxes[conn] = _Outbox(conn, self.unsubscribe_connection)
+            sub = Subscription(next(self.sub_ids), outbox, set(units), set(prefixes), events)
+            self.subscriptions[sub.sub_id] = sub
+            for event in events:
+                self.indexes[event].add(sub)
+        logger.info(f"✓ Backend {conn} 已订阅设备事件: {sub.to_dict()}")
+        return sub
+
+    def unsubscribe(self, conn, sub_id):
+        """取消订阅，返回是否存在"""
+        with self.lock:
+            sub = self.subscriptions.get(sub_id)
+            if sub is None or sub.outbox.conn is not conn:
+                return False
+            self._remove(sub)
+            if not any(s.outbox is sub.outbox for s in self.subscriptions.values()):
+                self.outboxes.pop(conn, None)
+                sub.outbox.close()
+        return True
+
+    def unsubscribe_connection(self, conn):
+        """取消连接的全部订阅（也作为连接断开回调）"""
+        with self.lock:
+            outbox = self.outboxes.pop(conn, None)
+            if outbox is None:
+                return
+            for sub in [s for s in self.subscriptions.values() if s.outbox is outbox]:
+                self._remove(sub)
+        outbox.close()
+
+    def _remove(self, sub):
+        """调用方持有 lock"""
+        del self.subscriptions[sub.sub_id]
+        for event in sub.events:
+            self.indexes[event].remove(sub)
+
+    # ---------------- 事件发布 ----------------
+
+    def update_batch(self, batch):
+        """
+        心跳流水线消费者：发布 heartbeat 事件，未在线的设备同时发布 online 事件
+
+        Args:
+            batch: [(unit, received_at, data), ...]
+        """
+        with self.lock:
+            heartbeat_index = self.indexes[EVENT_HEARTBEAT]
+            online_index = self.indexes[EVENT_ONLINE]
+            for unit, received_at, data in batch:
+                if self.presence and unit not in self.online:
+                    self.online.add(unit)
+                    if not online_index.is_empty():
+                        self._publish_locked(online_index, PRESENCE_KEY, unit,
+                                             {"event": EVENT_ONLINE, "unit": unit, "ts": received_at})
+                if not heartbeat_index.is_empty():
+                    self._publish_locked(heartbeat_index, EVENT_HEARTBEAT, unit,
+                                         {"event": EVENT_HEARTBEAT, "unit": unit, "ts": received_at, "data": data})
+
+    def publish_alert(self, alert):
+        """
+        异常检测监听函数：发布 alert 事件，静默告警同时发布 offline 事件
+
+        Args:
+            alert: anomaly_detector 的告警事件
+        """
+        unit = alert["unit"]
+        with self.lock:
+            if alert["kind"] == "silent" and alert["state"] == "raised":
+                self.online.discard(unit)
+                self._publish_locked(self.indexes[EVENT_OFFLINE], PRESENCE_KEY, unit,
+                                     {"event": EVENT_OFFLINE, "unit": unit, "ts": alert["ts"]})
+            # 同一告警的产生和恢复合并为最新状态
+            self._publish_locked(self.indexes[EVENT_ALERT], (EVENT_ALERT, alert["kind"], alert["metric"]),
+                                 unit, alert)
+
+    def _publish_locked(self, index, key, unit, event):
+        """
+        匹配订阅并放入各连接的发送队列（调用方持有 lock）
+        事件只序列化一次，各订阅只在末尾拼接 sub_id，开销不随订阅数量成倍增加
+        """
+        matched = index.match(unit)
+        if not matched:
+            return
+        prefix = json.dumps(event, ensure_ascii=False).encode('utf-8')[:-1] + b', "sub_id": '
+        for sub in matched:
+            sub.outbox.put((sub.sub_id, key, unit), b'%s%d}' % (prefix, sub.sub_id))
+        self.published += len(matched)
+
+    # ---------------- 快照 ----------------
+
+    def dump_snapshot(self, writer):
+        """导出快照段：在线设备"""
+        with self.lock:
+            online = list(self.online)
+        writer.strings(online)
+
+    def load_snapshot(self, reader):
+        """导入快照段，恢复的设备若不再发送心跳，由静默告警转为离线"""
+        online = reader.strings()
+        with self.lock:
+            self.online.update(online)
+
+    # ---------------- 本地命令 ----------------
+
+    def cmd_subscribe(self, conn, json_data):
+        """SUB 本地命令（多路复用连接）"""
+        if not conn.mux:
+            return {"type": "SUB", "ok": False, "error": "事件推送需要多路复用连接"}
+        try:
+            sub = self.subscribe(conn, _string_list(json_data, 'units'), _string_list(json_data, 'prefixes'),
+                                 _string_list(json_data, 'events'))
+        except ValueError as e:
+            return {"type": "SUB", "ok": False, "error": str(e)}
+        return {"type": "SUB", "ok": True, **sub.to_dict()}
+
+    def cmd_unsubscribe(self, conn, json_data):
+        """UNS 本地命令"""
+        sub_id = json_data.get('sub_id')
+        if sub_id is None:
+            self.unsubscribe_connection(conn)
+            return {"type": "UNS", "ok": True}
+        return {"type": "UNS", "ok": self.unsubscribe(conn, sub_id), "sub_id": sub_id}
+
+    def get_stats(self):
+        """订阅统计"""
+        with self.lock:
+            outboxes = list(self.outboxes.values())
+            return {
+                "subscriptions": len(self.subscriptions),
+                "connections": len(outboxes),
+                "online_units": len(self.online),
+                "published": self.published,
+                "sent": sum(o.sent for o in outboxes),
+                "coalesced": sum(o.coalesced for o in outboxes),
+                "queued": sum(len(o.pending) for o in outboxes),
+            }
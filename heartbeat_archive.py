@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备心跳归档
+只追加的列式存储，按时间分段，每段每个字段一个定长列文件，读取时 mmap 映射，
+时间范围查询在时间列上二分，按 unit 查询走段内索引，都不需要扫描整个文件
+
+目录结构:
+    <archive_dir>/units.dict                 unit 字典（每行一个，行号即 unit_id）
+    <archive_dir>/<首行毫秒时间戳>/<字段>.col  定长列文件（小端序）
+    <archive_dir>/<首行毫秒时间戳>/index.bin   段封存时写入的 unit 索引，未封存的段索引在内存中
+
+用法:
+    python heartbeat_archive.py <archive_dir> --unit MS500-H090-EP-2549-0038 --start "2026-10-18 20:00" --end "2026-10-19 08:00"
+"""
+
+import os
+import json
+import mmap
+import math
+import shutil
+import socket
+import struct
+import argparse
+import threading
+import logging
+from array import array
+from datetime import datetime
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# 列定义: (字段, array 类型码)，ts 为中转服务收到心跳的时间
+COLUMNS = (
+    ('ts', 'd'),
+    ('unit', 'I'),
+    ('cpu_temp', 'f'),
+    ('sense_temp', 'f'),
+    ('video_fps', 'f'),
+    ('spi_fps', 'f'),
+    ('lte_signal', 'f'),
+    ('network', 'B'),
+    ('links', 'B'),  # bit0 以太网, bit1 WiFi, bit2 LTE
+    ('ip', 'I'),
+)
+FLOAT_FIELDS = ('cpu_temp', 'sense_temp', 'video_fps', 'spi_fps', 'lte_signal')
+FIELDS = tuple(name for name, _ in COLUMNS if name not in ('ts', 'unit'))
+
+NETWORK_CODES = {'eth': 1, 'wifi': 2, 'lte': 3}
+NETWORK_NAMES = {code: name for name, code in NETWORK_CODES.items()}
+
+LINK_ETH = 0x01
+LINK_WIFI = 0x02
+LINK_LTE = 0x04
+
+UNITS_FILE = "units.dict"
+INDEX_FILE = "index.bin"
+INDEX_HEADER = struct.Struct('<I')      # unit 数量
+INDEX_ENTRY = struct.Struct('<III')     # unit_id, 行号起始位置, 行数
+
+NAN = float('nan')
+
+
+def _to_float(value):
+    """心跳中的数值字段转为 float，缺失或无法解析时为 NaN（lte_signal 可能带单位，如 "-85 dBm"）"""
+    if value is None or isinstance(value, bool):
+        return NAN
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        try:
+            return float(str(value).split()[0])
+        except (ValueError, IndexError):
+            return NAN
+
+
+def _ip_to_int(ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (OSError, TypeError):
+        return 0
+
+
+def _int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value)) if value else None
+
+
+def _lower_bound(lo, hi, value, get):
+    """在 [lo, hi) 中找到第一个 get(i) >= value 的位置（get 单调不减）"""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if get(mid) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _SegmentReader:
+    """段的只读视图：列文件 mmap 映射为定长数组"""
+
+    def __init__(self, path, rows):
+        self.rows = rows
+        self.maps = []
+        self.columns = {}
+        for name, typecode in COLUMNS:
+            size = rows * array(typecode).itemsize
+            if not size:
+                self.columns[name] = memoryview(b'').cast(typecode)
+                continue
+            with open(os.path.join(path, f"{name}.col"), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.maps.append(mm)
+            self.columns[name] = memoryview(mm).cast(typecode)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        for mm in self.maps:
+            mm.close()
+        self.columns = {}
+        self.maps = []
+
+
+class _Segment:
+    """一个时间段：列文件 + unit 索引"""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = int(os.path.basename(path)) / 1000.0
+        self.sealed = os.path.exists(os.path.join(path, INDEX_FILE))
+        self.rows = 0
+        self.files = None      # 未封存段的列文件（追加写）
+        self.index = None      # unit_id → (start, count)（已封存）或 array('I')（未封存）
+        self.index_rows = None
+        self.reader = None
+        self.last_ts = 0.0
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.path, name))
+                   for name in os.listdir(self.path))
+
+    def open_for_append(self, read_only=False):
+        """
+        打开未封存的段继续追加，各列截断到相同行数并从 unit 列重建内存索引
+
+        Args:
+            read_only: 只读打开（不截断、不追加），用于服务运行时在另一个进程中查询
+        """
+        rows = None
+        for name, typecode in COLUMNS:
+            path = os.path.join(self.path, f"{name}.col")
+            count = os.path.getsize(path) // array(typecode).itemsize if os.path.exists(path) else 0
+            rows = count if rows is None else min(rows, count)
+        if not read_only:
+            for name, typecode in COLUMNS:
+                path = os.path.join(self.path, f"{name}.col")
+                with open(path, 'ab') as f:
+                    f.truncate(rows * array(typecode).itemsize)
+        self.rows = rows
+
+        self.index = {}
+        if rows:
+            reader = _SegmentReader(self.path, rows)
+            try:
+                for row, unit_id in enumerate(reader.columns['unit']):
+                    self.index.setdefault(unit_id, array('I')).append(row)
+                self.last_ts = reader.columns['ts'][rows - 1]
+            finally:
+                reader.close()
+
+        if not read_only:
+            self.files = {name: open(os.path.join(self.path, f"{name}.col"), 'ab') for name, _ in COLUMNS}
+
+    def append(self, columns, unit_ids):
+        """追加一批行（columns 为 字段 → array）"""
+        for name, _ in COLUMNS:
+            columns[name].tofile(self.files[name])
+        for offset, unit_id in enumerate(unit_ids):
+            self.index.setdefault(unit_id, array('I')).append(self.rows + offset)
+        self.rows += len(unit_ids)
+
+    def flush(self):
+        if self.files:
+            for f in self.files.values():
+                f.flush()
+
+    def seal(self):
+        """封存：关闭列文件并写入 unit 索引"""
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = None
+
+        entries = bytearray(INDEX_HEADER.pack(len(self.index)))
+        rows = array('I')
+        for unit_id in sorted(self.index):
+            unit_rows = self.index[unit_id]
+            entries += INDEX_ENTRY.pack(unit_id, len(rows), len(unit_rows))
+            rows.extend(unit_rows)
+        tmp_path = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(entries)
+            rows.tofile(f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+        self.sealed = True
+        self.index = None
+
+    def load_sealed(self):
+        """打开已封存的段：mmap 列文件，读取 unit 索引"""
+        if self.reader is not None:
+            return
+        with open(os.path.join(self.path, INDEX_FILE), 'rb') as f:
+            data = f.read()
+        count, = INDEX_HEADER.unpack_from(data, 0)
+        self.index = {}
+        offset = INDEX_HEADER.size
+        for _ in range(count):
+            unit_id, start, unit_count = INDEX_ENTRY.unpack_from(data, offset)
+            self.index[unit_id] = (start, unit_count)
+            offset += INDEX_ENTRY.size
+        self.index_rows = memoryview(data)[offset:].cast('I')
+        self.rows = os.path.getsize(os.path.join(self.path, "ts.col")) // 8
+        self.reader = _SegmentReader(self.path, self.rows)
+
+    def unit_rows(self, unit_id):
+        """返回 unit 在本段中的行号序列（升序）"""
+        if self.sealed:
+            entry = self.index.get(unit_id)
+            if entry is None:
+                return ()
+            start, count = entry
+            return self.index_rows[start:start + count]
+        return self.index.get(unit_id, ())
+
+    def close(self):
+        if self.files:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+
+class HeartbeatArchive:
+    """心跳归档类 - 心跳流水线消费者，支持按 unit 和时间范围查询"""
+
+    def __init__(self, archive_dir=HEARTBEAT_ARCHIVE_DIR, segment_seconds=HEARTBEAT_ARCHIVE_SEGMENT_SECONDS,
+                 max_bytes=HEARTBEAT_ARCHIVE_MAX_BYTES, read_only=False):
+        """
+        打开（或创建）归档目录
+
+        Args:
+            archive_dir: 归档目录
+            segment_seconds: 每段覆盖的时间长度（秒），超过后封存并开始新段
+            max_bytes: 归档总大小上限，超过后删除最旧的已封存段
+            read_only: 只读打开，只能查询（命令行查询工具使用，可与正在写入的服务同时运行）
+        """
+        self.archive_dir = archive_dir
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if not read_only:
+            os.makedirs(archive_dir, exist_ok=True)
+
+        # unit 字典
+        self.units_path = os.path.join(archive_dir, UNITS_FILE)
+        self.unit_names = []
+        self.unit_ids = {}
+        if os.path.exists(self.units_path):
+            with open(self.units_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._register_unit(line.rstrip('\n'))
+        self.units_file = None if read_only else open(self.units_path, 'a', encoding='utf-8')
+
+        # 已有的段，最后一个未封存的段继续追加，其余未封存的段（异常退出遗留）补写索引后封存
+        self.segments = [_Segment(os.path.join(archive_dir, name))
+                         for name in sorted(os.listdir(archive_dir)) if name.isdigit()]
+        self.active = None
+        for segment in self.segments:
+            if segment.sealed:
+                continue
+            segment.open_for_append(read_only)
+            if read_only:
+                continue
+            if segment is self.segments[-1]:
+                self.active = segment
+            else:
+                segment.seal()
+
+        self.rows_written = 0
+        logger.info(f"✓ 心跳归档已打开: {archive_dir} ({len(self.segments)} 段, {len(self.unit_names)} 个 unit)")
+
+    def _register_unit(self, unit):
+        unit_id = len(self.unit_names)
+        self.unit_names.append(unit)
+        self.unit_ids[unit] = unit_id
+        return unit_id
+
+    def _unit_id(self, unit):
+        unit_id = self.unit_ids.get(unit)
+        if unit_id is None:
+            unit_id = self._register_unit(unit)
+            self.units_file.write(unit + '\n')
+        return unit_id
+
+    def append_batch(self, batch):
+        """
+        心跳流水线消费者：按列追加一批心跳
+
+        Args:
+            batch: [(unit, received_at, data), ...]
+        """
+        with self.lock:
+            rows = []
+            last_ts = self.active.last_ts if self.active else 0.0
+            for unit, received_at, data in batch:
+                # 时间列必须单调不减（二分查找依赖），系统时间回拨时沿用上一行的时间
+                ts = max(received_at, last_ts)
+                last_ts = ts
+                rows.append((ts, self._unit_id(unit), data))
+            self.units_file.flush()
+
+            start = 0
+            while start < len(rows):
+                if self.active is None or rows[start][0] >= self.active.start + self.segment_seconds:
+                    self._rotate(rows[start][0])
+                # 本段能容纳的行
+                end = start
+                limit = self.active.start + self.segment_seconds
+                while end < len(rows) and rows[end][0] < limit:
+                    end += 1
+                self._write_rows(rows[start:end])
+                start = end
+
+    def _write_rows(self, rows):
+        columns = {name: array(typecode) for name, typecode in COLUMNS}
+        unit_ids = []
+        for ts, unit_id, data in rows:
+            columns['ts'].append(ts)
+            columns['unit'].append(unit_id)
+            unit_ids.append(unit_id)
+            for name in FLOAT_FIELDS:
+                columns[name].append(_to_float(data.get(name)))
+            columns['network'].append(NETWORK_CODES.get(data.get('network'), 0))
+            columns['links'].append((LINK_ETH if data.get('eth_connected') else 0) |
+                                    (LINK_WIFI if data.get('wifi_connected') else 0) |
+                                    (LINK_LTE if data.get('lte_connected') else 0))
+            columns['ip'].append(_ip_to_int(data.get('ip')))
+        self.active.append(columns, unit_ids)
+        self.active.last_ts = rows[-1][0]
+        self.rows_written += len(rows)
+
+    def _rotate(self, ts):
+        """封存当前段，以 ts 为起点开始新段，并按总大小清理旧段"""
+        if self.active is not None:
+            self.active.seal()
+            logger.info(f"✓ 心跳归档段已封存: {os.path.basename(self.active.path)} ({self.active.rows} 行)")
+
+        path = os.path.join(self.archive_dir, f"{int(ts * 1000):013d}")
+        os.makedirs(path, exist_ok=True)
+        self.active = _Segment(path)
+        self.active.open_for_append()
+        self.segments.append(self.active)
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        """总大小超过上限时删除最旧的已封存段"""
+        sizes = [segment.size() for segment in self.segments]
+        total = sum(sizes)
+        while total > self.max_bytes and len(self.segments) > 1 and self.segments[0].sealed:
+            segment = self.segments.pop(0)
+            total -= sizes.pop(0)
+            segment.close()
+            shutil.rmtree(segment.path, ignore_errors=True)
+            logger.info(f"心跳归档超过 {self.max_bytes} 字节，已删除旧段: {os.path.basename(segment.path)}")
+
+    def query(self, unit=None, start=None, end=None, fields=None, limit=10000):
+        """
+        查询心跳历史
+
+        Args:
+            unit: 设备单元标识，None 表示所有设备
+            start: 起始时间（Unix 时间戳，含），None 表示不限
+            end: 结束时间（Unix 时间戳，不含），None 表示不限
+            fields: 返回的字段，默认全部（见 FIELDS）
+            limit: 最多返回的行数
+
+        Returns:
+            list: [{"ts": ..., "unit": ..., 字段: 值, ...}, ...]，按时间排序
+        """
+        fields = [f for f in (fields or FIELDS) if f in FIELDS]
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        names = ['ts', 'unit'] + fields
+        chunks = []
+
+        # 锁内只复制所需列的切片，构建结果 dict 在锁外进行，不阻塞心跳写入
+        with self.lock:
+            unit_id = self.unit_ids.get(unit) if unit is not None else None
+            if unit is not None and unit_id is None:
+                return []
+
+            remaining = limit
+            for i, segment in enumerate(self.segments):
+                segment_end = self.segments[i + 1].start if i + 1 < len(self.segments) else math.inf
+                if segment.start >= end or segment_end <= start:
+                    continue
+                columns = self._slice_segment(segment, unit_id, start, end, names, remaining)
+                chunks.append(columns)
+                remaining -= len(columns['ts'])
+                if remaining <= 0:
+                    break
+            unit_names = self.unit_names
+
+        results = []
+        for columns in chunks:
+            for row in range(len(columns['ts'])):
+                results.append(self._row(columns, row, fields, unit_names))
+        return results
+
+    def _slice_segment(self, segment, unit_id, start, end, names, limit):
+        """
+        复制段中时间范围内的列数据（调用方持有 lock）
+
+        Returns:
+            dict: 列名 → 值列表，最多 limit 行
+        """
+        if segment.sealed:
+            segment.load_sealed()
+            reader = segment.reader
+            temporary = False
+        else:
+            # 未封存的段仍在追加，按当前行数重新映射
+            segment.flush()
+            reader = _SegmentReader(segment.path, segment.rows)
+            temporary = True
+
+        try:
+            ts = reader.columns['ts']
+            if unit_id is None:
+                lo = _lower_bound(0, reader.rows, start, ts.__getitem__)
+                hi = _lower_bound(lo, reader.rows, end, ts.__getitem__)
+                hi = min(hi, lo + limit)
+                return {name: reader.columns[name][lo:hi].tolist() for name in names}
+
+            unit_rows = segment.unit_rows(unit_id)
+            lo = _lower_bound(0, len(unit_rows), start, lambda k: ts[unit_rows[k]])
+            hi = _lower_bound(lo, len(unit_rows), end, lambda k: ts[unit_rows[k]])
+            rows = unit_rows[lo:min(hi, lo + limit)]
+            return {name: [reader.columns[name][row] for row in rows] for name in names}
+        finally:
+            if temporary:
+                reader.close()
+
+    @staticmethod
+    def _row(columns, row, fields, unit_names):
+        record = {"ts": columns['ts'][row], "unit": unit_names[columns['unit'][row]]}
+        for name in fields:
+            value = columns[name][row]
+            if name in FLOAT_FIELDS:
+                value = None if math.isnan(value) else round(value, 3)
+            elif name == 'network':
+                value = NETWORK_NAMES.get(value)
+            elif name == 'links':
+                value = {"eth": bool(value & LINK_ETH), "wifi": bool(value & LINK_WIFI),
+                         "lte": bool(value & LINK_LTE)}
+            elif name == 'ip':
+                value = _int_to_ip(value)
+            record[name] = value
+        return record
+
+    def cmd_history(self, conn, json_data):
+        """
+        HIS 本地命令：查询心跳历史
+        {"type": "HIS", "unit": "...", "start": 1760800000, "end": 1760843200, "fields": ["spi_fps", "lte_signal"], "limit": 1000}
+        """
+        rows = self.query(json_data.get('unit'), json_data.get('start'), json_data.get('end'),
+                          json_data.get('fields'), min(int(json_data.get('limit', 1000)), 100000))
+        return {"type": "HIS", "ok": True, "count": len(rows), "rows": rows}
+
+    def get_stats(self):
+        """归档统计"""
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "units": len(self.unit_names),
+                "rows_written": self.rows_written,
+                "bytes": sum(segment.size() for segment in self.segments),
+            }
+
+    def close(self):
+        """关闭归档（当前段不封存，下次打开时继续追加）"""
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            if self.units_file:
+                self.units_file.close()
+
+
+def _parse_time(value):
+    """命令行时间参数：Unix 时间戳或 "YYYY-MM-DD HH:MM[:SS]"（本地时间）"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"无法解析时间: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查询设备心跳归档")
+    parser.add_argument("archive_dir", help="归档目录")
+    parser.add_argument("--unit", help="设备单元标识")
+    parser.add_argument("--start", type=_parse_time, help="起始时间")
+    parser.add_argument("--end", type=_parse_time, help="结束时间")
+    parser.add_argument("--fields", help=f"逗号分隔的字段: {','.join(FIELDS)}")
+    parser.add_argument("--limit", type=int, default=10000)
+    args = parser.parse_args()
+
+    archive = HeartbeatArchive(args.archive_dir, read_only=True)
+    try:
+        fields = args.fields.split(',') if args.fields else None
+        for row in archive.query(args.unit, args.start, args.end, fields, args.limit):
+            row['ts'] = datetime.fromtimestamp(row['ts']).strftime("%Y-%m-%d %H:%M:%S")
+            print(json.dumps(row, ensure_ascii=False))
+    finally:
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备心跳处理流水线
+MQTT 网络线程只把心跳原始数据放入有界队列，由独立的工作线程按数量或时间攒成小批次，
+统一解析后交给下游消费者（设备注册表、负载编码等），心跳量再大也不会阻塞命令和回复的转发
+
+批次格式: [(unit, received_at, data), ...]，received_at 为中转服务收到心跳的时间 (time.time())，
+data 为解析后的心跳 dict，同一批次内按到达顺序排列
+"""
+
+import json
+import time
+import threading
+import logging
+from collections import deque
+from config import *
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatPipeline:
+    """心跳流水线类 - 有界队列 + 微批处理工作线程"""
+
+    def __init__(self, batch_size=HEARTBEAT_BATCH_SIZE, batch_interval=HEARTBEAT_BATCH_INTERVAL,
+                 queue_size=HEARTBEAT_QUEUE_SIZE):
+        """
+        初始化心跳流水线
+
+        Args:
+            batch_size: 队列积压达到该数量时立即处理一批
+            batch_interval: 最长攒批时间（秒）
+            queue_size: 队列上限，满时丢弃最旧的心跳（设备会周期性重发，最新状态更有价值）
+        """
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = deque(maxlen=queue_size)
+        self.wake = threading.Event()
+        self.consumers = []
+        self.running = False
+        self.worker = None
+
+        # 统计
+        self.received = 0
+        self.dropped = 0
+        self.parse_errors = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def add_consumer(self, consumer):
+        """
+        注册下游消费者
+
+        Args:
+            consumer: 处理函数，接收一个批次 [(unit, received_at, data), ...]
+        """
+        self.consumers.append(consumer)
+
+    def handle_heartbeat(self, topic, payload, captures):
+        """心跳路由处理函数（MQTT 网络线程），只入队不解析"""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((captures['unit'], time.time(), payload))
+        self.received += 1
+        if len(self.queue) >= self.batch_size:
+            self.wake.set()
+
+    def start(self):
+        """启动工作线程"""
+        self.running = True
+        self.worker = threading.Thread(target=self._worker_loop, name="heartbeat-pipeline", daemon=True)
+        self.worker.start()
+        logger.info(f"✓ 心跳流水线已启动 (批量={self.batch_size}, 间隔={self.batch_interval}s)")
+
+    def stop(self):
+        """停止工作线程，处理完队列中剩余的心跳"""
+        self.running = False
+        self.wake.set()
+        if self.worker:
+            self.worker.join(timeout=5)
+            self.worker = None
+
+    def _worker_loop(self):
+        """工作线程：等待攒批条件满足后处理队列"""
+        while self.running:
+            self.wake.wait(self.batch_interval)
+            self.wake.clear()
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        """
+        处理队列中的全部心跳，每 batch_size 条交给消费者一次
+
+        Returns:
+            int: 处理的心跳数量
+        """
+        processed = 0
+        while self.queue:
+            raw = []
+            try:
+                for _ in range(self.batch_size):
+                    raw.append(self.queue.popleft())
+            except IndexError:
+                pass
+            processed += len(raw)
+            batch = self._parse(raw)
+            if batch:
+                self._dispatch(batch)
+        return processed
+
+    def _parse(self, raw):
+        """批量解析心跳 JSON，解析失败的丢弃并计数"""
+        batch = []
+        for unit, received_at, payload in raw:
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                self.parse_errors += 1
+                logger.warning(f"⚠️ 心跳数据解析失败，已丢弃 (unit={unit})")
+                continue
+            if isinstance(data, dict):
+                batch.append((unit, received_at, data))
+            else:
+                self.parse_errors += 1
+        return batch
+
+    def _dispatch(self, batch):
+        """将批次交给所有消费者，单个消费者出错不影响其他消费者"""
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        for consumer in self.consumers:
+            try:
+                consumer(batch)
+            except Exception as e:
+                logger.error(f"✗ 心跳消费者处理出错 ({getattr(consumer, '__qualname__', consumer)}): {e}")
+
+    def queue_depth(self):
+        """当前队列积压数量"""
+        return len(self.queue)
+
+    def get_stats(self):
+        """流水线统计"""
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "parse_errors": self.parse_errors,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "queue_depth": len(self.queue),
+        }
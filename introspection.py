@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行时诊断
+无需重启即可查看运行状态，未开启时不增加开销（阶段计时只多一次布尔判断）:
+    stacks      打印所有线程的调用栈
+    timers      各处理阶段的耗时统计（_handle_client 按单条 Backend 命令计、forward_socket_command、_on_message、send_socket_reply）
+    profile     采样分析 N 秒，输出折叠调用栈文件（可用 flamegraph.pl / speedscope 生成火焰图）
+    memory      tracemalloc 内存分配排行
+    gauges      队列深度、映射表大小等
+
+触发方式:
+    kill -USR1 <pid>    打印调用栈、阶段耗时和队列深度到日志
+    kill -USR2 <pid>    开始 PROFILE_DEFAULT_SECONDS 秒采样分析
+    DBG 本地命令         {"type": "DBG", "action": "timers", "op": "start"}，见 Introspection.cmd_debug
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+import traceback
+import tracemalloc
+import logging
+from collections import Counter
+from config import *
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimers:
+    """处理阶段耗时统计，enabled 为 False 时埋点只做一次判断"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stats = {}  # 阶段 → [次数, 总耗时, 最大耗时]
+        self.started_at = None
+
+    def start(self):
+        with self.lock:
+            self.stats.clear()
+            self.started_at = time.time()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def record(self, stage, started):
+        """
+        记录一次阶段耗时（埋点处先判断 enabled）
+
+        Args:
+            stage: 阶段名
+            started: time.perf_counter() 开始时间
+        """
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            stat = self.stats.get(stage)
+            if stat is None:
+                self.stats[stage] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                if elapsed > stat[2]:
+                    stat[2] = elapsed
+
+    def report(self):
+        """返回 阶段 → {count, total_ms, avg_ms, max_ms}"""
+        with self.lock:
+            return {
+                stage: {"count": count, "total_ms": round(total * 1000, 3),
+                        "avg_ms": round(total / count * 1000, 4), "max_ms": round(maximum * 1000, 3)}
+                for stage, (count, total, maximum) in sorted(self.stats.items())
+            }
+
+
+# 全局阶段计时（各模块埋点直接引用）
+STAGE_TIMERS = StageTimers()
+
+
+def dump_stacks():
+    """返回所有线程的调用栈文本"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f"--- 线程 {names.get(ident, '?')} ({ident}) ---")
+        lines.extend(line.rstrip() for line in traceback.format_stack(frame))
+    return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """采样分析器 - 定时采集所有线程的调用栈，输出折叠格式（每行: 线程;函数;...;函数 次数）"""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.output = None
+        self.samples = 0
+        self.stop_event = threading.Event()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, output):
+        """
+        开始采样（后台线程，到时自动写入文件）
+
+        Args:
+            seconds: 采样时长（秒），上限 PROFILE_MAX_SECONDS
+            output: 折叠调用栈输出文件
+
+        Returns:
+            bool: 已有采样在进行时返回False
+        """
+        if self.is_running():
+            return False
+        self.output = output
+        self.samples = 0
+        self.stop_event.clear()
+        seconds = min(seconds, PROFILE_MAX_SECONDS)
+        self.thread = threading.Thread(target=self._run, args=(seconds,), name="sampling-profiler", daemon=True)
+        self.thread.start()
+        logger.info(f"✓ 采样分析已开始: {seconds}s → {output}")
+        return True
+
+    def stop(self):
+        """提前结束采样（仍会写入文件）"""
+        self.stop_event.set()
+
+    def _run(self, seconds):
+        own = threading.get_ident()
+        counts = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+        os.makedirs(os.path.dirname(self.output) or ".", exist_ok=True)
+        with open(self.output, 'w', encoding='utf-8') as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"✓ 采样分析完成: {self.samples} 次采样 → {self.output}")
+
+
+class Introspection:
+    """运行时诊断类 - 信号和 DBG 命令入口"""
+
+    def __init__(self, output_dir=INTROSPECTION_DIR):
+        self.output_dir = output_dir
+        self.profiler = SamplingProfiler()
+        self.gauges = {}  # 名称 → 返回数值的函数
+
+    def register_gauge(self, name, func):
+        """注册队列深度等指标（只在查询时调用）"""
+        self.gauges[name] = func
+
+    def read_gauges(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                values[name] = f"error: {e}"
+        return values
+
+    def start_profile(self, seconds=PROFILE_DEFAULT_SECONDS):
+        """开始采样分析，返回输出文件路径（已有采样在进行时返回 None）"""
+        output = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        return output if self.profiler.start(seconds, output) else None
+
+    def memory_top(self, limit=20):
+        """tracemalloc 按代码行统计的内存分配排行（需先 start）"""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        return [{"where": str(stat.traceback), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in snapshot.statistics('lineno')[:limit]]
+
+    # ---------------- 信号 ----------------
+
+    def install_signal_handlers(self):
+        """注册 SIGUSR1/SIGUSR2（只能在主线程调用，Windows 不支持）"""
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        signal.signal(signal.SIGUSR1, self._on_sigusr1)
+        signal.signal(signal.SIGUSR2, self._on_sigusr2)
+        logger.info(f"✓ 诊断信号已注册: kill -USR1 {os.getpid()} 打印状态，kill -USR2 {os.getpid()} 采样分析")
+
+    def _on_sigusr1(self, sig, frame):
+        # 信号处理函数中只启动线程，避免在主线程中长时间阻塞
+        threading.Thread(target=self._log_report, daemon=True).start()
+
+    def _on_sigusr2(self, sig, frame):
+        output = self.start_profile()
+        if output is None:
+            logger.warning("⚠️ 采样分析正在进行中")
+
+    def _log_report(self):
+        logger.info("=" * 60)
+        logger.info("🔍 运行时诊断")
+        logger.info(f"线程调用栈:\n{dump_stacks()}")
+        if STAGE_TIMERS.enabled:
+            for stage, stat in STAGE_TIMERS.report().items():
+                logger.info(f"  阶段 {stage}: {stat}")
+        else:
+            logger.info("  阶段计时未开启（DBG timers start）")
+        for name, value in self.read_gauges().items():
+            logger.info(f"  {name}: {value}")
+        logger.info("=" * 60)
+
+    # ---------------- DBG 命令 ----------------
+
+    def cmd_debug(self, conn, json_data):
+        """
+        DBG 本地命令
+            {"action": "stacks"}                                   所有线程调用栈
+            {"action": "timers", "op": "start" | "stop" | "report"} 阶段计时
+            {"action": "profile", "seconds": 30}                   采样分析，返回输出文件
+            {"action": "profile", "op": "stop"}                    提前结束采样
+            {"action": "memory", "op": "start" | "stop" | "report", "limit": 20}  tracemalloc
+            {"action": "gauges"}                                   队列深度等指标
+        """
+        action = json_data.get('action', 'gauges')
+        op = json_data.get('op', 'report')
+        response = {"type": "DBG", "ok": True, "action": action}
+
+        if action == 'stacks':
+            response["stacks"] = dump_stacks()
+        elif action == 'timers':
+            if op == 'start':
+                STAGE_TIMERS.start()
+            elif op == 'stop':
+                STAGE_TIMERS.stop()
+            response["enabled"] = STAGE_TIMERS.enabled
+            response["since"] = STAGE_TIMERS.started_at
+            response["stages"] = STAGE_TIMERS.report()
+        elif action == 'profile':
+            if op == 'stop':
+                self.profiler.stop()
+                response["output"] = self.profiler.output
+            else:
+                output = self.start_profile(float(json_data.get('seconds', PROFILE_DEFAULT_SECONDS)))
+                if output is None:
+                    return {"type": "DBG", "ok": False, "error": "采样分析正在进行中", "output": self.profiler.output}
+                response["output"] = output
+        elif action == 'memory':
+            if op == 'start' and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            elif op == 'stop':
+                tracemalloc.stop()
+            response["tracing"] = tracemalloc.is_tracing()
+            if op == 'report':
+                response["top"] = self.memory_top(int(json_data.get('limit', 20)))
+        elif action == 'gauges':
+            response["gauges"] = self.read_gauges()
+        else:
+            return {"type": "DBG", "ok": False, "error": f"未知的 action: {action}"}
+        return response
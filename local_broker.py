@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 MQTT Broker 替身
+进程内实现主题匹配和消息投递，客户端接口与 paho.mqtt.client.Client 保持一致，
+用于流量回放、容量测试和长时间稳定性测试，无需真实 Broker
+"""
+
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+def topic_matches(topic_filter, topic):
+    """判断主题是否匹配订阅过滤器（支持 + 和 # 通配符）"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class LocalMessage:
+    """投递给客户端的消息，字段与 paho.mqtt.client.MQTTMessage 一致"""
+
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'properties')
+
+    def __init__(self, topic, payload, qos=0, retain=False, properties=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.properties = properties
+
+
+class LocalPublishResult:
+    """publish() 返回值，字段与 paho.mqtt.client.MQTTMessageInfo 一致"""
+
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def wait_for_publish(self, timeout=None):
+        return True
+
+    def is_published(self):
+        return self.rc == MQTT_ERR_SUCCESS
+
+
+class LocalBroker:
+    """本地 Broker - 线程安全的进程内消息路由，支持保留消息和 $share 共享订阅"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # client_id → LocalBrokerClient
+        self.retained = {}  # topic → LocalMessage
+        self.shared_cursor = {}  # (group, filter) → 轮询计数
+        self.message_count = 0
+
+    def create_client(self, client_id):
+        """创建连接到本 Broker 的客户端"""
+        return LocalBrokerClient(self, client_id)
+
+    def _register(self, client):
+        with self.lock:
+            self.clients[client.client_id] = client
+
+    def _unregister(self, client):
+        with self.lock:
+            if self.clients.get(client.client_id) is client:
+                del self.clients[client.client_id]
+
+    def route(self, topic, payload, qos=0, retain=False, properties=None):
+        """将消息投递给所有订阅匹配的客户端"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+        else:
+            payload = bytes(payload)
+
+        with self.lock:
+            self.message_count += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = LocalMessage(topic, payload, qos, True, properties)
+                else:
+                    self.retained.pop(topic, None)
+
+            targets = []
+            shared = {}  # 共享订阅 (group, filter) → 订阅的客户端
+            for client in self.clients.values():
+                direct = False
+                for topic_filter in client.get_subscriptions():
+                    if topic_filter.startswith('$share/'):
+                        _, group, real_filter = topic_filter.split('/', 2)
+                        if topic_matches(real_filter, topic):
+                            shared.setdefault((group, real_filter), []).append(client)
+                    elif not direct and topic_matches(topic_filter, topic):
+                        direct = True
+                if direct:
+                    targets.append(client)
+
+            # 共享订阅组内轮询投递给其中一个客户端
+            for key, members in shared.items():
+                cursor = self.shared_cursor.get(key, 0)
+                self.shared_cursor[key] = cursor + 1
+                client = members[cursor % len(members)]
+                if client not in targets:
+                    targets.append(client)
+
+        for client in targets:
+            client._enqueue(LocalMessage(topic, payload, qos, False, properties))
+
+    def _deliver_retained(self, client, topic_filters):
+        """新订阅时投递匹配的保留消息"""
+        with self.lock:
+            messages = [m for m in self.retained.values()
+                        if any(topic_matches(f.split('/', 2)[2] if f.startswith('$share/') else f, m.topic)
+                               for f in topic_filters)]
+        for message in messages:
+            client._enqueue(message)
+
+
+class LocalBrokerClient:
+    """本地 Broker 客户端 - 提供 MQTTService 使用到的 paho 客户端接口"""
+
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+
+        self.subscriptions = set()
+        self.sub_lock = threading.Lock()
+        self.inbox = queue.Queue()
+        self.loop_thread = None
+        self.connected = False
+        self.next_mid = 1
+        self.will = None
+        self.topic_aliases = {}  # MQTT 5 主题别名 alias → topic
+
+    def connect(self, host=None, port=None, keepalive=60, **kwargs):
+        """连接 Broker（host/port 参数被忽略）"""
+        self.broker._register(self)
+        self.connected = True
+        # 与 paho 一致，on_connect 在网络循环线程中回调
+        self.inbox.put(('connect', None))
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self, **kwargs):
+        if self.connected:
+            self.connected = False
+            self.broker._unregister(self)
+            self.inbox.put(('disconnect', None))
+        return MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        if self.loop_thread is None:
+            self.loop_thread = threading.Thread(target=self._loop, daemon=True)
+            self.loop_thread.start()
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        if self.loop_thread is not None:
+            self.inbox.put(('stop', None))
+            if self.loop_thread is not threading.current_thread():
+                self.loop_thread.join(timeout=5)
+            self.loop_thread = None
+        return MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        """订阅，topic 可为字符串或 [(topic, qos), ...] 列表（与 paho 一致）"""
+        topics = self._topic_list(topic)
+        with self.sub_lock:
+            self.subscriptions.update(topics)
+        self.broker._deliver_retained(self, topics)
+        return MQTT_ERR_SUCCESS, self._mid()
+
+    def unsubscribe(self, topic, **kwargs):
+        with self.sub_lock:
+            self.subscriptions.difference_update(self._topic_list(topic))
+        return MQTT_ERR_SUCCESS, self._mid()
+
+    @staticmethod
+    def _topic_list(topic):
+        if isinstance(topic, str):
+            return [topic]
+        return [t if isinstance(t, str) else t[0] for t in topic]
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if not self.connected:
+            return LocalPublishResult(MQTT_ERR_NO_CONN, 0)
+
+        # MQTT 5 主题别名：带主题时建立别名，主题为空时按别名还原
+        alias = getattr(properties, 'TopicAlias', None)
+        if alias:
+            if topic:
+                self.topic_aliases[alias] = topic
+            else:
+                topic = self.topic_aliases[alias]
+        self.broker.route(topic, payload, qos, retain, properties)
+        return LocalPublishResult(MQTT_ERR_SUCCESS, self._mid())
+
+    def get_subscriptions(self):
+        with self.sub_lock:
+            return list(self.subscriptions)
+
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """设置遗嘱消息，disconnect() 不发送遗嘱，close_abnormally() 时发送"""
+        self.will = (topic, payload, qos, retain)
+
+    def close_abnormally(self):
+        """模拟异常断开：发送遗嘱消息后断开"""
+        self.disconnect()
+        if self.will:
+            self.broker.route(*self.will)
+
+    def _mid(self):
+        mid = self.next_mid
+        self.next_mid += 1
+        return mid
+
+    def _enqueue(self, message):
+        self.inbox.put(('message', message))
+
+    def _loop(self):
+        """网络循环线程，依次执行回调"""
+        while True:
+            event, message = self.inbox.get()
+            try:
+                if event == 'stop':
+                    break
+                elif event == 'connect' and self.on_connect:
+                    self.on_connect(self, None, {}, 0)
+                elif event == 'disconnect' and self.on_disconnect:
+                    self.on_disconnect(self, None, 0)
+                elif event == 'message' and self.on_message:
+                    self.on_message(self, None, message)
+            except Exception as e:
+                logger.error(f"本地 Broker 客户端回调出错 ({self.client_id}): {e}")
+
+    def pending_messages(self):
+        """返回尚未投递的消息数量"""
+        return self.inbox.qsize()
@@ -7,13 +7,24 @@ MS500 MQTT 服务器端主程序
 
 import sys
 import time
+import threading
 import signal
 import logging
-import json
 from config import *
 from mqtt_service import MQTTService
 from mqtt_pub import MQTTPublisher
 from socket_service import SocketService
+from traffic_capture import TrafficRecorder
+from cluster import ClusterCoordinator
+from payload_codec import PayloadCodec
+from heartbeat_pipeline import HeartbeatPipeline
+from device_registry import DeviceRegistry
+from heartbeat_archive import HeartbeatArchive
+from anomaly_detector import AnomalyDetector
+from event_subscriptions import EventHub
+from introspection import Introspection
+from snapshot import SnapshotManager
+from command_coalescer import CommandCoalescer
 
 # 配置日志
 logging.basicConfig(
@@ -25,12 +36,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def handle_online_message(topic, payload):
-    """处理设备在线消息"""
+def handle_online_message(unit, data):
+    """处理设备在线消息（已解析的心跳数据）"""
     try:
-        # 解析 JSON 数据
-        data = json.loads(payload)
-
         # 提取设备信息
         device_id = data.get('device_id', 'unknown')
         msg_type = data.get('msg_type', 'unknown')
@@ -38,7 +46,7 @@ def handle_online_message(topic, payload):
 
         logger.info("=" * 60)
         logger.info(f"📱 收到设备在线消息")
-        logger.info(f"  主题: {topic}")
+        logger.info(f"  设备: {unit}")
         logger.info(f"  设备ID: {device_id}")
         logger.info(f"  时间戳: {timestamp}")
 
@@ -78,20 +86,48 @@ def handle_online_message(topic, payload):
 
         logger.info("=" * 60)
 
-    except json.JSONDecodeError as e:
-        logger.error(f"✗ 解析在线消息JSON失败: {e}")
     except Exception as e:
         logger.error(f"✗ 处理在线消息时出错: {e}")
 
 
+def log_heartbeat_batch(batch):
+    """心跳流水线消费者：逐条打印心跳详情（仅 DEBUG 日志级别启用）"""
+    for unit, received_at, data in batch:
+        handle_online_message(unit, data)
+
+
 class MS500Server:
     """MS500 服务器主类"""
 
-    def __init__(self):
-        """初始化服务器"""
+    def __init__(self, mqtt_client=None, socket_host=SOCKET_HOST, socket_port=SOCKET_PORT,
+                 capture_file=CAPTURE_FILE):
+        """
+        初始化服务器
+
+        Args:
+            mqtt_client: 可选，外部创建的 MQTT 客户端（回放/测试时使用本地 Broker 替身）
+            socket_host: Socket 监听地址
+            socket_port: Socket 监听端口
+            capture_file: 流量抓取文件路径，None 表示不抓取
+        """
+        self.mqtt_client = mqtt_client
+        self.socket_host = socket_host
+        self.socket_port = socket_port
+        self.capture_file = capture_file
         self.mqtt_service = None
         self.mqtt_publisher = None
         self.socket_service = None
+        self.recorder = None
+        self.cluster = None
+        self.codec = None
+        self.heartbeats = None
+        self.registry = None
+        self.archive = None
+        self.detector = None
+        self.events = None
+        self.snapshot = None
+        self.coalescer = None
+        self.introspection = Introspection()
         self.running = False
 
     def start(self):
@@ -104,26 +140,95 @@ class MS500Server:
 
         # 1. 创建MQTT服务
         logger.info("\n[1/3] 初始化 MQTT 服务...")
-        self.mqtt_service = MQTTService()
-
-        # 设置MQTT消息回调（处理设备在线消息）
-        # self.mqtt_service.set_message_callback(handle_online_message)
+        self.mqtt_service = MQTTService(self.mqtt_client)
+
+        # 按 unit 协商的负载编码
+        self.codec = PayloadCodec()
+        self.mqtt_service.set_codec(self.codec)
+
+        # 设备心跳流水线：MQTT 网络线程只入队，工作线程批量解析后更新设备注册表和负载编码
+        # （集群模式下心跳使用共享订阅由各实例分摊，学到的编码由 cluster 同步）
+        self.registry = DeviceRegistry()
+        self.heartbeats = HeartbeatPipeline()
+        self.heartbeats.add_consumer(self.registry.update_batch)
+        self.heartbeats.add_consumer(self.codec.update_batch)
+        if logger.isEnabledFor(logging.DEBUG):
+            self.heartbeats.add_consumer(log_heartbeat_batch)
+        self.mqtt_service.add_route(DEVICE_ONLINE_TOPIC, self.heartbeats.handle_heartbeat)
 
         # 2. 创建MQTT发布器
         logger.info("[2/3] 初始化 MQTT 发布器...")
-        self.mqtt_publisher = MQTTPublisher(self.mqtt_service)
+        self.mqtt_publisher = MQTTPublisher(self.mqtt_service, self.codec)
+
+        # 设置命令合并（可选）：CFG/CTS/CDN/UDS 在窗口内合并后只发布一次
+        publisher = self.mqtt_publisher
+        if COMMAND_COALESCE_WINDOW:
+            self.coalescer = CommandCoalescer(self.mqtt_publisher)
+            publisher = self.coalescer
 
         # 3. 创建Socket服务（接收 Backend 命令）
         logger.info("[3/3] 初始化 Socket 服务...")
-        self.socket_service = SocketService(self.mqtt_publisher)
+        self.socket_service = SocketService(publisher, self.socket_host, self.socket_port)
+        if self.coalescer:
+            self.coalescer.set_socket_service(self.socket_service)
+        self.socket_service.add_local_command('ENC', self.codec.cmd_encoding)
+
+        # 设备事件订阅（SUB/UNS）和异常检测，心跳、上下线和告警推送给订阅的 Backend
+        # 集群模式下心跳由各实例分摊，单个实例看到的心跳间隔被拉长，无法判断设备是否静默/离线
+        presence = not CLUSTER_ENABLED
+        if not presence:
+            logger.warning("⚠️ 集群模式下关闭静默告警和 online/offline 事件（各实例只收到部分心跳）")
+        self.events = EventHub(presence=presence)
+        self.detector = AnomalyDetector(silent_detection=presence)
+        self.detector.set_event_hub(self.events)
+        self.heartbeats.add_consumer(self.detector.update_batch)
+        self.heartbeats.add_consumer(self.events.update_batch)
+        self.socket_service.add_local_command('SUB', self.events.cmd_subscribe)
+        self.socket_service.add_local_command('UNS', self.events.cmd_unsubscribe)
+        self.socket_service.add_local_command('ALR', self.detector.cmd_alerts)
+        self.socket_service.add_disconnect_callback(self.events.unsubscribe_connection)
+
+        # 心跳归档（可选）
+        if HEARTBEAT_ARCHIVE_DIR:
+            self.archive = HeartbeatArchive(HEARTBEAT_ARCHIVE_DIR)
+            self.heartbeats.add_consumer(self.archive.append_batch)
+            self.socket_service.add_local_command('HIS', self.archive.cmd_history)
+
+        # 状态快照（可选）：在处理心跳前恢复设备注册表、编码、检测基线和在线设备
+        if SNAPSHOT_FILE:
+            self.snapshot = SnapshotManager(SNAPSHOT_FILE)
+            self.snapshot.add_section(b'DEVS', self.registry.dump_snapshot, self.registry.load_snapshot)
+            self.snapshot.add_section(b'ENCD', self.codec.dump_snapshot, self.codec.load_snapshot)
+            self.snapshot.add_section(b'ANOM', self.detector.dump_snapshot, self.detector.load_snapshot)
+            self.snapshot.add_section(b'ONLN', self.events.dump_snapshot, self.events.load_snapshot)
+            self.snapshot.load()
+
+        # 运行时诊断（DBG 命令、SIGUSR1/SIGUSR2）
+        self._register_gauges()
+        self.socket_service.add_local_command('DBG', self.introspection.cmd_debug)
 
         # 4. 设置 Socket 回复回调 (MQTT回复 -> Socket)
         self.mqtt_service.set_socket_reply_callback(self.socket_service.send_socket_reply)
+        self.mqtt_service.set_socket_reply_chunk_callback(self.socket_service.send_socket_reply_chunk)
         logger.info("✓ Socket 回复回调已设置")
 
+        # 5. 集群模式（可选，需在 MQTT 连接前设置共享订阅和遗嘱）
+        if CLUSTER_ENABLED:
+            self.cluster = ClusterCoordinator(self.mqtt_service, CLUSTER_INSTANCE_ID, CLUSTER_GROUP)
+            self.mqtt_service.set_cluster(self.cluster)
+            self.socket_service.set_cluster(self.cluster)
+            self.cluster.set_codec(self.codec)
+
+        # 6. 开启流量抓取（可选）
+        if self.capture_file:
+            self.recorder = TrafficRecorder(self.capture_file, CAPTURE_BUFFER_SIZE)
+            self.mqtt_service.set_recorder(self.recorder)
+            self.socket_service.set_recorder(self.recorder)
+
         # 启动MQTT服务
         if not self.mqtt_service.start():
             logger.error("MQTT 服务启动失败")
+            self._shutdown()
             return False
 
         # 等待MQTT连接
@@ -135,12 +240,21 @@ class MS500Server:
 
         if not self.mqtt_service.is_connected():
             logger.error("MQTT 连接超时")
+            self._shutdown()
             return False
 
+        # 连接成功后启动心跳流水线、异常检测、状态快照和命令合并（此前到达的心跳已在队列中）
+        self.heartbeats.start()
+        self.detector.start()
+        if self.snapshot:
+            self.snapshot.start()
+        if self.coalescer:
+            self.coalescer.start()
+
         # 启动Socket服务
         if not self.socket_service.start():
             logger.error("Socket 服务启动失败")
-            self.mqtt_service.stop()
+            self._shutdown()
             return False
 
         self.running = True
@@ -149,30 +263,78 @@ class MS500Server:
         logger.info("✓ 服务器启动成功！")
         logger.info("=" * 60)
         logger.info(f"MQTT Broker: {MQTT_BROKER}:{MQTT_PORT}")
-        logger.info(f"Socket 服务: {SOCKET_HOST}:{SOCKET_PORT}")
+        logger.info(f"Socket 服务: {self.socket_host}:{self.socket_port}")
         logger.info("=" * 60)
         logger.info("\n等待客户端连接和设备消息...")
         logger.info("按 Ctrl+C 停止服务器\n")
 
         return True
 
+    def _register_gauges(self):
+        """注册诊断指标（只在 DBG gauges 或 SIGUSR1 时读取）"""
+        socket_service = self.socket_service
+        gauge = self.introspection.register_gauge
+        gauge("threads", threading.active_count)
+        gauge("connections", lambda: len(socket_service.connections))
+        gauge("unit_socket_map", lambda: len(socket_service.unit_socket_map))
+        gauge("pending_requests", lambda: sum(len(q) for q in list(socket_service.pending_requests.values())))
+        gauge("pending_by_correlation", lambda: len(socket_service.pending_by_correlation))
+        gauge("reply_chunks_pending", self.mqtt_service.reply_reassembler.pending_count)
+        gauge("heartbeat_queue", self.heartbeats.queue_depth)
+        gauge("heartbeat_pipeline", self.heartbeats.get_stats)
+        gauge("devices", lambda: len(self.registry))
+        gauge("event_outbox_queued", lambda: self.events.get_stats()["queued"])
+        if self.archive:
+            gauge("heartbeat_archive", self.archive.get_stats)
+        if self.snapshot:
+            gauge("snapshot", self.snapshot.get_stats)
+        if self.coalescer:
+            gauge("command_coalescer", self.coalescer.get_stats)
+
     def stop(self):
         """停止服务器"""
         if not self.running:
             return
 
         logger.info("\n正在停止服务器...")
+        self._shutdown()
+        self.running = False
+        logger.info("服务器已停止")
 
+    def _shutdown(self):
+        """
+        停止所有组件并释放资源（stop() 和 start() 的失败路径共用，未启动的组件停止时不做任何事）
+        启动失败时不写入快照，保留上一次的快照
+        """
         # 停止Socket服务
         if self.socket_service:
             self.socket_service.stop()
 
+        # 发布合并窗口中剩余的命令
+        if self.coalescer:
+            self.coalescer.stop()
+
         # 停止MQTT服务
         if self.mqtt_service:
             self.mqtt_service.stop()
 
-        self.running = False
-        logger.info("服务器已停止")
+        # 停止心跳流水线（处理完剩余心跳）
+        if self.heartbeats:
+            self.heartbeats.stop()
+        if self.detector:
+            self.detector.stop()
+
+        # 写入最后一次状态快照
+        if self.snapshot:
+            self.snapshot.stop(write=self.running)
+
+        # 关闭心跳归档
+        if self.archive:
+            self.archive.close()
+
+        # 关闭流量抓取
+        if self.recorder:
+            self.recorder.close()
 
     def run(self):
         """运行服务器（阻塞）"""
@@ -207,6 +369,7 @@ def main():
 
     # 创建并运行服务器
     server = MS500Server()
+    server.introspection.install_signal_handlers()
 
     try:
         success = server.run()
@@ -5,8 +5,10 @@ MQTT 消息发布
 负责转发 Backend Socket 命令到 MQTT
 """
 
-import json
+import time
 import logging
+from payload_codec import encode, ENCODING_JSON
+from introspection import STAGE_TIMERS
 
 logger = logging.getLogger(__name__)
 
@@ -14,51 +16,67 @@ logger = logging.getLogger(__name__)
 class MQTTPublisher:
     """MQTT 消息发布类 - 专门用于转发 Socket 命令"""
 
-    def __init__(self, mqtt_service):
+    def __init__(self, mqtt_service, codec=None):
         """
         初始化发布器
 
         Args:
             mqtt_service: MQTTService 实例
+            codec: 可选，PayloadCodec 实例，按 unit 选择命令编码，默认全部使用 JSON
         """
         self.mqtt_service = mqtt_service
+        self.codec = codec
 
-    def forward_socket_command(self, json_data):
+    def forward_socket_command(self, json_data, correlation=None):
         """
         转发 Backend 的 Socket 命令到设备
 
         Args:
             json_data: Backend 发送的 JSON 数据（dict）
+            correlation: 可选，SCS/UDS 请求的 Correlation Data（MQTT 5 模式下设备按它回复到响应主题）
 
         Returns:
             bool: 发送成功返回True
         """
-        # 提取 unit 字段（设备单元标识）
-        unit = json_data.get('unit')
-        if not unit:
-            logger.error("Socket命令缺少 'unit' 字段")
-            return False
+        started = time.perf_counter() if STAGE_TIMERS.enabled else None
+        try:
+            # 提取 unit 字段（设备单元标识）
+            unit = json_data.get('unit')
+            if not unit:
+                logger.error("Socket命令缺少 'unit' 字段")
+                return False
 
-        # 拼装 topic: /service/ms500/{unit}/socket
-        topic = f"/service/ms500/{unit}/socket"
-        print(topic)
+            # 拼装 topic: /service/ms500/{unit}/socket
+            topic = f"/service/ms500/{unit}/socket"
+            print(topic)
 
-        # 转换为JSON字符串
-        try:
-            json_payload = json.dumps(json_data, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"构建JSON失败: {e}")
-            return False
+            # 按 unit 的编码序列化（JSON / MessagePack / CBOR）
+            try:
+                if self.codec:
+                    payload, encoding = self.codec.encode_command(unit, json_data)
+                else:
+                    payload, encoding = encode(ENCODING_JSON, json_data), ENCODING_JSON
+            except Exception as e:
+                logger.error(f"构建命令数据失败: {e}")
+                return False
+
+            # 发布消息
+            success = self.mqtt_service.publish(topic, payload,
+                                                command_type=json_data.get('type', 'UNKNOWN'),
+                                                correlation=correlation)
 
-        # 发布消息
-        success = self.mqtt_service.publish(topic, json_payload)
+            if success:
+                logger.info(f"✓ Socket命令已转发到 MQTT")
+                logger.info(f"  主题: {topic}")
+                logger.info(f"  类型: {json_data.get('type', 'UNKNOWN')}")
+                logger.info(f"  设备: {unit}")
+                if encoding != ENCODING_JSON:
+                    logger.info(f"  编码: {encoding} ({len(payload)} 字节)")
+            else:
+                logger.error(f"✗ Socket命令转发失败")
 
-        if success:
-            logger.info(f"✓ Socket命令已转发到 MQTT")
-            logger.info(f"  主题: {topic}")
-            logger.info(f"  类型: {json_data.get('type', 'UNKNOWN')}")
-            logger.info(f"  设备: {unit}")
-        else:
-            logger.error(f"✗ Socket命令转发失败")
+            return success
 
-        return success
+        finally:
+            if started is not None:
+                STAGE_TIMERS.record('forward_socket_command', started)
@@ -6,10 +6,18 @@ MQTT 服务管理
 """
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import logging
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 from config import *
+from reply_stream import ReplyReassembler
+from traffic_capture import REC_PUBLISH, REC_DEVICE
+from topic_router import TopicRouter
+from introspection import STAGE_TIMERS
 
 logger = logging.getLogger(__name__)
 
@@ -17,17 +25,53 @@ logger = logging.getLogger(__name__)
 class MQTTService:
     """MQTT 服务管理类"""
 
-    def __init__(self):
-        """初始化 MQTT 服务"""
+    def __init__(self, client=None):
+        """
+        初始化 MQTT 服务
+
+        Args:
+            client: 可选，已创建的 MQTT 客户端（如 local_broker 的本地客户端），默认创建 paho 客户端
+        """
         self.client = None
         self.connected = False
         self.message_callback = None
         self.connect_callback = None
         self.socket_reply_callback = None  # Socket回复消息的回调
+        self.socket_reply_chunk_callback = None  # Socket分片回复的回调
+        self.recorder = None  # 流量记录器（可选）
+        self.cluster = None  # 集群协调器（可选，启用后设备主题使用共享订阅）
+        self.exclusive_filters = set()  # 集群模式下也不使用共享订阅的过滤器
+        self.codec = None  # 负载编码（可选，二进制编码的设备回复转为 JSON）
+
+        # MQTT 5 相关状态
+        self.mqtt_v5 = MQTT_PROTOCOL == "5"
+        self.topic_aliases = OrderedDict()  # topic → alias，按最近使用排序
+        self.topic_alias_maximum = 0  # 与 Broker 协商后的别名上限，连接成功后更新
+        self.alias_lock = threading.Lock()
+
+        # 分片回复重组器（按序号流式输出）
+        self.reply_reassembler = ReplyReassembler(self._emit_reply_chunk)
+
+        # 主题路由表，订阅也由路由表生成
+        self.router = TopicRouter()
+        self.router.add_route(SOCKET_REPLY_TOPIC, self._handle_socket_reply)
+        self.router.add_route(REPLY_CHUNK_TOPIC, self._handle_socket_reply_part)
+        for topic in SUBSCRIBE_TOPICS:
+            self.router.add_route(topic, self._handle_subscribed_message)
 
         # 创建 MQTT 客户端
-        client_id = f"{MQTT_CLIENT_ID_PREFIX}_{int(time.time())}"
-        self.client = mqtt.Client(client_id=client_id)
+        if client is None:
+            client_id = f"{MQTT_CLIENT_ID_PREFIX}_{int(time.time())}"
+            protocol = mqtt.MQTTv5 if self.mqtt_v5 else mqtt.MQTTv311
+            self.client = mqtt.Client(client_id=client_id, protocol=protocol)
+        else:
+            client_id = getattr(client, 'client_id', 'external')
+            self.client = client
+
+        # MQTT 5 请求/响应：SCS/UDS 回复发到本客户端专属的响应主题，按 Correlation Data 匹配请求
+        self.response_topic = MQTT_RESPONSE_TOPIC.format(client_id=client_id)
+        if self.mqtt_v5:
+            self.add_route(self.response_topic, self._handle_response, shared=False)
 
         # 设置回调函数
         self.client.on_connect = self._on_connect
@@ -36,16 +80,25 @@ class MQTTService:
 
         logger.info(f"MQTT 客户端已创建: {client_id}")
 
-    def _on_connect(self, client, userdata, flags, rc):
-        """MQTT 连接回调"""
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        """MQTT 连接回调（MQTT 5 时带 CONNACK 属性）"""
         if rc == 0:
             self.connected = True
             logger.info(f"✓ 成功连接到 MQTT Broker: {MQTT_BROKER}:{MQTT_PORT}")
 
-            # 订阅 ESP32 回复主题 (通配符订阅所有设备的回复)
-            reply_topic = "/device/ms500/+/socket_reply"
-            self.client.subscribe(reply_topic)
-            logger.info(f"✓ 已订阅 Socket 回复主题: {reply_topic}")
+            if self.mqtt_v5:
+                # 主题别名每个连接单独生效，重连后重新建立
+                broker_maximum = getattr(properties, 'TopicAliasMaximum', 0) or 0
+                with self.alias_lock:
+                    self.topic_aliases.clear()
+                    self.topic_alias_maximum = min(MQTT_TOPIC_ALIAS_MAXIMUM, broker_maximum)
+                logger.info(f"✓ MQTT 5 模式，主题别名上限: {self.topic_alias_maximum}")
+
+            # 按路由表订阅（ESP32 回复、分片回复、SUBSCRIBE_TOPICS 等）
+            filters = [self._subscription_filter(f) for f in self.router.get_filters()]
+            self.client.subscribe([(topic_filter, 0) for topic_filter in filters])
+            for topic_filter in filters:
+                logger.info(f"✓ 已订阅主题: {topic_filter}")
 
             # 调用外部连接回调
             if self.connect_callback:
@@ -55,7 +108,7 @@ class MQTTService:
             self.connected = False
             logger.error(f"✗ MQTT 连接失败，错误码: {rc}")
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         """MQTT 断开连接回调"""
         self.connected = False
         if rc != 0:
@@ -63,40 +116,133 @@ class MQTTService:
             logger.info("尝试重新连接...")
 
     def _on_message(self, client, userdata, msg):
-        """MQTT 消息回调"""
+        """MQTT 消息回调，按路由表分发"""
+        started = time.perf_counter() if STAGE_TIMERS.enabled else None
         try:
             topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-
-            # 判断是否是 Socket 回复消息
-            if "/socket_reply" in topic:
-                # 处理 Socket 回复消息
-                logger.info(f"📬 收到 ESP32 Socket 回复:")
-                logger.info(f"   主题: {topic}")
-                logger.debug(f"   数据: {payload[:200]}...")
-
-                # 从主题中提取 unit_sn
-                # topic格式: /device/ms500/{unit}/socket_reply
-                parts = topic.split('/')
-                if len(parts) >= 4:
-                    unit = parts[3]  # 提取 unit_sn
-
-                    # 调用 Socket 回复回调
-                    if self.socket_reply_callback:
-                        self.socket_reply_callback(unit, payload)
-                    else:
-                        logger.warning("Socket回复回调未设置，无法转发回复")
-                else:
-                    logger.error(f"无法从主题中提取 unit_sn: {topic}")
 
-            else:
-                # 其他类型的消息，调用通用回调
+            if self.recorder:
+                # 集群转发来的消息按原始设备主题记录，实例间协作消息不记录
+                device_topic = self.cluster.device_topic(topic) if self.cluster else topic
+                if device_topic:
+                    self.recorder.record(REC_DEVICE, device_topic, msg.payload)
+
+            # MQTT 5 响应消息带 Correlation Data，随提取结果一起传给处理函数
+            extra = None
+            if self.mqtt_v5:
+                correlation = getattr(getattr(msg, 'properties', None), 'CorrelationData', None)
+                if correlation is not None:
+                    extra = {'correlation': correlation}
+
+            if not self.router.dispatch(topic, msg.payload, extra):
+                # 未注册路由的消息，调用通用回调
                 if self.message_callback:
-                    self.message_callback(topic, payload)
+                    self.message_callback(topic, msg.payload.decode('utf-8'))
 
         except Exception as e:
             logger.error(f"处理 MQTT 消息时出错: {e}")
 
+        finally:
+            if started is not None:
+                STAGE_TIMERS.record('_on_message', started)
+
+    def _handle_socket_reply(self, topic, payload, captures):
+        """处理 Socket 回复消息（JSON 回复保持二进制不做解码，二进制编码的回复转为 JSON）"""
+        unit = captures['unit']
+
+        # 集群模式下，回复属于其他实例时转发过去
+        if self.cluster and not captures.get('forwarded') and \
+                self.cluster.forward_if_remote(unit, topic, payload):
+            return
+
+        payload = memoryview(payload)
+        if self.codec:
+            payload = self.codec.transcode_reply(unit, payload)
+        logger.info(f"📬 收到 ESP32 Socket 回复:")
+        logger.info(f"   主题: {topic}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"   数据: {bytes(payload[:200])!r}...")
+
+        # 调用 Socket 回复回调
+        if self.socket_reply_callback:
+            self.socket_reply_callback(unit, payload)
+        else:
+            logger.warning("Socket回复回调未设置，无法转发回复")
+
+    def _handle_response(self, topic, payload, captures):
+        """处理 MQTT 5 响应主题上的回复，按 Correlation Data 找到对应请求"""
+        correlation = captures.get('correlation')
+        if correlation is None:
+            logger.warning(f"⚠️ 响应消息缺少 Correlation Data，已忽略: {topic}")
+            return
+
+        logger.info(f"📬 收到 ESP32 响应 (correlation={correlation.hex()})")
+        payload = memoryview(payload)
+        if self.codec:
+            payload = self.codec.transcode_reply(None, payload)
+        if self.socket_reply_callback:
+            self.socket_reply_callback(None, payload, correlation)
+        else:
+            logger.warning("Socket回复回调未设置，无法转发回复")
+
+    def _handle_socket_reply_part(self, topic, payload, captures):
+        """处理分片回复，交给重组器按序流式输出"""
+        unit = captures['unit']
+        if self.cluster and not captures.get('forwarded') and \
+                self.cluster.forward_if_remote(unit, topic, payload):
+            return
+        self.reply_reassembler.feed(unit, payload)
+
+    def dispatch_forwarded(self, topic, payload):
+        """分发集群中其他实例转发来的消息，标记 forwarded 避免再次转发"""
+        for handler, captures in self.router.match(topic):
+            captures['forwarded'] = True
+            handler(topic, payload, captures)
+
+    def _handle_subscribed_message(self, topic, payload, captures):
+        """SUBSCRIBE_TOPICS 中的消息，调用通用回调"""
+        if self.message_callback:
+            self.message_callback(topic, payload.decode('utf-8'))
+
+    def _emit_reply_chunk(self, unit, reply_id, chunk, final):
+        """重组器输出回调，将按序排好的分片转发给 Socket"""
+        if self.socket_reply_chunk_callback:
+            self.socket_reply_chunk_callback(unit, chunk, final)
+        else:
+            logger.warning("Socket分片回复回调未设置，无法转发回复")
+
+    def add_route(self, pattern, handler, shared=True):
+        """
+        注册主题路由，已连接时立即订阅
+
+        Args:
+            pattern: 路由模式，如 "/device/ms500/{unit}/online"（见 topic_router）
+            handler: 处理函数，接收 (topic, payload, captures) 三个参数，payload 为 bytes
+            shared: 集群模式下是否使用共享订阅（实例间协作主题应为 False）
+        """
+        subscribed = self.router.get_filters()
+        topic_filter = self.router.add_route(pattern, handler)
+        if not shared:
+            self.exclusive_filters.add(topic_filter)
+        if self.connected and topic_filter not in subscribed:
+            topic_filter = self._subscription_filter(topic_filter)
+            self.client.subscribe(topic_filter)
+            logger.info(f"✓ 已订阅主题: {topic_filter}")
+
+    def _subscription_filter(self, topic_filter):
+        """集群模式下将设备主题转换为共享订阅"""
+        if self.cluster and topic_filter not in self.exclusive_filters:
+            return self.cluster.shared_filter(topic_filter)
+        return topic_filter
+
+    def set_cluster(self, cluster):
+        """设置集群协调器（需在连接前设置）"""
+        self.cluster = cluster
+
+    def set_codec(self, codec):
+        """设置负载编码，设备回复在转发给 Backend 前转为 JSON"""
+        self.codec = codec
+
     def set_message_callback(self, callback):
         """设置消息处理回调函数"""
         self.message_callback = callback
@@ -110,10 +256,24 @@ class MQTTService:
         设置 Socket 回复消息的回调函数
 
         Args:
-            callback: 回调函数，接收 (unit, payload) 两个参数
+            callback: 回调函数，接收 (unit, payload, correlation=None) 参数；
+                      MQTT 5 响应按 correlation 匹配时 unit 为 None
         """
         self.socket_reply_callback = callback
 
+    def set_socket_reply_chunk_callback(self, callback):
+        """
+        设置 Socket 分片回复的回调函数
+
+        Args:
+            callback: 回调函数，接收 (unit, chunk, final) 三个参数
+        """
+        self.socket_reply_chunk_callback = callback
+
+    def set_recorder(self, recorder):
+        """设置流量记录器（None 表示关闭抓取）"""
+        self.recorder = recorder
+
     def connect(self):
         """连接到 MQTT Broker"""
         try:
@@ -140,16 +300,31 @@ class MQTTService:
             self.connected = False
             logger.info("MQTT 服务已停止")
 
-    def publish(self, topic, payload):
-        """发布消息到 MQTT"""
+    def publish(self, topic, payload, retain=False, command_type=None, correlation=None):
+        """
+        发布消息到 MQTT
+
+        Args:
+            topic: 主题
+            payload: 数据
+            retain: 是否为保留消息
+            command_type: 设备命令类型；MQTT 5 模式下据此设置消息过期时间并使用主题别名
+            correlation: MQTT 5 模式下的 Correlation Data (bytes)，设备回复发到响应主题
+        """
         if not self.connected:
             logger.error("MQTT 未连接，无法发布消息")
             return False
 
         try:
-            result = self.client.publish(topic, payload)
+            if self.mqtt_v5 and command_type:
+                result = self._publish_v5(topic, payload, command_type, correlation)
+            else:
+                result = self.client.publish(topic, payload, retain=retain)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
                 logger.debug(f"消息已发布到主题: {topic}")
+                # 只记录设备命令，集群实例间的归属声明、编码同步和回复转发不是回放的预期输出
+                if self.recorder and command_type:
+                    self.recorder.record(REC_PUBLISH, topic, payload)
                 return True
             else:
                 logger.error(f"发布消息失败，错误码: {result.rc}")
@@ -158,6 +333,43 @@ class MQTTService:
             logger.error(f"发布消息时出错: {e}")
             return False
 
+    def _publish_v5(self, topic, payload, command_type, correlation):
+        """MQTT 5 发布设备命令：消息过期时间、响应主题、主题别名"""
+        properties = Properties(PacketTypes.PUBLISH)
+        expiry = MQTT_MESSAGE_EXPIRY.get(command_type, MQTT_MESSAGE_EXPIRY_DEFAULT)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+        if correlation is not None:
+            properties.ResponseTopic = self.response_topic
+            properties.CorrelationData = correlation
+
+        # 别名的建立和使用必须按发布顺序到达 Broker，因此加锁覆盖整个发布过程
+        with self.alias_lock:
+            if not self.topic_alias_maximum:
+                return self.client.publish(topic, payload, properties=properties)
+
+            alias = self.topic_aliases.get(topic)
+            if alias is not None:
+                # 已建立别名，只发送别名，主题为空
+                self.topic_aliases.move_to_end(topic)
+                properties.TopicAlias = alias
+                return self.client.publish("", payload, properties=properties)
+
+            evicted = None
+            if len(self.topic_aliases) < self.topic_alias_maximum:
+                alias = len(self.topic_aliases) + 1
+            else:
+                # 别名用完，复用最久未使用主题的别名
+                evicted = next(iter(self.topic_aliases))
+                alias = self.topic_aliases[evicted]
+            properties.TopicAlias = alias
+            result = self.client.publish(topic, payload, properties=properties)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                if evicted is not None:
+                    del self.topic_aliases[evicted]
+                self.topic_aliases[topic] = alias
+            return result
+
     def is_connected(self):
         """检查 MQTT 连接状态"""
         return self.connected
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多路复用 Socket 协议
+Backend 在一条持久连接上同时发送多个命令，回复按 stream_id 乱序返回
+
+连接建立后客户端先发送 5 字节握手: MUX_MAGIC + 版本号，服务端原样回送；
+服务端不支持该版本时回送自己的 MUX_HELLO 后关闭连接。
+之后双方收发的每一帧格式为:
+
+    type(uint8) + flags(uint8) + stream_id(uint32) + length(uint32) + body
+
+    REQUEST  Backend → 中转服务，body 为 JSON 命令
+    ACK      中转服务 → Backend，无回复命令（非 SCS/UDS）发布完成的确认，body 为 JSON
+    REPLY    中转服务 → Backend，设备回复原始数据；带 FLAG_MORE 表示后面还有分片
+    ERROR    中转服务 → Backend，命令失败或等待回复超时，body 为 JSON
+    EVENT    中转服务 → Backend，订阅的推送事件（如设备告警），stream_id 固定为 0，body 为 JSON
+"""
+
+import socket
+import struct
+import threading
+import queue
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 握手魔数与协议版本
+MUX_MAGIC = b'MS5M'
+MUX_VERSION = 1
+MUX_HELLO = MUX_MAGIC + bytes([MUX_VERSION])
+
+# 帧头: type(uint8) + flags(uint8) + stream_id(uint32) + length(uint32)，大端序
+FRAME_HEADER = struct.Struct('>BBII')
+
+# 帧类型
+FRAME_REQUEST = 1
+FRAME_ACK = 2
+FRAME_REPLY = 3
+FRAME_ERROR = 4
+FRAME_EVENT = 5
+
+# 推送事件使用的 stream_id（客户端分配的 stream_id 从 1 开始）
+EVENT_STREAM_ID = 0
+
+# 帧标志
+FLAG_MORE = 0x01  # 同一 stream 后续还有 REPLY 分片
+
+# 单帧最大长度
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16MB
+
+
+class FrameError(Exception):
+    """帧格式错误"""
+
+
+def send_frame(sock, frame_type, stream_id, body=b'', flags=0):
+    """
+    发送一帧数据
+    帧头和 body 通过 sendmsg 一次提交，body 不做拼接拷贝
+
+    Args:
+        sock: socket 对象（调用方负责并发发送时加锁）
+        frame_type: 帧类型
+        stream_id: 请求ID
+        body: 帧内容 (bytes 或 memoryview)
+        flags: 帧标志
+    """
+    header = FRAME_HEADER.pack(frame_type, flags, stream_id, len(body))
+    if not hasattr(sock, 'sendmsg'):
+        # Windows 不支持 sendmsg
+        sock.sendall(header)
+        if body:
+            sock.sendall(body)
+        return
+
+    buffers = [memoryview(header), memoryview(body)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # 处理部分发送，跳过已发送的数据
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+class FrameReader:
+    """增量帧解析器 - 从 recv 得到的数据流中切分出完整的帧"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """
+        追加数据并返回已完整接收的帧
+
+        Args:
+            data: 新接收的数据
+
+        Returns:
+            list: [(frame_type, flags, stream_id, body), ...]，body 为 bytes
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        size = len(self.buffer)
+
+        while size - offset >= FRAME_HEADER.size:
+            frame_type, flags, stream_id, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"帧长度超限: {length}")
+            end = offset + FRAME_HEADER.size + length
+            if end > size:
+                break
+            frames.append((frame_type, flags, stream_id, bytes(self.buffer[offset + FRAME_HEADER.size:end])))
+            offset = end
+
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class MuxClient:
+    """多路复用客户端 - 供 Backend 使用，一条持久连接并发发送多个命令"""
+
+    def __init__(self, host, port, timeout=30.0):
+        """
+        初始化并连接中转服务
+
+        Args:
+            host: 服务器地址
+            port: 服务器端口
+            timeout: 等待 ACK/REPLY 的默认超时时间（秒）
+        """
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port))
+        self.sock.sendall(MUX_HELLO)
+        hello = self._recv_exact(len(MUX_HELLO))
+        if hello != MUX_HELLO:
+            self.sock.close()
+            raise FrameError(f"握手失败: {hello!r}")
+
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}  # stream_id → _PendingStream
+        self.next_stream_id = 1
+        self.closed = False
+        self.reader_done = False  # 接收线程已退出（连接断开），之后的请求直接失败
+        self.events = queue.Queue()  # 推送事件 body (bytes)
+
+        self.reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader_thread.start()
+
+    def _recv_exact(self, size):
+        """接收指定长度的数据"""
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def submit(self, command):
+        """
+        发送命令但不等待结果
+
+        Args:
+            command: 命令数据（dict）
+
+        Returns:
+            _PendingStream: 可调用 wait() 获取结果
+        """
+        body = json.dumps(command, ensure_ascii=False).encode('utf-8')
+        with self.pending_lock:
+            stream_id = self.next_stream_id
+            self.next_stream_id = (self.next_stream_id % 0xFFFFFFFF) + 1
+            pending = _PendingStream(stream_id)
+            if self.closed or self.reader_done:
+                # 连接已断开，不再等待超时
+                pending.add(FRAME_ERROR, b'{"error": "connection closed"}', True)
+                return pending
+            self.pending[stream_id] = pending
+
+        try:
+            with self.send_lock:
+                send_frame(self.sock, FRAME_REQUEST, stream_id, body)
+        except OSError as e:
+            with self.pending_lock:
+                self.pending.pop(stream_id, None)
+            pending.add(FRAME_ERROR, json.dumps({"error": f"send failed: {e}"}).encode('utf-8'), True)
+        return pending
+
+    def request(self, command, timeout=None):
+        """
+        发送命令并等待结果
+
+        Returns:
+            tuple: (frame_type, body)，SCS/UDS 返回 REPLY 和设备回复，其他命令返回 ACK
+        """
+        return self.submit(command).wait(timeout or self.timeout)
+
+    def next_event(self, timeout=None):
+        """
+        获取一条推送事件
+
+        Returns:
+            dict: 事件内容，超时返回 None
+        """
+        try:
+            return json.loads(self.events.get(timeout=timeout))
+        except queue.Empty:
+            return None
+
+    def _read_loop(self):
+        """接收线程，按 stream_id 分发帧，推送事件放入事件队列"""
+        reader = FrameReader()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for frame_type, flags, stream_id, body in reader.feed(data):
+                    if frame_type == FRAME_EVENT:
+                        self.events.put(body)
+                        continue
+                    with self.pending_lock:
+                        pending = self.pending.get(stream_id)
+                        done = not (frame_type == FRAME_REPLY and flags & FLAG_MORE)
+                        if pending and done:
+                            del self.pending[stream_id]
+                    if pending:
+                        pending.add(frame_type, body, done)
+        except (OSError, FrameError) as e:
+            if not self.closed:
+                logger.error(f"多路复用连接接收出错: {e}")
+        finally:
+            # 连接断开，唤醒所有等待者
+            with self.pending_lock:
+                self.reader_done = True
+                waiting = list(self.pending.values())
+                self.pending.clear()
+            for pending in waiting:
+                pending.add(FRAME_ERROR, b'{"error": "connection closed"}', True)
+
+    def close(self):
+        """关闭连接（先 shutdown，唤醒阻塞在 recv 中的接收线程并通知服务端）"""
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class _PendingStream:
+    """等待中的请求"""
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.frame_type = None
+        self.parts = []
+        self.event = threading.Event()
+
+    def add(self, frame_type, body, done):
+        self.frame_type = frame_type
+        self.parts.append(body)
+        if done:
+            self.event.set()
+
+    def wait(self, timeout=None):
+        """等待结果，超时返回 (None, b'')"""
+        if not self.event.wait(timeout):
+            return None, b''
+        return self.frame_type, b''.join(self.parts)
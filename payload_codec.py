@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备负载编码
+按 unit 选择发往设备的命令编码（JSON / MessagePack / CBOR），Backend 始终使用 JSON，
+中转服务在 MQTT 边界转码
+
+unit 的编码来源（优先级从高到低）:
+    1. Backend 发送的 ENC 本地命令或 config.UNIT_PAYLOAD_ENCODING
+    2. 设备心跳中的 "encoding" 字段（字符串或按偏好排序的列表）；
+       集群模式下心跳由各实例分摊，学到的编码通过 cluster 的保留消息同步给其他实例
+    3. config.DEFAULT_PAYLOAD_ENCODING
+"""
+
+import json
+import base64
+import threading
+import logging
+from config import *
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_CBOR = "cbor"
+
+
+def available_encodings():
+    """返回当前环境可用的编码（msgpack/cbor 需安装对应的可选依赖）"""
+    encodings = [ENCODING_JSON]
+    if msgpack is not None:
+        encodings.append(ENCODING_MSGPACK)
+    if cbor2 is not None:
+        encodings.append(ENCODING_CBOR)
+    return encodings
+
+
+def encode(encoding, data):
+    """
+    按指定编码序列化
+
+    Returns:
+        str 或 bytes: JSON 返回 str，二进制编码返回 bytes
+    """
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    if encoding == ENCODING_CBOR:
+        return cbor2.dumps(data)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def decode(encoding, payload):
+    """按指定编码反序列化"""
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    if encoding == ENCODING_CBOR:
+        return cbor2.loads(payload)
+    return json.loads(payload)
+
+
+def _json_default(value):
+    """二进制编码中的 bytes 值在 JSON 中以 base64 字符串表示"""
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"无法转为 JSON 的类型: {type(value).__name__}")
+
+
+def _looks_like_json(payload):
+    """JSON 文本以 { 或 [ 开头（允许前导空白）"""
+    for byte in payload[:16]:
+        if byte in b' \t\r\n':
+            continue
+        return byte in b'{['
+    return False
+
+
+class PayloadCodec:
+    """负载编码类 - 维护每个 unit 的编码并在 MQTT 边界转码"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.available = available_encodings()
+        self.configured = {}  # unit → 编码（配置或 Backend 指定）
+        self.advertised = {}  # unit → 编码（设备心跳声明）
+        self.advertise_callbacks = []  # 心跳中学到新编码时调用 (unit, encoding)
+
+        for unit, encoding in UNIT_PAYLOAD_ENCODING.items():
+            self.set_encoding(unit, encoding)
+
+        if DEFAULT_PAYLOAD_ENCODING not in self.available:
+            logger.warning(f"⚠️ 默认编码 {DEFAULT_PAYLOAD_ENCODING} 不可用（缺少依赖），使用 JSON")
+            self.default = ENCODING_JSON
+        else:
+            self.default = DEFAULT_PAYLOAD_ENCODING
+
+    def set_encoding(self, unit, encoding):
+        """
+        指定 unit 的编码
+
+        Args:
+            unit: 设备单元标识
+            encoding: json/msgpack/cbor，None 表示取消指定
+
+        Returns:
+            bool: 编码可用返回True
+        """
+        with self.lock:
+            if encoding is None:
+                self.configured.pop(unit, None)
+                return True
+            if encoding not in self.available:
+                logger.error(f"✗ 编码 {encoding} 不可用 (unit={unit})，可用: {self.available}")
+                return False
+            self.configured[unit] = encoding
+        return True
+
+    def add_advertise_callback(self, callback):
+        """
+        注册编码学习回调（集群模式下同步给其他实例）
+
+        Args:
+            callback: 回调函数，接收 (unit, encoding)
+        """
+        self.advertise_callbacks.append(callback)
+
+    def set_advertised(self, unit, encoding):
+        """
+        设置其他实例从心跳中学到的编码（不触发编码学习回调）
+
+        Args:
+            unit: 设备单元标识
+            encoding: 编码，None 表示清除；本地不可用的编码忽略
+        """
+        with self.lock:
+            if encoding is None:
+                self.advertised.pop(unit, None)
+            elif encoding in self.available:
+                self.advertised[unit] = encoding
+
+    def get_encoding(self, unit):
+        """返回 unit 当前使用的编码"""
+        with self.lock:
+            return self.configured.get(unit) or self.advertised.get(unit) or self.default
+
+    def observe_heartbeat(self, unit, data):
+        """
+        从设备心跳中学习 unit 支持的编码
+
+        Args:
+            unit: 设备单元标识
+            data: 已解析的心跳数据 (dict)
+        """
+        advertised = data.get('encoding')
+        if not advertised:
+            return
+        if isinstance(advertised, str):
+            advertised = [advertised]
+
+        # 设备按偏好排序，取第一个本地可用的编码
+        for encoding in advertised:
+            if encoding in self.available:
+                with self.lock:
+                    previous = self.advertised.get(unit)
+                    self.advertised[unit] = encoding
+                if previous != encoding:
+                    logger.info(f"✓ 设备 {unit} 声明使用编码: {encoding}")
+                    for callback in self.advertise_callbacks:
+                        try:
+                            callback(unit, encoding)
+                        except Exception as e:
+                            logger.error(f"✗ 编码学习回调出错 (unit={unit}): {e}")
+                return
+
+    def update_batch(self, batch):
+        """心跳流水线消费者，只处理声明了 encoding 的心跳"""
+        for unit, received_at, data in batch:
+            if 'encoding' in data:
+                self.observe_heartbeat(unit, data)
+
+    def dump_snapshot(self, writer):
+        """导出快照段（unit 和编码各写成一列，10 万台设备时不做一次性的 JSON 序列化）"""
+        with self.lock:
+            tables = [list(self.configured.items()), list(self.advertised.items())]
+        for items in tables:
+            writer.strings([unit for unit, _ in items])
+            writer.strings([encoding for _, encoding in items])
+
+    def load_snapshot(self, reader):
+        """导入快照段，配置文件中的 UNIT_PAYLOAD_ENCODING 优先，本地不可用的编码跳过"""
+        tables = [(reader.strings(), reader.strings()) for _ in range(2)]
+        with self.lock:
+            for (units, encodings), table in zip(tables, (self.configured, self.advertised)):
+                for unit, encoding in zip(units, encodings):
+                    if encoding in self.available and unit not in table:
+                        table[unit] = encoding
+
+    def cmd_encoding(self, conn, json_data):
+        """
+        ENC 本地命令：查询或指定 unit 的编码
+        {"type": "ENC", "unit": "...", "encoding": "cbor"} 指定，"encoding": null 取消指定，
+        不带 encoding 字段时只查询，不带 unit 时返回统计
+        """
+        unit = json_data.get('unit')
+        if not unit:
+            return {"type": "ENC", "ok": True, **self.get_stats()}
+
+        ok = True
+        if 'encoding' in json_data:
+            ok = self.set_encoding(unit, json_data['encoding'])
+        return {"type": "ENC", "ok": ok, "unit": unit, "encoding": self.get_encoding(unit)}
+
+    def encode_command(self, unit, json_data):
+        """
+        按 unit 的编码序列化发往设备的命令
+
+        Returns:
+            tuple: (payload, encoding)
+        """
+        encoding = self.get_encoding(unit)
+        return encode(encoding, json_data), encoding
+
+    def transcode_reply(self, unit, payload):
+        """
+        将设备回复转为 Backend 使用的 JSON
+        JSON 回复原样返回（不拷贝），二进制回复解码后重新编码为 JSON（bytes 值转为 base64 字符串）；
+        无法转为 JSON 时原样转发
+
+        Args:
+            unit: 设备单元标识（按 Correlation Data 匹配时可为 None）
+            payload: 设备回复 (bytes 或 memoryview)
+
+        Returns:
+            bytes 或 memoryview: JSON 数据
+        """
+        if _looks_like_json(payload):
+            return payload
+
+        encoding = self.get_encoding(unit) if unit else None
+        candidates = [encoding] if encoding and encoding != ENCODING_JSON else \
+            [e for e in self.available if e != ENCODING_JSON]
+        for candidate in candidates:
+            try:
+                data = decode(candidate, bytes(payload))
+            except Exception:
+                continue
+            try:
+                return json.dumps(data, ensure_ascii=False, default=_json_default).encode('utf-8')
+            except (TypeError, ValueError) as e:
+                logger.warning(f"⚠️ 设备回复无法转为 JSON，原样转发 (unit={unit}): {e}")
+                return payload
+
+        logger.warning(f"⚠️ 无法识别设备回复编码，原样转发 (unit={unit})")
+        return payload
+
+    def get_stats(self):
+        """返回各编码的 unit 数量"""
+        with self.lock:
+            units = set(self.configured) | set(self.advertised)
+            counts = {}
+            for unit in units:
+                encoding = self.configured.get(unit) or self.advertised.get(unit)
+                counts[encoding] = counts.get(encoding, 0) + 1
+        return {"default": self.default, "available": self.available, "units": counts}
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量回放工具
+将 traffic_capture 抓取的流量按原始时间间隔（可加速）回放到一个使用本地 Broker 替身的中转服务，
+用于问题复现、回归测试和容量测试
+
+用法:
+    python replay_tool.py capture.bin                # 1× 原速回放
+    python replay_tool.py capture.bin --speed 10     # 10× 加速
+    python replay_tool.py capture.bin --speed 0      # 不等待，最大速度
+
+限制:
+    MQTT 5 模式下设备回复发到中转服务的响应主题并按 Correlation Data 匹配请求，
+    抓取文件不记录 Correlation Data（回放时中转服务也会生成新的值），这类回复无法回放，
+    对应的 SCS/UDS 请求在回放中超时；回放 MQTT 5 模式的抓取时只有命令发布和心跳有参考价值
+"""
+
+import sys
+import time
+import json
+import argparse
+import threading
+import logging
+from main import MS500Server
+from local_broker import LocalBroker
+from mux_protocol import MuxClient, FRAME_ACK, FRAME_REPLY, FRAME_ERROR
+from traffic_capture import read_capture, REC_COMMAND, REC_PUBLISH, REC_DEVICE
+
+logger = logging.getLogger(__name__)
+
+# 回放中转服务使用的 Socket 端口（避免与正在运行的中转服务冲突）
+REPLAY_SOCKET_PORT = 16080
+# 设备替身订阅的命令主题，只有这些发布计入预期输出
+COMMAND_TOPIC_PREFIX = "/service/ms500/"
+
+
+class ReplayStats:
+    """回放统计"""
+
+    def __init__(self):
+        self.commands = 0
+        self.device_messages = 0
+        self.expected_publishes = 0
+        self.observed_publishes = 0
+        self.acks = 0
+        self.replies = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.publish_cond = threading.Condition()
+
+    def count_publish(self):
+        with self.publish_cond:
+            self.observed_publishes += 1
+            self.publish_cond.notify_all()
+
+    def wait_publishes(self, count, timeout):
+        """等待中转服务的 MQTT 发布数达到 count，保持与抓取时相同的因果顺序"""
+        with self.publish_cond:
+            return self.publish_cond.wait_for(lambda: self.observed_publishes >= count, timeout)
+
+
+def replay(capture_path, speed=1.0, socket_port=REPLAY_SOCKET_PORT, wait_timeout=10.0):
+    """
+    回放抓取文件
+
+    Args:
+        capture_path: 抓取文件路径
+        speed: 回放倍速，0 表示不等待（最大速度）
+        socket_port: 回放中转服务的 Socket 端口
+        wait_timeout: 回放结束后等待剩余结果的时间（秒）
+
+    Returns:
+        ReplayStats: 回放统计
+    """
+    stats = ReplayStats()
+    broker = LocalBroker()
+
+    # 设备替身：统计中转服务发布的命令，并注入抓取到的设备消息
+    device = broker.create_client("replay_device")
+    device.on_message = lambda client, userdata, msg: stats.count_publish()
+    device.connect()
+    device.subscribe(COMMAND_TOPIC_PREFIX + "#")
+    device.loop_start()
+
+    server = MS500Server(mqtt_client=broker.create_client("replay_bridge"),
+                         socket_host="127.0.0.1", socket_port=socket_port, capture_file=None)
+    if not server.start():
+        logger.error("回放中转服务启动失败")
+        return stats
+
+    clients = {}  # 抓取中的 Backend 连接 → 回放连接
+    streams = []
+    base_ns = 0
+    last_ns = 0
+    start = time.monotonic()
+
+    try:
+        for kind, t_ns, key, payload in read_capture(capture_path):
+            # 追加写入的抓取段时间从 0 重新开始，接到上一段末尾
+            if t_ns + base_ns < last_ns:
+                base_ns = last_ns
+            t_ns += base_ns
+            last_ns = t_ns
+
+            if speed > 0:
+                delay = t_ns / 1e9 / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if kind == REC_COMMAND:
+                client = clients.get(key)
+                if client is None:
+                    client = MuxClient("127.0.0.1", socket_port, timeout=wait_timeout)
+                    clients[key] = client
+                try:
+                    streams.append(client.submit(json.loads(payload)))
+                    stats.commands += 1
+                except ValueError as e:
+                    logger.warning(f"⚠️ 跳过无效命令记录 ({key}): {e}")
+            elif kind == REC_DEVICE:
+                # 抓取中设备消息之前的命令必须先发布出去，否则回复会早于请求到达
+                if not stats.wait_publishes(stats.expected_publishes, wait_timeout):
+                    logger.warning(f"⚠️ 等待命令发布超时，继续回放设备消息: {key}")
+                device.publish(key, payload)
+                stats.device_messages += 1
+            elif kind == REC_PUBLISH and key.startswith(COMMAND_TOPIC_PREFIX):
+                # 旧抓取文件中可能有集群实例间的发布，设备替身收不到，不计入
+                stats.expected_publishes += 1
+
+        # 等待剩余的 ACK/REPLY
+        for stream in streams:
+            frame_type, _ = stream.wait(wait_timeout)
+            if frame_type == FRAME_ACK:
+                stats.acks += 1
+            elif frame_type == FRAME_REPLY:
+                stats.replies += 1
+            elif frame_type == FRAME_ERROR:
+                stats.errors += 1
+            else:
+                stats.timeouts += 1
+
+    finally:
+        elapsed = time.monotonic() - start
+        for client in clients.values():
+            client.close()
+        server.stop()
+        device.loop_stop()
+        device.disconnect()
+
+    print("=" * 60)
+    print(f"回放完成: {capture_path} (倍速: {'最大' if speed <= 0 else f'{speed:g}×'})")
+    print(f"  用时: {elapsed:.3f}s，原始时长: {last_ns / 1e9:.3f}s")
+    print(f"  Backend 命令: {stats.commands} ({stats.commands / max(elapsed, 1e-9):.0f}/s)")
+    print(f"  设备消息: {stats.device_messages}")
+    print(f"  MQTT 发布: {stats.observed_publishes} (抓取时 {stats.expected_publishes})")
+    print(f"  ACK: {stats.acks}  REPLY: {stats.replies}  ERROR: {stats.errors}  超时: {stats.timeouts}")
+    print("=" * 60)
+    return stats
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(
+        description="MS500 中转服务流量回放工具",
+        epilog="限制: MQTT 5 响应主题上的设备回复按 Correlation Data 匹配，抓取文件不记录它，这类回复无法回放")
+    parser.add_argument("capture", help="抓取文件路径 (config.CAPTURE_FILE)")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0 表示最大速度 (默认 1)")
+    parser.add_argument("--port", type=int, default=REPLAY_SOCKET_PORT, help="回放中转服务 Socket 端口")
+    parser.add_argument("--wait", type=float, default=10.0, help="回放结束后等待结果的时间（秒）")
+    args = parser.parse_args()
+
+    stats = replay(args.capture, args.speed, args.port, args.wait)
+    sys.exit(0 if stats.errors == 0 and stats.timeouts == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
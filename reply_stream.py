@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备分片回复重组
+按序号重组 ESP32 的多分片回复（如 IMG 图片、SCS 设置），并按到达顺序流式转发
+"""
+
+import struct
+import threading
+import time
+import logging
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# 分片头: reply_id(uint32) + seq(uint16, 从0开始) + total(uint16)，大端序
+CHUNK_HEADER = struct.Struct('>IHH')
+
+
+class _PartialReply:
+    """单个分片回复的重组状态"""
+
+    __slots__ = ('total', 'next_seq', 'pending', 'pending_bytes', 'updated')
+
+    def __init__(self, total):
+        self.total = total
+        self.next_seq = 0
+        self.pending = {}        # 乱序到达的分片: seq → memoryview
+        self.pending_bytes = 0
+        self.updated = time.monotonic()
+
+
+class ReplyReassembler:
+    """分片回复重组类 - 按序号排序后流式输出，不做整体拼接"""
+
+    def __init__(self, emit_callback):
+        """
+        初始化重组器
+
+        Args:
+            emit_callback: 输出回调，接收 (unit, reply_id, chunk, final) 四个参数，
+                           chunk 为 memoryview，final 表示是否为最后一个分片
+        """
+        self.emit_callback = emit_callback
+        self.partials = {}  # (unit, reply_id) → _PartialReply
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def feed(self, unit, payload):
+        """
+        处理一个分片
+
+        Args:
+            unit: 设备单元标识
+            payload: 分片原始数据（bytes 或 memoryview，包含分片头）
+
+        Returns:
+            bool: 分片有效返回True
+        """
+        view = memoryview(payload)
+        if len(view) < CHUNK_HEADER.size:
+            logger.error(f"✗ 分片数据过短 (unit={unit}, len={len(view)})")
+            return False
+
+        reply_id, seq, total = CHUNK_HEADER.unpack_from(view)
+        chunk = view[CHUNK_HEADER.size:]
+
+        if total == 0 or seq >= total:
+            logger.error(f"✗ 分片序号无效 (unit={unit}, reply_id={reply_id}, seq={seq}, total={total})")
+            return False
+
+        ready = []
+        key = (unit, reply_id)
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_sweep >= REPLY_CHUNK_TIMEOUT:
+                self._sweep(now)
+
+            partial = self.partials.get(key)
+            if partial is None:
+                partial = _PartialReply(total)
+                self.partials[key] = partial
+            partial.updated = now
+
+            if seq < partial.next_seq or seq in partial.pending:
+                logger.debug(f"丢弃重复分片 (unit={unit}, reply_id={reply_id}, seq={seq})")
+                return True
+
+            if seq > partial.next_seq:
+                # 乱序分片，暂存等待前序分片
+                if partial.pending_bytes + len(chunk) > REPLY_CHUNK_MAX_BUFFERED:
+                    logger.error(f"✗ 分片缓存超限，放弃重组 (unit={unit}, reply_id={reply_id})")
+                    del self.partials[key]
+                    return False
+                partial.pending[seq] = chunk
+                partial.pending_bytes += len(chunk)
+                return True
+
+            # 按序输出当前分片以及之后已经到达的连续分片
+            ready.append(chunk)
+            partial.next_seq += 1
+            while partial.next_seq in partial.pending:
+                buffered = partial.pending.pop(partial.next_seq)
+                partial.pending_bytes -= len(buffered)
+                ready.append(buffered)
+                partial.next_seq += 1
+
+            finished = partial.next_seq >= partial.total
+            if finished:
+                del self.partials[key]
+
+        # 在锁外输出，避免 Socket 发送阻塞其他分片
+        last = len(ready) - 1
+        for i, part in enumerate(ready):
+            self.emit_callback(unit, reply_id, part, finished and i == last)
+
+        return True
+
+    def _sweep(self, now):
+        """清理超时未完成的重组状态（调用方持有锁）"""
+        self.last_sweep = now
+        expired = [key for key, partial in self.partials.items()
+                   if now - partial.updated >= REPLY_CHUNK_TIMEOUT]
+        for key in expired:
+            partial = self.partials.pop(key)
+            logger.warning(f"⚠️ 分片回复超时未完成，已丢弃 (unit={key[0]}, reply_id={key[1]}, "
+                           f"进度={partial.next_seq}/{partial.total})")
+
+    def pending_count(self):
+        """返回正在重组的回复数量"""
+        with self.lock:
+            return len(self.partials)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态快照与热启动
+定期把设备注册表、负载编码、异常检测基线和在线设备等状态写入二进制快照，
+启动时加载，重启后的实例立即恢复路由和检测所需的设备信息
+
+文件格式:
+    MAGIC(8) + 段... + crc32(uint32)
+    段:   tag(4) + length(uint32) + 字段...
+    字段: kind(1) + length(uint32) + data
+          S  字符串列表（UTF-8，以 \\0 分隔，MQTT 主题中不允许出现 \\0）
+          A  定长数组（首字节为 array 类型码，小端序）
+          J  JSON
+
+一组值（如所有设备心跳中的同一字段）按 column_kind() 判断的类型用 column() 写成一个字段:
+    bool / int / float 写成定长数组，str 写成字符串列表，其余类型写成 JSON
+避免对大量 dict 做一次性的 json.dumps / json.loads（C 实现不释放 GIL，10 万台设备时会停顿数百毫秒）
+
+写入时先写临时文件并 fsync，再 os.replace 原子替换，进程在任何时刻退出都不会留下半个快照。
+各组件只在锁内复制引用，序列化和写盘在快照线程中进行，不阻塞命令和心跳处理。
+Backend 的 Socket 连接无法跨进程保留，unit → socket 映射和等待中的请求不在快照中
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import threading
+import logging
+from array import array
+from config import *
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'MS5SNP\x00\x02'
+SECTION_HEADER = struct.Struct('<4sI')
+FIELD_HEADER = struct.Struct('<cI')
+CRC = struct.Struct('<I')
+
+KIND_STRINGS = b'S'
+KIND_ARRAY = b'A'
+KIND_JSON = b'J'
+
+# column() 的列类型
+COLUMN_BOOL = 'bool'
+COLUMN_INT = 'int'
+COLUMN_FLOAT = 'float'
+COLUMN_STR = 'str'
+COLUMN_JSON = 'json'
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+# JSON 列每次序列化的值个数
+JSON_CHUNK_SIZE = 1000
+
+
+def column_kind(values):
+    """
+    判断一组值写入快照时的列类型: 同一类型的 bool / int / float / str 写成数组或字符串列表，其余写成 JSON
+
+    Returns:
+        str: COLUMN_*
+    """
+    types = set(map(type, values))
+    if len(types) == 1:
+        kind = types.pop()
+        if kind is bool:
+            return COLUMN_BOOL
+        if kind is int and INT64_MIN <= min(values) and max(values) <= INT64_MAX:
+            return COLUMN_INT
+        if kind is float:
+            return COLUMN_FLOAT
+        if kind is str and not any('\0' in value for value in values):
+            return COLUMN_STR
+    return COLUMN_JSON
+
+
+class SnapshotWriter:
+    """段内字段写入"""
+
+    def __init__(self):
+        self.parts = []
+
+    def _field(self, kind, data):
+        self.parts.append(FIELD_HEADER.pack(kind, len(data)))
+        self.parts.append(data)
+
+    def strings(self, values):
+        self._field(KIND_STRINGS, '\0'.join(values).encode('utf-8'))
+
+    def array(self, typecode, values):
+        values = values if isinstance(values, array) else array(typecode, values)
+        if sys.byteorder != 'little':
+            values = array(typecode, values)
+            values.byteswap()
+        self._field(KIND_ARRAY, typecode.encode('ascii') + values.tobytes())
+
+    def json(self, value):
+        self._field(KIND_JSON, json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def column(self, kind, values):
+        """
+        写入一列
+
+        Args:
+            kind: 列类型（column_kind 的返回值）
+            values: 值列表
+        """
+        if kind == COLUMN_BOOL:
+            self.array('B', values)
+        elif kind == COLUMN_INT:
+            self.array('q', values)
+        elif kind == COLUMN_FLOAT:
+            self.array('d', values)
+        elif kind == COLUMN_STR:
+            self.strings(values)
+        else:
+            # 分块序列化，块之间其他线程可以拿到 GIL
+            chunks = (json.dumps(values[i:i + JSON_CHUNK_SIZE], ensure_ascii=False, separators=(',', ':'))[1:-1]
+                      for i in range(0, len(values), JSON_CHUNK_SIZE))
+            self._field(KIND_JSON, f"[{','.join(chunks)}]".encode('utf-8'))
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class SnapshotReader:
+    """段内字段读取（顺序与写入一致）"""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def _field(self, expected):
+        kind, length = FIELD_HEADER.unpack_from(self.data, self.offset)
+        if kind != expected:
+            raise ValueError(f"快照字段类型不符: {kind!r} != {expected!r}")
+        start = self.offset + FIELD_HEADER.size
+        self.offset = start + length
+        return self.data[start:self.offset]
+
+    def strings(self):
+        data = bytes(self._field(KIND_STRINGS))
+        return data.decode('utf-8').split('\0') if data else []
+
+    def array(self):
+        data = self._field(KIND_ARRAY)
+        values = array(chr(data[0]))
+        values.frombytes(data[1:])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def json(self):
+        return json.loads(bytes(self._field(KIND_JSON)))
+
+    def column(self, kind, count):
+        """
+        读取 SnapshotWriter.column 写入的一列
+
+        Args:
+            kind: 写入时返回的列类型
+            count: 值的个数
+
+        Returns:
+            list: 值列表
+        """
+        if kind == COLUMN_BOOL:
+            return [bool(value) for value in self.array()]
+        if kind in (COLUMN_INT, COLUMN_FLOAT):
+            return self.array().tolist()
+        if kind == COLUMN_STR:
+            # 只有一个空字符串时写入的数据为空
+            return self.strings() or [''] * count
+        return self.json()
+
+
+class SnapshotManager:
+    """快照管理类 - 组件按段注册导出/导入函数"""
+
+    def __init__(self, path=SNAPSHOT_FILE, interval=SNAPSHOT_INTERVAL):
+        """
+        Args:
+            path: 快照文件路径
+            interval: 定期快照间隔（秒）
+        """
+        self.path = path
+        self.interval = interval
+        self.sections = []  # (tag, dump(writer), load(reader))
+        self.stop_event = threading.Event()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.last_written = None
+        self.last_duration = None
+        self.last_size = 0
+
+    def add_section(self, tag, dump, load):
+        """
+        注册快照段
+
+        Args:
+            tag: 4 字节段标识，如 b'DEVS'
+            dump: 导出函数，接收 SnapshotWriter（锁内只复制引用，序列化在锁外）
+            load: 导入函数，接收 SnapshotReader
+        """
+        self.sections.append((tag, dump, load))
+
+    def start(self):
+        """启动定期快照线程"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self.thread.start()
+        logger.info(f"✓ 状态快照已启用: {self.path}（每 {self.interval}s）")
+
+    def stop(self, write=True):
+        """
+        停止定期快照并写入最后一次快照
+
+        Args:
+            write: 是否写入最后一次快照（服务启动失败时为 False，保留原有快照）
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=self.interval + 5)
+            self.thread = None
+        if write:
+            self.write()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """
+        写入快照（临时文件 + fsync + 原子替换）
+
+        Returns:
+            bool: 写入成功返回True
+        """
+        with self.write_lock:
+            started = time.perf_counter()
+            try:
+                parts = [SNAPSHOT_MAGIC]
+                for tag, dump, _ in self.sections:
+                    writer = SnapshotWriter()
+                    dump(writer)
+                    body = writer.getvalue()
+                    parts.append(SECTION_HEADER.pack(tag, len(body)))
+                    parts.append(body)
+                crc = 0
+                for part in parts:
+                    crc = zlib.crc32(part, crc)
+                parts.append(CRC.pack(crc))
+
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.writelines(parts)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._fsync_dir(directory)
+            except Exception as e:
+                logger.error(f"✗ 写入状态快照失败: {e}")
+                return False
+
+            self.last_written = time.time()
+            self.last_duration = time.perf_counter() - started
+            self.last_size = sum(len(part) for part in parts)
+            logger.debug(f"状态快照已写入: {self.last_size} 字节, {self.last_duration * 1000:.1f}ms")
+            return True
+
+    @staticmethod
+    def _fsync_dir(directory):
+        """同步目录项，保证替换后的文件名落盘（部分平台不支持打开目录）"""
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def load(self):
+        """
+        加载快照，校验失败或文件不存在时跳过
+
+        Returns:
+            bool: 加载成功返回True
+        """
+        if not os.path.exists(self.path):
+            logger.info(f"状态快照不存在，冷启动: {self.path}")
+            return False
+
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if not data.startswith(SNAPSHOT_MAGIC) or len(data) < len(SNAPSHOT_MAGIC) + CRC.size:
+                raise ValueError("文件头不符")
+            crc, = CRC.unpack_from(data, len(data) - CRC.size)
+            if zlib.crc32(memoryview(data)[:-CRC.size]) != crc:
+                raise ValueError("校验和不符")
+
+            sections = {}
+            offset = len(SNAPSHOT_MAGIC)
+            end = len(data) - CRC.size
+            while offset < end:
+                tag, length = SECTION_HEADER.unpack_from(data, offset)
+                offset += SECTION_HEADER.size
+                sections[tag] = memoryview(data)[offset:offset + length]
+                offset += length
+        except Exception as e:
+            logger.error(f"✗ 状态快照无效，冷启动 ({self.path}): {e}")
+            return False
+
+        # 恢复时一次性创建大量长期存活的对象，暂停分代回收避免反复全量扫描
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for tag, _, load in self.sections:
+                body = sections.get(tag)
+                if body is None:
+                    continue
+                try:
+                    load(SnapshotReader(body))
+                except Exception as e:
+                    logger.error(f"✗ 恢复快照段 {tag.decode()} 失败: {e}")
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        age = time.time() - os.path.getmtime(self.path)
+        logger.info(f"✓ 已从状态快照恢复 ({len(data)} 字节, 耗时 {(time.perf_counter() - started) * 1000:.0f}ms, "
+                    f"快照时间 {age:.0f}s 前)")
+        return True
+
+    def get_stats(self):
+        return {"path": self.path, "last_written": self.last_written,
+                "last_duration_ms": round(self.last_duration * 1000, 1) if self.last_duration else None,
+                "size": self.last_size}
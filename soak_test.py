@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+长时间浸泡测试
+在本地 Broker 替身上运行中转服务，持续制造 Backend 连接的建立与断开、混合命令、设备回复和心跳，
+定期采样 RSS、线程数、打开的文件描述符和各映射表大小，检查是否存在持续增长（泄漏）
+
+模拟的场景:
+    多路复用 / 传统连接交替建立和断开，连接上发送 TEST_COMMANDS_CONFIG 中的混合命令
+    设备替身回复 SCS/UDS，部分回复丢弃（等待超时）、部分分片、部分分片不完整（重组超时）
+    部分连接发送 SCS/UDS 后立即断开（设备回复发往已断开的连接）
+    部分多路复用连接订阅事件后断开
+    设备替身持续发送心跳
+
+用法:
+    python soak_test.py                                   # 默认 2 小时
+    python soak_test.py --duration 600 --cps 20 --rps 500 # 10 分钟，每秒 20 个连接、500 条命令
+    python soak_test.py --report soak.csv                 # 指定时间序列报告文件
+
+判定: 预热期之后把采样分为前后三段，最后一段的中位数比第一段高出的量超过
+"每小时允许增长 × 间隔小时数 + 容差" 时判定为持续增长；中转服务停止后线程或文件描述符
+没有回到启动前的数量也判定为泄漏。任一项不通过时退出码为 1
+"""
+
+import gc
+import os
+import csv
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import statistics
+import logging
+from config import *
+from main import MS500Server
+from local_broker import LocalBroker
+from mux_protocol import MuxClient, FrameError
+from reply_stream import CHUNK_HEADER
+from test_client import TEST_COMMANDS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 浸泡测试中转服务使用的 Socket 端口（避免与正在运行的中转服务冲突）
+SOAK_SOCKET_PORT = 16180
+
+# 需要设备回复的命令
+REPLY_TYPES = ('SCS', 'UDS')
+
+# 指标 → (每小时允许增长, 容差)；未列出的指标只记录不判定（如 devices 随设备数增长到上限）
+GROWTH_LIMITS = {
+    "rss_kb": (16 * 1024, 8 * 1024),
+    "threads": (2, 4),
+    "fds": (4, 8),
+    "py_objects": (20000, 20000),
+    "connections": (2, 8),
+    "unit_socket_map": (2, 8),
+    "pending_requests": (10, 50),
+    "pending_by_correlation": (10, 50),
+    "reply_chunks_pending": (10, 50),
+    "event_outbox_queued": (100, 500),
+    "heartbeat_queue": (1000, 5000),
+}
+
+
+def read_rss_kb():
+    """当前进程常驻内存（KB），不支持 /proc 的平台返回 None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def count_fds():
+    """当前进程打开的文件描述符数，不支持 /proc 的平台返回 None"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class RateLimiter:
+    """令牌桶限速（多线程共享）"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self, stop_event):
+        """等待下一个令牌，stop_event 置位时返回False"""
+        with self.lock:
+            now = time.monotonic()
+            self.next_at = max(self.next_at + self.interval, now)
+            delay = self.next_at - now
+        return not stop_event.wait(delay) if delay > 0 else not stop_event.is_set()
+
+
+class SoakStats:
+    """浸泡测试计数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class DeviceSimulator:
+    """设备替身 - 回复 SCS/UDS（部分丢弃、部分分片），并持续发送心跳"""
+
+    def __init__(self, broker, units, stats, drop_rate, chunk_rate, seed=None):
+        self.units = units
+        self.stats = stats
+        self.drop_rate = drop_rate
+        self.chunk_rate = chunk_rate
+        self.random = random.Random(seed)
+        self.reply_ids = 0
+        self.client = broker.create_client("soak_device")
+        self.client.on_message = self._on_message
+        self.client.connect()
+        self.client.subscribe("/service/ms500/+/socket")
+        self.client.loop_start()
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            command = json.loads(msg.payload)
+        except ValueError:
+            self.stats.add("device_bad_payload")
+            return
+        self.stats.add("device_commands")
+        if command.get('type') not in REPLY_TYPES:
+            return
+
+        unit = command.get('unit')
+        reply = json.dumps({"type": command['type'], "unit": unit, "ok": True,
+                            "settings": TEST_COMMANDS_CONFIG["UDS"]["settings"]}).encode('utf-8')
+        roll = self.random.random()
+        if roll < self.drop_rate:
+            # 不回复，或只发送部分分片，由中转服务超时清理
+            if self.random.random() < 0.5:
+                self._publish_chunks(unit, reply, incomplete=True)
+            self.stats.add("device_dropped")
+        elif roll < self.drop_rate + self.chunk_rate:
+            self._publish_chunks(unit, reply)
+            self.stats.add("device_chunked")
+        else:
+            client.publish(SOCKET_REPLY_TOPIC.format(unit=unit), reply)
+            self.stats.add("device_replies")
+
+    def _publish_chunks(self, unit, reply, incomplete=False):
+        self.reply_ids = (self.reply_ids + 1) & 0xFFFFFFFF
+        size = max(1, len(reply) // 3)
+        parts = [reply[i:i + size] for i in range(0, len(reply), size)]
+        topic = REPLY_CHUNK_TOPIC.format(unit=unit)
+        for seq, part in enumerate(parts[:-1] if incomplete else parts):
+            self.client.publish(topic, CHUNK_HEADER.pack(self.reply_ids, seq, len(parts)) + part)
+
+    def publish_heartbeat(self):
+        unit = self.random.choice(self.units)
+        data = {"cpu_temp": round(self.random.uniform(40, 70), 1), "sense_temp": 35.0,
+                "video_fps": 25, "spi_fps": 30, "lte_signal": -80, "network": "eth"}
+        self.client.publish(DEVICE_ONLINE_TOPIC.format(unit=unit), json.dumps(data))
+        self.stats.add("heartbeats")
+
+
+class BackendChurn:
+    """Backend 替身 - 多个工作线程不断建立连接、发送混合命令、断开"""
+
+    def __init__(self, port, units, stats, connection_rate, command_rate, commands_per_connection,
+                 legacy_ratio, abandon_rate, subscribe_rate, reply_timeout, seed=None):
+        self.port = port
+        self.units = units
+        self.stats = stats
+        self.connections = RateLimiter(connection_rate)
+        self.commands = RateLimiter(command_rate)
+        self.commands_per_connection = commands_per_connection
+        self.legacy_ratio = legacy_ratio
+        self.abandon_rate = abandon_rate
+        self.subscribe_rate = subscribe_rate
+        self.reply_timeout = reply_timeout
+        self.seed = seed
+
+    def run(self, stop_event, worker_id):
+        rng = random.Random(None if self.seed is None else self.seed + worker_id)
+        while self.connections.wait(stop_event):
+            try:
+                if rng.random() < self.legacy_ratio:
+                    self._legacy_session(rng, stop_event)
+                else:
+                    self._mux_session(rng, stop_event)
+            except (OSError, FrameError) as e:
+                self.stats.add("backend_errors")
+                logger.debug(f"Backend 替身连接出错: {e}")
+
+    def _command(self, rng):
+        command_type = rng.choice(list(TEST_COMMANDS_CONFIG))
+        return {"type": command_type, **TEST_COMMANDS_CONFIG[command_type], "unit": rng.choice(self.units)}
+
+    def _mux_session(self, rng, stop_event):
+        client = MuxClient("127.0.0.1", self.port, timeout=self.reply_timeout)
+        self.stats.add("mux_connections")
+        try:
+            if rng.random() < self.subscribe_rate:
+                client.request({"type": "SUB", "prefixes": [self.units[0][:8]], "events": ["online", "alert"]})
+                self.stats.add("subscriptions")
+
+            streams = []
+            for _ in range(self.commands_per_connection):
+                if not self.commands.wait(stop_event):
+                    break
+                command = self._command(rng)
+                streams.append(client.submit(command))
+                self.stats.add("commands")
+                if command['type'] in REPLY_TYPES and rng.random() < self.abandon_rate:
+                    # 设备回复将发往已断开的连接
+                    self.stats.add("abandoned")
+                    return
+
+            for stream in streams:
+                frame_type, _ = stream.wait(self.reply_timeout)
+                self.stats.add("results" if frame_type is not None else "result_timeouts")
+        finally:
+            client.close()
+
+    def _legacy_session(self, rng, stop_event):
+        if not self.commands.wait(stop_event):
+            return
+        command = self._command(rng)
+        with socket.create_connection(("127.0.0.1", self.port), timeout=self.reply_timeout) as sock:
+            self.stats.add("legacy_connections")
+            sock.sendall(json.dumps(command, ensure_ascii=False).encode('utf-8'))
+            self.stats.add("commands")
+            if command['type'] not in REPLY_TYPES:
+                return
+            if rng.random() < self.abandon_rate:
+                self.stats.add("abandoned")
+                return
+            try:
+                sock.recv(SOCKET_BUFFER_SIZE)
+                self.stats.add("results")
+            except socket.timeout:
+                self.stats.add("result_timeouts")
+
+
+class ResourceSampler:
+    """资源采样 - 定期记录 RSS、线程数、文件描述符、Python 对象数和中转服务的映射表大小"""
+
+    def __init__(self, server, interval):
+        self.server = server
+        self.interval = interval
+        self.rows = []
+        self.started = time.monotonic()
+
+    def sample(self):
+        row = {"elapsed": round(time.monotonic() - self.started, 1), "rss_kb": read_rss_kb(),
+               "threads": threading.active_count(), "fds": count_fds(), "py_objects": len(gc.get_objects())}
+        for name, value in self.server.introspection.read_gauges().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and name not in row:
+                row[name] = value
+        self.rows.append(row)
+        return row
+
+    def run(self, stop_event):
+        self.sample()
+        while not stop_event.wait(self.interval):
+            row = self.sample()
+            logger.info(f"🔍 {row['elapsed']:.0f}s rss={row['rss_kb']}KB threads={row['threads']} fds={row['fds']} "
+                        f"connections={row.get('connections')} pending={row.get('pending_requests')}")
+
+    def write_csv(self, path):
+        columns = []
+        for row in self.rows:
+            columns.extend(name for name in row if name not in columns)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+
+def _slope(points):
+    """最小二乘斜率（每秒）"""
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def analyze(rows, warmup_fraction=0.2, limits=GROWTH_LIMITS):
+    """
+    判断各指标在预热期之后是否持续增长
+
+    Returns:
+        dict: 指标 → {"first", "last", "growth", "allowed", "slope_per_hour", "leak"}
+    """
+    rows = rows[int(len(rows) * warmup_fraction):]
+    if len(rows) < 6:
+        return {}
+
+    third = len(rows) // 3
+    first, last = rows[:third], rows[-third:]
+    hours = (statistics.median(r["elapsed"] for r in last) - statistics.median(r["elapsed"] for r in first)) / 3600
+
+    results = {}
+    for name, (per_hour, tolerance) in limits.items():
+        points = [(r["elapsed"], r[name]) for r in rows if r.get(name) is not None]
+        if len(points) < 6:
+            continue
+        first_median = statistics.median(y for _, y in points[:len(points) // 3])
+        last_median = statistics.median(y for _, y in points[-(len(points) // 3):])
+        slope = _slope(points) * 3600
+        growth = last_median - first_median
+        allowed = per_hour * hours + tolerance
+        results[name] = {"first": first_median, "last": last_median, "growth": growth,
+                         "allowed": round(allowed, 1), "slope_per_hour": round(slope, 1),
+                         "leak": growth > allowed and slope > 0}
+    return results
+
+
+def check_released(baseline, timeout=5.0):
+    """中转服务停止后，线程和文件描述符应回到启动前的数量"""
+    deadline = time.monotonic() + timeout
+    while threading.active_count() > baseline["threads_after_stop"] and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    results = {}
+    for name, current in (("threads_after_stop", threading.active_count()), ("fds_after_stop", count_fds())):
+        if baseline[name] is None or current is None:
+            continue
+        growth = current - baseline[name]
+        results[name] = {"first": baseline[name], "last": current, "growth": growth, "allowed": 0,
+                         "slope_per_hour": None, "leak": growth > 0}
+    if results.get("threads_after_stop", {}).get("leak"):
+        main_thread = threading.main_thread()
+        names = [t.name for t in threading.enumerate() if t is not main_thread]
+        logger.warning(f"⚠️ 停止后残留线程: {names}")
+    return results
+
+
+def soak(duration, port=SOAK_SOCKET_PORT, units=200, workers=4, connection_rate=10.0, command_rate=200.0,
+         commands_per_connection=20, heartbeat_rate=100.0, legacy_ratio=0.3, abandon_rate=0.1,
+         subscribe_rate=0.1, drop_rate=0.05, chunk_rate=0.2, reply_timeout=5.0, sample_interval=10.0,
+         warmup_fraction=0.2, report=None, seed=None):
+    """
+    运行浸泡测试
+
+    Returns:
+        tuple: (采样行列表, 分析结果)
+    """
+    stats = SoakStats()
+    baseline = {"threads_after_stop": threading.active_count(), "fds_after_stop": count_fds()}
+    broker = LocalBroker()
+    unit_ids = [f"MS500-SOAK-{i:05d}" for i in range(units)]
+    device = DeviceSimulator(broker, unit_ids, stats, drop_rate, chunk_rate, seed)
+
+    server = MS500Server(mqtt_client=broker.create_client("soak_bridge"),
+                         socket_host="127.0.0.1", socket_port=port, capture_file=None)
+    if not server.start():
+        device.close()
+        raise RuntimeError("浸泡测试中转服务启动失败")
+
+    stop_event = threading.Event()
+    sampler = ResourceSampler(server, sample_interval)
+    churn = BackendChurn(port, unit_ids, stats, connection_rate, command_rate, commands_per_connection,
+                         legacy_ratio, abandon_rate, subscribe_rate, reply_timeout, seed)
+    heartbeats = RateLimiter(heartbeat_rate)
+
+    def heartbeat_loop():
+        while heartbeats.wait(stop_event):
+            device.publish_heartbeat()
+
+    threads = [threading.Thread(target=churn.run, args=(stop_event, i), name=f"soak-backend-{i}", daemon=True)
+               for i in range(workers)]
+    threads.append(threading.Thread(target=heartbeat_loop, name="soak-heartbeat", daemon=True))
+    threads.append(threading.Thread(target=sampler.run, args=(stop_event,), name="soak-sampler", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        stop_event.wait(duration)
+    except KeyboardInterrupt:
+        logger.warning("⚠️ 浸泡测试被中断，输出已采集的数据")
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=reply_timeout + 5)
+        server.stop()
+        device.close()
+
+    results = analyze(sampler.rows, warmup_fraction)
+    results.update(check_released(baseline))
+    if report:
+        sampler.write_csv(report)
+
+    print("=" * 60)
+    print(f"浸泡测试完成: {sampler.rows[-1]['elapsed'] if sampler.rows else 0:.0f}s, {len(sampler.rows)} 次采样")
+    for name, value in sorted(stats.snapshot().items()):
+        print(f"  {name}: {value}")
+    print("-" * 60)
+    for name, result in results.items():
+        mark = "✗ 持续增长" if result["leak"] else "✓"
+        slope = f", 斜率 {result['slope_per_hour']}/h" if result['slope_per_hour'] is not None else ""
+        print(f"  {mark} {name}: {result['first']} → {result['last']} (增长 {result['growth']}, "
+              f"允许 {result['allowed']}{slope})")
+    if report:
+        print(f"  时间序列报告: {report}")
+    print("=" * 60)
+    return sampler.rows, results
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="MS500 中转服务浸泡测试（泄漏与资源增长检查）")
+    parser.add_argument("--duration", type=float, default=7200, help="测试时长（秒，默认 7200）")
+    parser.add_argument("--port", type=int, default=SOAK_SOCKET_PORT, help="中转服务 Socket 端口")
+    parser.add_argument("--units", type=int, default=200, help="模拟设备数")
+    parser.add_argument("--workers", type=int, default=4, help="Backend 替身线程数")
+    parser.add_argument("--cps", type=float, default=10.0, help="每秒新建连接数")
+    parser.add_argument("--rps", type=float, default=200.0, help="每秒命令数")
+    parser.add_argument("--per-conn", type=int, default=20, help="每个多路复用连接发送的命令数")
+    parser.add_argument("--hps", type=float, default=100.0, help="每秒心跳数")
+    parser.add_argument("--legacy", type=float, default=0.3, help="传统连接比例")
+    parser.add_argument("--abandon", type=float, default=0.1, help="发送 SCS/UDS 后立即断开的比例")
+    parser.add_argument("--subscribe", type=float, default=0.1, help="订阅事件的多路复用连接比例")
+    parser.add_argument("--drop", type=float, default=0.05, help="设备不回复（或只发部分分片）的比例")
+    parser.add_argument("--chunk", type=float, default=0.2, help="设备分片回复的比例")
+    parser.add_argument("--reply-timeout", type=float, default=5.0, help="Backend 替身等待结果的时间（秒）")
+    parser.add_argument("--interval", type=float, default=10.0, help="采样间隔（秒）")
+    parser.add_argument("--warmup", type=float, default=0.2, help="不参与判定的预热比例")
+    parser.add_argument("--report", default="soak_report.csv", help="时间序列报告 (CSV)")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    parser.add_argument("--verbose", action="store_true", help="输出中转服务 INFO 日志")
+    args = parser.parse_args()
+
+    # 中转服务每条命令都有 INFO 日志，浸泡测试默认只保留警告和采样输出
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+
+    _, results = soak(args.duration, args.port, args.units, args.workers, args.cps, args.rps, args.per_conn,
+                      args.hps, args.legacy, args.abandon, args.subscribe, args.drop, args.chunk,
+                      args.reply_timeout, args.interval, args.warmup, args.report, args.seed)
+    sys.exit(1 if any(result["leak"] for result in results.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,29 +7,157 @@ Socket 服务器
 
 import socket
 import threading
+import time
 import json
+import struct
+import itertools
 import logging
+from collections import deque
 from config import *
+from mux_protocol import (MUX_MAGIC, MUX_VERSION, MUX_HELLO, FRAME_HEADER, FrameReader, FrameError, send_frame,
+                          FRAME_REQUEST, FRAME_ACK, FRAME_REPLY, FRAME_ERROR, FRAME_EVENT, FLAG_MORE,
+                          EVENT_STREAM_ID)
+from traffic_capture import REC_COMMAND
+from introspection import STAGE_TIMERS
 
 logger = logging.getLogger(__name__)
 
+# 需要通过 Socket 回复数据的命令类型
+REPLY_COMMAND_TYPES = ('SCS', 'UDS')
+
+
+class BackendConnection:
+    """Backend 连接 - 封装 socket 并保证多线程发送互斥，记录收发统计"""
+
+    def __init__(self, conn_id, client_socket, address):
+        self.conn_id = conn_id
+        self.socket = client_socket
+        self.address = address
+        self.mux = False  # 是否为多路复用连接
+        self.send_lock = threading.Lock()
+
+        # 连接统计
+        self.connected_at = time.time()
+        self.last_active = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def on_received(self, size, messages=0):
+        """记录接收统计（仅由该连接的处理线程调用）"""
+        self.bytes_in += size
+        self.messages_in += messages
+        self.last_active = time.monotonic()
+
+    def send_raw(self, payload):
+        """发送原始数据（传统连接）"""
+        with self.send_lock:
+            try:
+                self.socket.sendall(payload)
+            except OSError:
+                self.shutdown()
+                raise
+            self._on_sent(len(payload) if payload else 0)
+
+    def send_frame(self, frame_type, stream_id, body=b'', flags=0):
+        """发送一帧数据（多路复用连接）"""
+        with self.send_lock:
+            try:
+                send_frame(self.socket, frame_type, stream_id, body, flags)
+            except OSError:
+                self.shutdown()
+                raise
+            self._on_sent(FRAME_HEADER.size + len(body))
+
+    def shutdown(self):
+        """
+        关闭连接的收发（发送失败或服务停止时调用）
+        阻塞在 recv 中的处理线程立即返回并清理映射，而不是等到空闲超时
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _on_sent(self, size):
+        """记录发送统计（调用方持有 send_lock）"""
+        self.bytes_out += size
+        self.messages_out += 1
+        self.last_active = time.monotonic()
+
+    def idle_seconds(self):
+        """距最后一次收发的时间（秒）"""
+        return time.monotonic() - self.last_active
+
+    def send_reply(self, payload, stream_id=None, more=False):
+        """发送设备回复，多路复用连接按 stream_id 打包成 REPLY 帧"""
+        if stream_id is None:
+            self.send_raw(payload)
+        else:
+            self.send_frame(FRAME_REPLY, stream_id, payload, FLAG_MORE if more else 0)
+
+    def send_event(self, body):
+        """推送事件（仅多路复用连接），body 为 JSON bytes"""
+        self.send_frame(FRAME_EVENT, EVENT_STREAM_ID, body)
+
+    def __repr__(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+
+class PendingRequest:
+    """多路复用连接上等待设备回复的请求"""
+
+    __slots__ = ('conn', 'stream_id', 'unit', 'command_type', 'correlation', 'created', 'followers')
+
+    def __init__(self, conn, stream_id, unit, command_type, correlation):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.unit = unit
+        self.command_type = command_type
+        self.correlation = correlation  # MQTT 5 Correlation Data
+        self.created = time.monotonic()
+        self.followers = []  # 合并到本请求的请求，设备回复同时发送给它们
+
 
 class SocketService:
     """Socket 服务器类 - 专门处理 Backend 的 Socket 命令"""
 
-    def __init__(self, mqtt_publisher):
+    def __init__(self, mqtt_publisher, host=SOCKET_HOST, port=SOCKET_PORT):
         """
         初始化Socket服务器
 
         Args:
             mqtt_publisher: MQTTPublisher实例
+            host: 监听地址
+            port: 监听端口
         """
         self.mqtt_publisher = mqtt_publisher
+        self.host = host
+        self.port = port
         self.server_socket = None
         self.running = False
+        self.recorder = None  # 流量记录器（可选）
+        self.cluster = None  # 集群协调器（可选）
+
+        # 当前连接表 conn_id → BackendConnection
+        self.connections = {}
+        self.next_conn_id = 1
+        self.rejected_connections = 0
+
+        # Backend 本地命令（由中转服务直接处理，不转发到设备）
+        self.local_commands = {
+            'CON': self._cmd_connections,
+        }
+        self.disconnect_callbacks = []
 
-        # unit_sn → socket连接 映射表 (内存存储)
+        # unit_sn → BackendConnection 映射表 (内存存储，传统连接使用)
         self.unit_socket_map = {}
+        # unit_sn → 等待回复的请求队列 (多路复用连接使用，按发送顺序匹配回复)
+        self.pending_requests = {}
+        # Correlation Data → 等待回复的请求 (MQTT 5 模式下设备回复直接按它匹配)
+        self.pending_by_correlation = {}
+        self.correlation_counter = itertools.count(1)
         # 线程锁，保护映射表的并发访问
         self.map_lock = threading.Lock()
 
@@ -38,34 +166,75 @@ class SocketService:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((SOCKET_HOST, SOCKET_PORT))
-            self.server_socket.listen(5)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(SOCKET_BACKLOG)
             self.running = True
 
-            logger.info(f"✓ Socket服务器已启动: {SOCKET_HOST}:{SOCKET_PORT}")
+            logger.info(f"✓ Socket服务器已启动: {self.host}:{self.port}")
             logger.info(f"  等待 Backend 服务器连接...")
 
             # 启动接受连接的线程
             accept_thread = threading.Thread(target=self._accept_connections, daemon=True)
             accept_thread.start()
 
+            # 启动维护线程（清理超时请求和空闲连接）
+            maintenance_thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+            maintenance_thread.start()
+
             return True
 
         except Exception as e:
             logger.error(f"启动Socket服务器失败: {e}")
             return False
 
+    def set_recorder(self, recorder):
+        """设置流量记录器（None 表示关闭抓取）"""
+        self.recorder = recorder
+
+    def set_cluster(self, cluster):
+        """设置集群协调器，等待回复的 unit 会在集群中声明归属"""
+        self.cluster = cluster
+
+    def add_disconnect_callback(self, callback):
+        """
+        注册连接断开回调（如清除该连接的事件订阅）
+
+        Args:
+            callback: 回调函数，接收 BackendConnection 参数
+        """
+        self.disconnect_callbacks.append(callback)
+
+    def add_local_command(self, command_type, handler):
+        """
+        注册中转服务本地命令（不转发到设备）
+
+        Args:
+            command_type: 命令类型，如 "ENC"
+            handler: 处理函数，接收 (conn, json_data)，返回回复的 dict
+        """
+        self.local_commands[command_type] = handler
+
     def stop(self):
         """停止Socket服务器"""
         self.running = False
 
-        # 关闭服务器socket
+        # 关闭服务器socket（先 shutdown，Linux 上仅 close 不会唤醒阻塞在 accept 中的线程）
         if self.server_socket:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.server_socket.close()
             except:
                 pass
 
+        # 关闭所有 Backend 连接，处理线程退出并清理映射和等待中的请求
+        with self.map_lock:
+            connections = list(self.connections.values())
+        for conn in connections:
+            conn.shutdown()
+
         logger.info("Socket服务器已停止")
 
     def _accept_connections(self):
@@ -73,12 +242,32 @@ class SocketService:
         while self.running:
             try:
                 client_socket, address = self.server_socket.accept()
+
+                # 连接数达到上限时立即拒绝，不占用处理线程
+                with self.map_lock:
+                    admitted = len(self.connections) < SOCKET_MAX_CONNECTIONS
+                    if admitted:
+                        conn = BackendConnection(self.next_conn_id, client_socket, address)
+                        self.next_conn_id += 1
+                        self.connections[conn.conn_id] = conn
+                    else:
+                        self.rejected_connections += 1
+
+                if not admitted:
+                    logger.warning(f"⚠️ 连接数已达上限 {SOCKET_MAX_CONNECTIONS}，拒绝连接: {address[0]}:{address[1]}")
+                    try:
+                        client_socket.close()
+                    except:
+                        pass
+                    continue
+
                 logger.info(f"✓ Backend 服务器连接: {address[0]}:{address[1]}")
+                self._configure_socket(client_socket)
 
                 # 启动客户端处理线程
                 client_thread = threading.Thread(
                     target=self._handle_client,
-                    args=(client_socket, address),
+                    args=(conn,),
                     daemon=True
                 )
                 client_thread.start()
@@ -87,74 +276,73 @@ class SocketService:
                 if self.running:
                     logger.error(f"接受连接时出错: {e}")
 
-    def _handle_client(self, client_socket, address):
+    def _configure_socket(self, client_socket):
+        """设置 TCP_NODELAY 和 TCP keepalive"""
+        try:
+            if SOCKET_TCP_NODELAY:
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if SOCKET_TCP_KEEPALIVE:
+                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # 以下选项并非所有平台都支持
+                if hasattr(socket, 'TCP_KEEPIDLE'):
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, SOCKET_KEEPALIVE_IDLE)
+                if hasattr(socket, 'TCP_KEEPINTVL'):
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, SOCKET_KEEPALIVE_INTERVAL)
+                if hasattr(socket, 'TCP_KEEPCNT'):
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, SOCKET_KEEPALIVE_COUNT)
+        except OSError as e:
+            logger.warning(f"⚠️ 设置 Socket 选项失败: {e}")
+
+    def _maintenance_loop(self):
+        """维护线程，定期清理等待超时的多路复用请求"""
+        while self.running:
+            time.sleep(1.0)
+            try:
+                self._expire_pending_requests()
+            except Exception as e:
+                logger.error(f"清理超时请求时出错: {e}")
+
+    def _handle_client(self, conn):
         """
         处理客户端请求
         接收 Backend 发送的 JSON 命令并转发到 MQTT
+        首包以 MUX_MAGIC 开头的连接按多路复用协议处理，否则按传统方式处理
         """
-        current_unit = None  # 当前连接对应的 unit_sn
+        client_socket = conn.socket
+        address = conn.address
 
         try:
-            # 设置 Socket 超时 (60秒)
-            client_socket.settimeout(60.0)
-
-            while self.running:
-                # 接收数据
-                try:
-                    data = client_socket.recv(SOCKET_BUFFER_SIZE)
-                except socket.timeout:
-                    logger.warning(f"客户端 {address} 接收超时，继续等待...")
-                    continue
-
-                if not data:
+            # 设置 Socket 超时，超时后检查是否空闲过久
+            client_socket.settimeout(min(SOCKET_IDLE_TIMEOUT, 60.0))
+
+            # 接收首包，判断连接协议
+            data = self._recv(conn)
+            # 握手可能分多次到达，等到完整的 MUX_HELLO（魔数 + 版本号）再判断
+            while data and len(data) < len(MUX_HELLO) and MUX_MAGIC.startswith(data[:len(MUX_MAGIC)]):
+                more = self._recv(conn)
+                if not more:
                     break
-
-                # 解码JSON数据
-                try:
-                    json_str = data.decode('utf-8')
-                    json_data = json.loads(json_str)
-
-                    logger.info(f"📥 收到 Backend 命令:")
-                    logger.info(f"   {json.dumps(json_data, indent=2, ensure_ascii=False)}")
-
-                    # 只为 SCS/UDS 命令保存映射关系（这两个命令需要通过 Socket 回复数据）
-                    command_type = json_data.get('type')
-                    unit = json_data.get('unit')
-
-                    if command_type in ['SCS', 'UDS'] and unit:
-                        with self.map_lock:
-                            self.unit_socket_map[unit] = client_socket
-                            current_unit = unit
-                        logger.info(f"✓ 已保存映射 ({command_type}): unit={unit} → socket={address}")
-                    elif command_type in ['SCS', 'UDS'] and not unit:
-                        logger.warning(f"⚠️ {command_type} 命令缺少 unit 字段，无法保存映射")
-                    else:
-                        logger.debug(f"命令类型 {command_type} 不需要 Socket 映射")
-
-                    # 转发到 MQTT
-                    success = self.mqtt_publisher.forward_socket_command(json_data)
-
-                    if success:
-                        logger.info(f"✓ 命令已转发到 MQTT")
-                    else:
-                        logger.error(f"✗ 命令转发失败")
-
-                except json.JSONDecodeError as e:
-                    logger.error(f"JSON解析失败: {e}")
-                    logger.error(f"原始数据: {data}")
-                except UnicodeDecodeError as e:
-                    logger.error(f"UTF-8解码失败: {e}")
+                data += more
+
+            if data.startswith(MUX_MAGIC):
+                if len(data) < len(MUX_HELLO):
+                    logger.warning(f"⚠️ Backend {conn} 握手不完整，关闭连接")
+                elif data[len(MUX_MAGIC)] != MUX_VERSION:
+                    # 回送本服务支持的版本后关闭，客户端据此判断握手失败
+                    logger.error(f"✗ Backend {conn} 使用不支持的多路复用协议版本 {data[len(MUX_MAGIC)]}，关闭连接")
+                    conn.send_raw(MUX_HELLO)
+                else:
+                    self._serve_mux(conn, data)
+            elif data:
+                self._serve_legacy(conn, data)
 
         except Exception as e:
             logger.error(f"处理客户端 {address} 时出错: {e}")
 
         finally:
-            # 清除映射关系
-            if current_unit:
-                with self.map_lock:
-                    if current_unit in self.unit_socket_map:
-                        del self.unit_socket_map[current_unit]
-                        logger.info(f"✓ 已移除映射: unit={current_unit}")
+            self._release_connection(conn)
+            with self.map_lock:
+                self.connections.pop(conn.conn_id, None)
 
             try:
                 client_socket.close()
@@ -163,42 +351,503 @@ class SocketService:
 
             logger.info(f"Backend 断开连接: {address}")
 
-    def send_socket_reply(self, unit, data):
+    def _serve_legacy(self, conn, data):
+        """
+        传统连接：每次 recv 的数据作为一条完整 JSON 命令
+        每条命令的处理耗时计入 _handle_client 阶段（不含等待下一条命令的时间）
+        """
+        while self.running:
+            started = time.perf_counter() if STAGE_TIMERS.enabled else None
+            conn.on_received(0, 1)
+            if self.recorder:
+                self.recorder.record(REC_COMMAND, str(conn), data)
+
+            # 解码JSON数据
+            try:
+                json_str = data.decode('utf-8')
+                json_data = json.loads(json_str)
+                if not isinstance(json_data, dict):
+                    raise ValueError(f"命令必须是 JSON 对象: {type(json_data).__name__}")
+
+                logger.info(f"📥 收到 Backend 命令:")
+                logger.info(f"   {json.dumps(json_data, indent=2, ensure_ascii=False)}")
+
+                self._process_legacy_command(conn, json_data)
+
+            except json.JSONDecodeError as e:
+                logger.error(f"JSON解析失败: {e}")
+                logger.error(f"原始数据: {data}")
+            except UnicodeDecodeError as e:
+                logger.error(f"UTF-8解码失败: {e}")
+            except ValueError as e:
+                logger.error(f"✗ 无效命令: {e}")
+
+            if started is not None:
+                STAGE_TIMERS.record('_handle_client', started)
+
+            # 接收数据
+            data = self._recv(conn)
+            if not data:
+                break
+
+    def _process_legacy_command(self, conn, json_data):
+        """处理传统连接上的一条命令"""
+        command_type = json_data.get('type')
+        unit = json_data.get('unit')
+
+        # 中转服务本地命令，直接回复
+        if command_type in self.local_commands:
+            self._process_local_command(conn, None, json_data)
+            return
+
+        # 只为 SCS/UDS 命令保存映射关系（这两个命令需要通过 Socket 回复数据）
+        if command_type in REPLY_COMMAND_TYPES and unit:
+            with self.map_lock:
+                self.unit_socket_map[unit] = conn
+            logger.info(f"✓ 已保存映射 ({command_type}): unit={unit} → socket={conn.address}")
+            self._update_claims([unit])
+        elif command_type in REPLY_COMMAND_TYPES and not unit:
+            logger.warning(f"⚠️ {command_type} 命令缺少 unit 字段，无法保存映射")
+        else:
+            logger.debug(f"命令类型 {command_type} 不需要 Socket 映射")
+
+        # 转发到 MQTT
+        success = self.mqtt_publisher.forward_socket_command(json_data)
+
+        if success:
+            logger.info(f"✓ 命令已转发到 MQTT")
+        else:
+            logger.error(f"✗ 命令转发失败")
+
+    def _serve_mux(self, conn, data):
+        """多路复用连接：按帧接收命令，同一连接上可有多个未完成的请求"""
+        conn.mux = True
+        conn.send_raw(MUX_HELLO)
+        logger.info(f"✓ Backend {conn} 使用多路复用协议")
+
+        reader = FrameReader()
+        data = data[len(MUX_HELLO):]
+
+        while self.running:
+            try:
+                frames = reader.feed(data)
+            except FrameError as e:
+                logger.error(f"✗ 多路复用帧格式错误 ({conn}): {e}")
+                break
+
+            conn.on_received(0, len(frames))
+            for frame_type, flags, stream_id, body in frames:
+                if frame_type == FRAME_REQUEST:
+                    # 每条命令的处理耗时计入 _handle_client 阶段
+                    started = time.perf_counter() if STAGE_TIMERS.enabled else None
+                    try:
+                        self._process_mux_request(conn, stream_id, body)
+                    except Exception as e:
+                        # 单条请求出错只回复该 stream 的 ERROR 帧，不关闭连接
+                        logger.error(f"✗ 处理命令出错 ({conn}, stream={stream_id}): {e}")
+                        self._send_mux_error(conn, stream_id, str(e))
+                    if started is not None:
+                        STAGE_TIMERS.record('_handle_client', started)
+                else:
+                    logger.warning(f"⚠️ 忽略未知帧类型 {frame_type} ({conn})")
+
+            data = self._recv(conn)
+            if not data:
+                break
+
+    def _recv(self, conn):
+        """
+        接收数据
+        超时后若连接空闲超过 SOCKET_IDLE_TIMEOUT 则返回空（由调用方关闭连接），否则继续等待；
+        连接关闭或服务停止时返回空
+        """
+        while self.running:
+            try:
+                data = conn.socket.recv(SOCKET_BUFFER_SIZE)
+                conn.on_received(len(data))
+                return data
+            except socket.timeout:
+                idle = conn.idle_seconds()
+                if idle >= SOCKET_IDLE_TIMEOUT:
+                    logger.warning(f"⚠️ 客户端 {conn.address} 空闲 {idle:.0f}s，关闭连接")
+                    return b''
+        return b''
+
+    def _process_mux_request(self, conn, stream_id, body):
+        """处理多路复用连接上的一条命令"""
+        if self.recorder:
+            self.recorder.record(REC_COMMAND, str(conn), body)
+
+        try:
+            json_data = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            logger.error(f"JSON解析失败 ({conn}, stream={stream_id}): {e}")
+            self._send_mux_error(conn, stream_id, f"invalid json: {e}")
+            return
+        if not isinstance(json_data, dict):
+            # 只拒绝这一条请求，连接上的其他请求不受影响
+            logger.error(f"✗ 命令不是 JSON 对象 ({conn}, stream={stream_id})")
+            self._send_mux_error(conn, stream_id, "command must be a json object")
+            return
+
+        command_type = json_data.get('type')
+        unit = json_data.get('unit')
+        logger.debug(f"📥 收到 Backend 命令 ({conn}, stream={stream_id}): {command_type} → {unit}")
+
+        # 中转服务本地命令，直接回复
+        if command_type in self.local_commands:
+            self._process_local_command(conn, stream_id, json_data)
+            return
+
+        expects_reply = command_type in REPLY_COMMAND_TYPES and unit
+        if expects_reply:
+            # 先登记再发布，避免设备回复早于登记
+            correlation = struct.pack('>Q', next(self.correlation_counter))
+            pending = PendingRequest(conn, stream_id, unit, command_type, correlation)
+            with self.map_lock:
+                self.pending_requests.setdefault(unit, deque()).append(pending)
+                self.pending_by_correlation[correlation] = pending
+            self._update_claims([unit])
+            success = self.mqtt_publisher.forward_socket_command(json_data, correlation)
+        else:
+            success = self.mqtt_publisher.forward_socket_command(json_data)
+
+        if not success:
+            if expects_reply:
+                self._remove_pending(unit, pending)
+            self._send_mux_error(conn, stream_id, "forward failed")
+        elif not expects_reply:
+            # 无回复命令，发布完成即确认
+            try:
+                conn.send_frame(FRAME_ACK, stream_id, b'{"ok": true}')
+            except OSError as e:
+                logger.error(f"✗ 发送 ACK 失败 ({conn}, stream={stream_id}): {e}")
+
+    def _process_local_command(self, conn, stream_id, json_data):
+        """
+        处理中转服务本地命令并回复
+        多路复用连接按 stream_id 回复 REPLY 帧，传统连接直接发送 JSON
+        """
+        if not isinstance(json_data, dict):
+            command_type = None
+            response = {"ok": False, "error": "command must be a json object"}
+        else:
+            command_type = json_data.get('type')
+            try:
+                response = self.local_commands[command_type](conn, json_data)
+            except Exception as e:
+                logger.error(f"✗ 处理本地命令 {command_type} 出错: {e}")
+                response = {"type": command_type, "ok": False, "error": str(e)}
+
+        body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        try:
+            conn.send_reply(body, stream_id)
+        except OSError as e:
+            logger.error(f"✗ 发送本地命令回复失败 ({conn}): {e}")
+
+    def _cmd_connections(self, conn, json_data):
+        """CON 命令：返回当前连接表"""
+        return {
+            "type": "CON",
+            "ok": True,
+            "max_connections": SOCKET_MAX_CONNECTIONS,
+            "rejected": self.rejected_connections,
+            "connections": self.get_connections(),
+        }
+
+    def get_connections(self):
+        """
+        获取当前连接表
+
+        Returns:
+            list: 每个连接的地址、协议、空闲时间以及收发字节数/消息数
+        """
+        with self.map_lock:
+            connections = list(self.connections.values())
+            units = {}
+            for unit, c in self.unit_socket_map.items():
+                units[c.conn_id] = units.get(c.conn_id, 0) + 1
+            pending = {}
+            for queue in self.pending_requests.values():
+                for p in queue:
+                    for request in (p, *p.followers):
+                        pending[request.conn.conn_id] = pending.get(request.conn.conn_id, 0) + 1
+
+        return [{
+            "id": c.conn_id,
+            "address": str(c),
+            "protocol": "mux" if c.mux else "legacy",
+            "connected_at": c.connected_at,
+            "idle_seconds": round(c.idle_seconds(), 3),
+            "bytes_in": c.bytes_in,
+            "bytes_out": c.bytes_out,
+            "messages_in": c.messages_in,
+            "messages_out": c.messages_out,
+            "units": units.get(c.conn_id, 0),
+            "pending": pending.get(c.conn_id, 0),
+        } for c in connections]
+
+    def _send_mux_error(self, conn, stream_id, message):
+        """发送 ERROR 帧"""
+        body = json.dumps({"ok": False, "error": message}, ensure_ascii=False).encode('utf-8')
+        try:
+            conn.send_frame(FRAME_ERROR, stream_id, body)
+        except OSError as e:
+            logger.error(f"✗ 发送 ERROR 失败 ({conn}, stream={stream_id}): {e}")
+
+    def _remove_pending(self, unit, pending):
+        """移除一条等待中的请求"""
+        with self.map_lock:
+            self._discard_pending_locked(pending)
+        self._update_claims([unit])
+
+    def _discard_pending_locked(self, pending):
+        """从队列和 Correlation 索引中移除请求（调用方持有 map_lock）"""
+        self.pending_by_correlation.pop(pending.correlation, None)
+        queue = self.pending_requests.get(pending.unit)
+        if queue:
+            try:
+                queue.remove(pending)
+            except ValueError:
+                pass
+            if not queue:
+                del self.pending_requests[pending.unit]
+
+    def merge_pending(self, correlation, into):
+        """
+        合并等待中的请求（命令合并后只发布一次，设备的一条回复同时发送给被合并的请求）
+
+        Args:
+            correlation: 被合并请求的 Correlation Data
+            into: 保留请求的 Correlation Data（合并后的命令使用它发布）
+
+        Returns:
+            bool: 保留请求已不在等待中（超时或连接断开）返回False，调用方改用被合并请求发布
+        """
+        with self.map_lock:
+            pending = self.pending_by_correlation.get(correlation)
+            kept = self.pending_by_correlation.get(into)
+            if pending is None or kept is None or pending is kept:
+                return False
+            self._discard_pending_locked(pending)
+            kept.followers.append(pending)
+        return True
+
+    def fail_pending(self, correlation, message):
+        """命令未能发布，向等待中的请求及合并到它的请求发送 ERROR 帧"""
+        with self.map_lock:
+            pending = self.pending_by_correlation.get(correlation)
+            if pending is None:
+                return
+            self._discard_pending_locked(pending)
+        self._update_claims([pending.unit])
+        for request in (pending, *pending.followers):
+            self._send_mux_error(request.conn, request.stream_id, message)
+
+    def _update_claims(self, units):
+        """集群模式下根据是否仍在等待回复，声明或释放 unit 归属"""
+        if not self.cluster:
+            return
+        for unit in units:
+            with self.map_lock:
+                held = unit in self.unit_socket_map or unit in self.pending_requests
+            if held:
+                self.cluster.claim(unit)
+            else:
+                self.cluster.release(unit)
+
+    def _expire_pending_requests(self):
+        """清理等待回复超时的请求，并通知 Backend"""
+        deadline = time.monotonic() - MUX_REQUEST_TIMEOUT
+        expired = []
+        with self.map_lock:
+            for unit in list(self.pending_requests):
+                queue = self.pending_requests[unit]
+                while queue and queue[0].created <= deadline:
+                    pending = queue.popleft()
+                    self.pending_by_correlation.pop(pending.correlation, None)
+                    expired.append((unit, pending))
+                if not queue:
+                    del self.pending_requests[unit]
+
+        self._update_claims({unit for unit, _ in expired})
+        for unit, pending in expired:
+            logger.warning(f"⚠️ 等待设备回复超时 (unit={unit}, {pending.command_type}, stream={pending.stream_id})")
+            for request in (pending, *pending.followers):
+                self._send_mux_error(request.conn, request.stream_id, "reply timeout")
+
+    def _release_connection(self, conn):
+        """连接断开时清除该连接的映射关系和等待中的请求"""
+        released = set()
+        with self.map_lock:
+            for unit in [u for u, c in self.unit_socket_map.items() if c is conn]:
+                del self.unit_socket_map[unit]
+                released.add(unit)
+                logger.info(f"✓ 已移除映射: unit={unit}")
+
+            if conn.mux:
+                for unit in list(self.pending_requests):
+                    queue = self.pending_requests[unit]
+                    for p in queue:
+                        if p.followers:
+                            p.followers = [f for f in p.followers if f.conn is not conn]
+                    if all(p.conn is not conn for p in queue):
+                        continue
+                    remaining = deque()
+                    for p in queue:
+                        if p.conn is not conn:
+                            remaining.append(p)
+                        elif p.followers:
+                            # 合并发布的命令仍按该请求的 Correlation Data 回复，由第一个被合并的请求接替
+                            successor = p.followers.pop(0)
+                            successor.correlation, successor.followers = p.correlation, p.followers
+                            self.pending_by_correlation[p.correlation] = successor
+                            remaining.append(successor)
+                        else:
+                            self.pending_by_correlation.pop(p.correlation, None)
+                    released.add(unit)
+                    if remaining:
+                        self.pending_requests[unit] = remaining
+                    else:
+                        del self.pending_requests[unit]
+
+        self._update_claims(released)
+
+        for callback in self.disconnect_callbacks:
+            try:
+                callback(conn)
+            except Exception as e:
+                logger.error(f"✗ 连接断开回调出错 ({conn}): {e}")
+
+    def _take_reply_target(self, unit, final, correlation=None):
+        """
+        查找 unit 回复的发送目标
+        带 Correlation Data 的回复（MQTT 5）直接匹配对应请求；
+        否则优先匹配多路复用连接上最早的等待请求，最后一个分片发送后出队；
+        再否则使用传统连接的映射
+
+        Returns:
+            list: [(BackendConnection, stream_id), ...]，合并的请求各占一项；未找到返回空列表
+        """
+        conn = None
+        with self.map_lock:
+            if correlation is not None:
+                pending = self.pending_by_correlation.get(correlation)
+                if pending is None:
+                    logger.error(f"✗ 未找到 correlation={correlation.hex()} 对应的请求，无法发送回复")
+                    return []
+                unit = pending.unit
+                queue = self.pending_requests.get(unit)
+            else:
+                queue = self.pending_requests.get(unit)
+                pending = queue[0] if queue else None
+
+            if pending:
+                drained = False
+                targets = [(p.conn, p.stream_id) for p in (pending, *pending.followers)]
+                if final:
+                    self._discard_pending_locked(pending)
+                    drained = unit not in self.pending_requests
+            else:
+                conn = self.unit_socket_map.get(unit)
+
+        if pending:
+            if drained:
+                self._update_claims([unit])
+            return targets
+
+        if not conn:
+            logger.error(f"✗ 未找到 unit={unit} 的 Socket 连接，无法发送回复")
+            logger.error(f"  当前映射表: {list(self.unit_socket_map.keys())}")
+            return []
+        return [(conn, None)]
+
+    def _send_to_targets(self, unit, targets, payload, more=False):
+        """
+        发送回复给每个目标（合并的请求各一份），某个连接发送失败不影响其他目标
+
+        Returns:
+            bool: 至少一个目标发送成功返回True
+        """
+        sent = 0
+        for conn, stream_id in targets:
+            try:
+                conn.send_reply(payload, stream_id, more)
+                sent += 1
+            except OSError as e:
+                logger.error(f"✗ 发送回复失败 (unit={unit}, {conn}, stream={stream_id}): {e}")
+        return sent > 0
+
+    def send_socket_reply(self, unit, data, correlation=None):
         """
         发送回复数据到 Backend Socket
-        通过 unit_sn 查找对应的 Socket 连接并发送数据
+        通过 unit_sn（或 MQTT 5 的 Correlation Data）查找对应的 Socket 连接并发送数据
 
         Args:
-            unit: 设备单元标识 (unit_sn)
-            data: 要发送的数据 (dict 或 str)
+            unit: 设备单元标识 (unit_sn)，按 correlation 匹配时可为 None
+            data: 要发送的数据 (dict、str，或 bytes/memoryview 原始数据)
+            correlation: 可选，MQTT 5 回复携带的 Correlation Data
 
         Returns:
             bool: 发送成功返回True
         """
+        started = time.perf_counter() if STAGE_TIMERS.enabled else None
         try:
-            # 查找对应的 Socket 连接
-            with self.map_lock:
-                client_socket = self.unit_socket_map.get(unit)
-
-            if not client_socket:
-                logger.error(f"✗ 未找到 unit={unit} 的 Socket 连接，无法发送回复")
-                logger.error(f"  当前映射表: {list(self.unit_socket_map.keys())}")
+            targets = self._take_reply_target(unit, final=True, correlation=correlation)
+            if not targets:
                 return False
 
-            # 转换为 JSON 字符串
-            if isinstance(data, dict):
-                json_str = json.dumps(data, ensure_ascii=False)
+            # 二进制数据直接转发，不做解码/重新编码
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                payload = data
+            elif isinstance(data, dict):
+                payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
             else:
-                json_str = data
+                payload = data.encode('utf-8')
 
-            # 发送数据
-            client_socket.sendall(json_str.encode('utf-8'))
+            # 发送数据（合并的请求各发送一份）
+            if not self._send_to_targets(unit, targets, payload):
+                return False
 
-            logger.info(f"✓ 已发送回复到 Backend (unit={unit})")
-            logger.debug(f"  回复数据: {json_str[:200]}...")  # 只显示前200字符
+            logger.info(f"✓ 已发送回复到 Backend (unit={unit}, {len(payload)} 字节)")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"  回复数据: {bytes(payload[:200])!r}...")  # 只显示前200字节
 
             return True
 
         except Exception as e:
             logger.error(f"✗ 发送回复失败 (unit={unit}): {e}")
             return False
+
+        finally:
+            if started is not None:
+                STAGE_TIMERS.record('send_socket_reply', started)
+
+    def send_socket_reply_chunk(self, unit, chunk, final):
+        """
+        流式发送分片回复到 Backend Socket
+        分片按序号到达即转发，不在内存中拼接完整回复
+
+        Args:
+            unit: 设备单元标识 (unit_sn)
+            chunk: 分片数据 (memoryview)
+            final: 是否为最后一个分片
+
+        Returns:
+            bool: 发送成功返回True
+        """
+        try:
+            targets = self._take_reply_target(unit, final)
+            if not targets:
+                return False
+
+            if not self._send_to_targets(unit, targets, chunk, more=not final):
+                return False
+
+            if final:
+                logger.info(f"✓ 分片回复已全部发送到 Backend (unit={unit})")
+            return True
+
+        except Exception as e:
+            logger.error(f"✗ 发送分片回复失败 (unit={unit}): {e}")
+            return False
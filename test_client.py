@@ -9,6 +9,7 @@ import socket
 import json
 import time
 import sys
+from mux_protocol import MuxClient, FRAME_ACK, FRAME_REPLY
 
 # ==================== 测试配置 ====================
 # 测试服务器配置
@@ -228,6 +229,44 @@ def test_rsr_command():
     return send_socket_command(SERVER_HOST, SERVER_PORT, command)
 
 
+def test_mux_commands(rounds=1):
+    """
+    多路复用模式 - 在一条持久连接上并发发送所有命令
+
+    Args:
+        rounds: 发送轮数，每轮发送全部 12 种命令
+    """
+    print(f"\n🔀 多路复用测试 ({rounds} 轮)")
+    try:
+        client = MuxClient(SERVER_HOST, SERVER_PORT, timeout=10)
+    except ConnectionRefusedError:
+        print(f"✗ 连接被拒绝: {SERVER_HOST}:{SERVER_PORT}")
+        print("  请确保 python_mqtt 中转服务已启动 (python main.py)")
+        return False
+
+    start = time.time()
+    try:
+        # 先全部发出，再统一等待结果（回复可能乱序返回）
+        streams = []
+        for _ in range(rounds):
+            for command_type, params in TEST_COMMANDS_CONFIG.items():
+                streams.append((command_type, client.submit({"type": command_type, **params})))
+
+        ok = 0
+        for command_type, stream in streams:
+            frame_type, body = stream.wait(client.timeout)
+            if frame_type in (FRAME_ACK, FRAME_REPLY):
+                ok += 1
+            if VERBOSE_JSON:
+                print(f"  [{stream.stream_id}] {command_type}: 帧类型={frame_type} {body[:200]!r}")
+    finally:
+        client.close()
+
+    elapsed = time.time() - start
+    print(f"✓ 完成 {ok}/{len(streams)} 个命令，用时 {elapsed:.3f}s")
+    return ok == len(streams)
+
+
 def interactive_mode():
     """交互模式 - 选择要测试的命令"""
     print("=" * 60)
@@ -254,6 +293,7 @@ def interactive_mode():
         '11': ('IMG - Image Request', test_img_command),
         '12': ('RSR - Resend Request', test_rsr_command),
         'all': ('测试所有命令', None),
+        'mux': ('多路复用发送所有命令', None),
         'q': ('退出', None)
     }
 
@@ -281,6 +321,10 @@ def interactive_mode():
             print("\n✓ 所有命令测试完成!")
             continue
 
+        if choice == 'mux':
+            test_mux_commands()
+            continue
+
         if choice in commands:
             _, test_func = commands[choice]
             if test_func:
@@ -311,7 +355,10 @@ def main():
             'ALL': None
         }
 
-        if command == 'ALL':
+        if command == 'MUX':
+            rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+            test_mux_commands(rounds)
+        elif command == 'ALL':
             for test_func in commands.values():
                 if test_func:
                     test_func()
@@ -320,7 +367,7 @@ def main():
             commands[command]()
         else:
             print(f"未知命令: {command}")
-            print("可用命令: AIM, FMW, APP, CDN, CFG, CTS, WFI, SCS, UDS, FRS, IMG, RSR, ALL")
+            print("可用命令: AIM, FMW, APP, CDN, CFG, CTS, WFI, SCS, UDS, FRS, IMG, RSR, ALL, MUX [轮数]")
     else:
         # 交互模式
         try:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MQTT 主题路由
+将订阅模式编译成按主题层级组织的前缀树，收到消息时沿主题层级匹配，
+分发开销只与主题层数有关，与注册的路由数量无关
+
+模式语法（按 / 分层）:
+    普通层级    精确匹配
+    {name}      单层通配（订阅时为 +），匹配值以 name 为键传给处理函数
+    +           单层通配，不提取
+    #           多层通配，只能位于最后一层，剩余部分以 '#' 为键传给处理函数
+
+示例: "/device/ms500/{unit}/online" 订阅 "/device/ms500/+/online"，
+      处理函数收到 captures = {"unit": "MS500-H090-EP-2549-0038"}
+"""
+
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Route:
+    """一条已编译的路由"""
+
+    __slots__ = ('pattern', 'topic_filter', 'capture_names', 'handler')
+
+    def __init__(self, pattern, topic_filter, capture_names, handler):
+        self.pattern = pattern
+        self.topic_filter = topic_filter
+        self.capture_names = capture_names  # 与各个 + 层级一一对应，None 表示不提取
+        self.handler = handler
+
+
+class _Node:
+    """前缀树节点"""
+
+    __slots__ = ('children', 'plus', 'hash_routes', 'routes')
+
+    def __init__(self):
+        self.children = {}      # 精确层级 → _Node
+        self.plus = None        # + 层级子节点
+        self.hash_routes = []   # 在此处以 # 结尾的路由
+        self.routes = []        # 在此处结束的路由
+
+
+def compile_pattern(pattern):
+    """
+    编译路由模式
+
+    Args:
+        pattern: 路由模式，如 "/device/ms500/{unit}/socket_reply"
+
+    Returns:
+        tuple: (levels, topic_filter, capture_names)
+    """
+    levels = pattern.split('/')
+    filter_levels = []
+    capture_names = []
+    for i, level in enumerate(levels):
+        if level.startswith('{') and level.endswith('}') and len(level) > 2:
+            filter_levels.append('+')
+            capture_names.append(level[1:-1])
+        elif level == '+':
+            filter_levels.append('+')
+            capture_names.append(None)
+        elif level == '#':
+            if i != len(levels) - 1:
+                raise ValueError(f"'#' 只能位于最后一层: {pattern}")
+            filter_levels.append('#')
+        elif '+' in level or '#' in level or '{' in level or '}' in level:
+            raise ValueError(f"无效的主题层级 '{level}': {pattern}")
+        else:
+            filter_levels.append(level)
+    return filter_levels, '/'.join(filter_levels), capture_names
+
+
+class TopicRouter:
+    """主题路由类 - 前缀树匹配，支持 + / # 通配和命名提取"""
+
+    def __init__(self):
+        self.root = _Node()
+        self.filters = []  # 按注册顺序去重后的订阅过滤器
+        self.lock = threading.Lock()
+
+    def add_route(self, pattern, handler):
+        """
+        注册路由
+
+        Args:
+            pattern: 路由模式（见模块说明）
+            handler: 处理函数，接收 (topic, payload, captures) 三个参数
+
+        Returns:
+            str: 对应的 MQTT 订阅过滤器
+        """
+        levels, topic_filter, capture_names = compile_pattern(pattern)
+        route = _Route(pattern, topic_filter, capture_names, handler)
+
+        with self.lock:
+            node = self.root
+            for level in levels:
+                if level == '#':
+                    node.hash_routes.append(route)
+                    break
+                if level == '+':
+                    if node.plus is None:
+                        node.plus = _Node()
+                    node = node.plus
+                else:
+                    node = node.children.setdefault(level, _Node())
+            else:
+                node.routes.append(route)
+
+            if topic_filter not in self.filters:
+                self.filters.append(topic_filter)
+
+        logger.debug(f"已注册路由: {pattern} → {topic_filter}")
+        return topic_filter
+
+    def get_filters(self):
+        """返回所有路由对应的订阅过滤器"""
+        with self.lock:
+            return list(self.filters)
+
+    def match(self, topic):
+        """
+        匹配主题
+
+        Args:
+            topic: 消息主题
+
+        Returns:
+            list: [(handler, captures), ...]
+        """
+        levels = topic.split('/')
+        matches = []
+        self._match(self.root, levels, 0, [], matches)
+        return matches
+
+    def _match(self, node, levels, depth, values, matches):
+        """沿前缀树递归匹配，values 为沿途 + 层级的取值"""
+        # '#' 同时匹配父层级本身（MQTT 规范），因此先于层级判断
+        for route in node.hash_routes:
+            matches.append((route.handler, self._captures(route, values, levels[depth:])))
+
+        if depth == len(levels):
+            for route in node.routes:
+                matches.append((route.handler, self._captures(route, values, None)))
+            return
+
+        level = levels[depth]
+        child = node.children.get(level)
+        if child is not None:
+            self._match(child, levels, depth + 1, values, matches)
+        if node.plus is not None:
+            values.append(level)
+            self._match(node.plus, levels, depth + 1, values, matches)
+            values.pop()
+
+    @staticmethod
+    def _captures(route, values, tail):
+        """根据路由的命名生成提取结果"""
+        captures = {name: value for name, value in zip(route.capture_names, values) if name}
+        if tail is not None:
+            captures['#'] = '/'.join(tail)
+        return captures
+
+    def dispatch(self, topic, payload, extra=None):
+        """
+        分发消息到所有匹配的处理函数
+
+        Args:
+            topic: 消息主题
+            payload: 消息数据
+            extra: 可选，附加到每个处理函数 captures 中的字段（如 MQTT 5 的 correlation）
+
+        Returns:
+            int: 调用的处理函数数量
+        """
+        matches = self.match(topic)
+        for handler, captures in matches:
+            if extra:
+                captures.update(extra)
+            handler(topic, payload, captures)
+        return len(matches)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量抓取
+将经过中转服务的 Backend 命令、MQTT 发布和设备消息追加写入紧凑的二进制文件，
+供 replay_tool.py 回放
+
+文件格式: CAPTURE_MAGIC 文件头，之后为连续的记录:
+
+    kind(uint8) + t_ns(uint64，相对抓取开始的单调时间) + key_len(uint16) + payload_len(uint32)
+    + key(utf-8) + payload
+
+    REC_COMMAND  Backend 命令，key 为连接地址，payload 为 JSON 命令原文
+    REC_PUBLISH  发布到 MQTT 的消息，key 为主题
+    REC_DEVICE   从 MQTT 收到的设备消息（回复、分片、心跳等），key 为主题
+"""
+
+import struct
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b'MS5CAP\x01'
+
+RECORD_HEADER = struct.Struct('<BQHI')
+
+# 记录类型
+REC_COMMAND = 1
+REC_PUBLISH = 2
+REC_DEVICE = 3
+
+RECORD_KIND_NAMES = {
+    REC_COMMAND: 'command',
+    REC_PUBLISH: 'publish',
+    REC_DEVICE: 'device',
+}
+
+
+class TrafficRecorder:
+    """流量记录器 - 缓冲写入，记录一条只做一次加锁和内存拷贝"""
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        """
+        初始化记录器
+
+        Args:
+            path: 抓取文件路径（已存在时追加，追加段的时间从 0 重新开始）
+            buffer_size: 写缓冲大小（字节）
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab', buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.start_ns = time.monotonic_ns()
+        self.record_count = 0
+        self.closed = False
+
+        logger.info(f"✓ 流量抓取已开启: {path}")
+
+    def record(self, kind, key, payload):
+        """
+        追加一条记录
+
+        Args:
+            kind: 记录类型 (REC_COMMAND/REC_PUBLISH/REC_DEVICE)
+            key: 连接地址或主题 (str)
+            payload: 数据 (bytes、memoryview 或 str)
+        """
+        t_ns = time.monotonic_ns() - self.start_ns
+        key_bytes = key.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        header = RECORD_HEADER.pack(kind, t_ns, len(key_bytes), len(payload))
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(header)
+            self.file.write(key_bytes)
+            self.file.write(payload)
+            self.record_count += 1
+
+    def flush(self):
+        """将缓冲数据写入磁盘"""
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        """关闭记录器"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.close()
+        logger.info(f"流量抓取已关闭: {self.path} ({self.record_count} 条记录)")
+
+
+def read_capture(path, buffer_size=1024 * 1024):
+    """
+    读取抓取文件（逐条读取，内存占用与文件大小无关）
+
+    Args:
+        path: 抓取文件路径
+        buffer_size: 读缓冲大小（字节）
+
+    Yields:
+        tuple: (kind, t_ns, key, payload)
+    """
+    with open(path, 'rb', buffering=buffer_size) as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"不是有效的抓取文件: {path}")
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                if header:
+                    logger.warning(f"⚠️ 抓取文件末尾记录不完整，已忽略: {path}")
+                break
+            kind, t_ns, key_len, payload_len = RECORD_HEADER.unpack(header)
+            body = f.read(key_len + payload_len)
+            if len(body) < key_len + payload_len:
+                logger.warning(f"⚠️ 抓取文件末尾记录不完整，已忽略: {path}")
+                break
+            yield kind, t_ns, str(body[:key_len], 'utf-8'), body[key_len:]